@@ -0,0 +1,300 @@
+"""Benchmarks of the scheduler hot path with synthetic queues.
+
+Drives `check_work`, `/client/register`, `/client/ping` and `/api` in-process
+(flask test client, simulated gpus), so the numbers are the server-side cost
+without the network. Results are written as json and can be compared with a
+previous run to catch regressions:
+
+    $ python benchmarks/bench_scheduler.py --clients 10,1000,10000 --gpus 8,64 --output bench.json
+    $ python benchmarks/bench_scheduler.py --baseline bench.json --max_regression 0.2
+"""
+import io
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tracemalloc
+import subprocess
+import datetime
+import statistics
+import warnings
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from werkzeug.test import EnvironBuilder  # noqa: E402
+
+from watchmen import listener, server  # noqa: E402
+from watchmen.backends import SimulatedBackend  # noqa: E402
+from watchmen.client import ClientCollection, ClientModel, ClientMode  # noqa: E402
+from watchmen.listener import GPUInfo  # noqa: E402
+from watchmen.scheduler import FairShare  # noqa: E402
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))
+    return values[index]
+
+
+def summarize(name, scenario, latencies, **extra):
+    total = sum(latencies)
+    record = {
+        "op": name,
+        **scenario,
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000 if latencies else 0.0,
+        "throughput_per_s": len(latencies) / total if total > 0 else 0.0,
+    }
+    record.update(extra)
+    return record
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def wsgi_request(path, data):
+    """a prepared json POST, `call()` runs it through the wsgi app like a server would,
+    without the request building cost of the flask test client"""
+    body = json.dumps(data).encode()
+    environ = EnvironBuilder(
+        path=path, method="POST", data=body, content_type="application/json"
+    ).get_environ()
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    def call():
+        request_environ = dict(environ)
+        request_environ["wsgi.input"] = io.BytesIO(body)
+        return b"".join(server.app.wsgi_app(request_environ, start_response))
+
+    return call
+
+
+def make_client_data(index, num_gpus, schedule_ratio, rng):
+    user = f"user{index % 17}"
+    if rng.random() < schedule_ratio:
+        scope = sorted(rng.sample(range(num_gpus), k=min(num_gpus, rng.randint(1, 8))))
+        return {
+            "id": f"{user}@job-{index}",
+            "gpus": scope,
+            "mode": ClientMode.SCHEDULE.value,
+            "req_gpu_num": rng.randint(1, len(scope)),
+        }
+    return {
+        "id": f"{user}@job-{index}",
+        "gpus": sorted(rng.sample(range(num_gpus), k=min(num_gpus, rng.randint(1, 2)))),
+        "mode": ClientMode.QUEUE.value,
+    }
+
+
+def setup_server(num_gpus, seed):
+    backend = SimulatedBackend(num_gpus=num_gpus, seed=seed)
+    listener.set_default_backend(backend)
+    server.gpu_info = GPUInfo(backend=backend)
+    server.cc = ClientCollection()
+    server.fair_share = FairShare()
+    server.AUTH_TOKEN = None
+    return backend
+
+
+def measure_memory(num_clients, num_gpus, schedule_ratio, seed):
+    """bytes allocated by a work queue of `num_clients` clients"""
+    rng = random.Random(seed)
+    data = [make_client_data(i, num_gpus, schedule_ratio, rng) for i in range(num_clients)]
+    now = datetime.datetime.now()
+    tracemalloc.start()
+    cc = ClientCollection()
+    for item in data:
+        cc.add(ClientModel(**item, register_time=now, last_request_time=now))
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del cc
+    return size
+
+
+def run_scenario(num_clients, num_gpus, schedule_ratio, args):
+    scenario = {"clients": num_clients, "gpus": num_gpus, "schedule_ratio": schedule_ratio}
+    rng = random.Random(args.seed)
+    backend = setup_server(num_gpus, args.seed)
+    app_client = server.app.test_client()
+    records = []
+
+    # half of the gpus are busy, so the queue cannot be drained at once
+    for gpu in rng.sample(range(num_gpus), k=num_gpus // 2):
+        backend.occupy(gpu)
+    server.check_gpu_info()
+
+    latencies = []
+    ids = []
+    for index in range(num_clients):
+        data = make_client_data(index, num_gpus, schedule_ratio, rng)
+        latency, response = timed(app_client.post, "/client/register", json=data)
+        assert response.json["status"] == "ok", response.json
+        latencies.append(latency)
+        ids.append(data["id"])
+    records.append(summarize("register", scenario, latencies))
+
+    latencies = []
+    for _ in range(args.passes):
+        # flip a gpu, so every pass sees a changed snapshot
+        gpu = rng.randrange(num_gpus)
+        if rng.random() < 0.5:
+            backend.occupy(gpu)
+        else:
+            backend.release(gpu)
+        server.check_gpu_info()
+        latency, _ = timed(server.check_work, args.queue_timeout)
+        latencies.append(latency)
+    records.append(summarize("check_work", scenario, latencies))
+
+    # passes without any change of the gpus or the queue
+    latencies = []
+    for _ in range(args.passes):
+        latency, _ = timed(server.check_work, args.queue_timeout)
+        latencies.append(latency)
+    records.append(summarize("check_work_idle", scenario, latencies))
+
+    latencies = []
+    for _ in range(args.pings):
+        client_id = ids[rng.randrange(len(ids))]
+        latency, response = timed(app_client.post, "/client/ping", json={"id": client_id})
+        latencies.append(latency)
+    records.append(summarize("ping", scenario, latencies))
+
+    requests = [
+        wsgi_request("/client/ping", {"id": ids[rng.randrange(len(ids))]})
+        for _ in range(args.pings)
+    ]
+    latencies = [timed(call)[0] for call in requests]
+    records.append(summarize("ping_wsgi", scenario, latencies))
+
+    for name, url in [("api", "/api"), ("api_page", "/api?limit=100"), ("api_delta", None)]:
+        latencies = []
+        sizes = []
+        for _ in range(args.api_calls):
+            if url is None:
+                version = server.cc.version_token()
+                server.check_work(args.queue_timeout)
+                request_url = f"/api?since={version}"
+            else:
+                request_url = url
+            latency, response = timed(app_client.get, request_url)
+            latencies.append(latency)
+            sizes.append(len(response.data))
+        records.append(summarize(name, scenario, latencies, mean_bytes=statistics.mean(sizes)))
+
+    records.append(
+        {
+            "op": "memory",
+            **scenario,
+            "bytes": measure_memory(num_clients, num_gpus, schedule_ratio, args.seed),
+        }
+    )
+    return records
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).resolve().parent,
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def record_key(record):
+    return (record["op"], record["clients"], record["gpus"], record["schedule_ratio"])
+
+
+def compare(results, baseline, max_regression):
+    """print the p50 changes against `baseline`, returns the regressed records"""
+    baseline_records = {record_key(r): r for r in baseline["results"]}
+    regressions = []
+    for record in results["results"]:
+        old = baseline_records.get(record_key(record))
+        if old is None or "p50_ms" not in record or old["p50_ms"] <= 0:
+            continue
+        change = record["p50_ms"] / old["p50_ms"] - 1
+        print(f"{record['op']:>15} clients={record['clients']:<6} gpus={record['gpus']:<3} "
+              f"p50 {old['p50_ms']:.3f}ms -> {record['p50_ms']:.3f}ms ({change:+.1%})")
+        if change > max_regression:
+            regressions.append(record)
+    return regressions
+
+
+def parse_args(in_args=None):
+    parser = argparse.ArgumentParser(description="watchmen scheduler benchmarks")
+    parser.add_argument("--clients", type=str, default="10,1000,10000",
+                        help="comma separated queue sizes, e.g. `10,1000,100000`")
+    parser.add_argument("--gpus", type=str, default="8,64", help="comma separated gpu counts")
+    parser.add_argument("--schedule_ratio", type=float, default=0.5,
+                        help="ratio of `schedule` mode clients, the others use `queue` mode")
+    parser.add_argument("--passes", type=int, default=20, help="number of `check_work` passes")
+    parser.add_argument("--pings", type=int, default=2000, help="number of pings")
+    parser.add_argument("--api_calls", type=int, default=5, help="number of calls per `/api` variant")
+    parser.add_argument("--queue_timeout", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=1997)
+    parser.add_argument("--output", type=str, default="", help="json file to write the results to")
+    parser.add_argument("--baseline", type=str, default="", help="json results of a previous run")
+    parser.add_argument("--max_regression", type=float, default=0.2,
+                        help="exit with 1 if any p50 is slower than the baseline by this ratio")
+    return parser.parse_args(in_args)
+
+
+def main(in_args=None):
+    args = parse_args(in_args)
+    warnings.simplefilter("ignore")
+    logging.getLogger("common").setLevel(logging.WARNING)
+
+    results = {
+        "meta": {
+            "time": datetime.datetime.now().isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": [],
+    }
+    for num_gpus in map(int, args.gpus.split(",")):
+        for num_clients in map(int, args.clients.split(",")):
+            records = run_scenario(num_clients, num_gpus, args.schedule_ratio, args)
+            for record in records:
+                if record["op"] == "memory":
+                    print(f"{'memory':>15} clients={num_clients:<6} gpus={num_gpus:<3} "
+                          f"{record['bytes'] / 1024 / 1024:.1f} MiB")
+                else:
+                    print(f"{record['op']:>15} clients={num_clients:<6} gpus={num_gpus:<3} "
+                          f"p50={record['p50_ms']:.3f}ms p99={record['p99_ms']:.3f}ms "
+                          f"{record['throughput_per_s']:.0f}/s")
+            results["results"].extend(records)
+
+    if args.output:
+        with open(args.output, "wt", encoding="utf-8") as fout:
+            json.dump(results, fout, indent=2)
+    if args.baseline:
+        with open(args.baseline, "rt", encoding="utf-8") as fin:
+            baseline = json.load(fin)
+        regressions = compare(results, baseline, args.max_regression)
+        if regressions:
+            print(f"{len(regressions)} regressions over {args.max_regression:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
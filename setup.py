@@ -31,6 +31,9 @@ setuptools.setup(
         "pydantic>=1.7.1",
         "requests>=2.24.0",
     ],
+    extras_require={
+        "server": ["waitress>=2.0.0"],
+    },
     package_data={
         'watchmen' : [
             'templates/*.html'
@@ -0,0 +1,53 @@
+from watchmen.allocator import BestFitAllocator, FirstFitAllocator, GPUTopology, get_allocator
+from watchmen.backends import SimulatedBackend
+from watchmen.listener import GPUInfo
+
+
+# two nvlink islands of 4 gpus, gpu 0 and 1 are bonded by 2 links
+TOPO = """\
+\tGPU0\tGPU1\tGPU2\tGPU3\tGPU4\tGPU5\tGPU6\tGPU7\tNIC0\tCPU Affinity\tNUMA Affinity
+GPU0\t X \tNV2\tNV1\tNV1\tSYS\tSYS\tSYS\tSYS\tPXB\t0-31\t0
+GPU1\tNV2\t X \tNV1\tNV1\tSYS\tSYS\tSYS\tSYS\tPXB\t0-31\t0
+GPU2\tNV1\tNV1\t X \tNV1\tSYS\tSYS\tSYS\tSYS\tPXB\t0-31\t0
+GPU3\tNV1\tNV1\tNV1\t X \tSYS\tSYS\tSYS\tSYS\tPXB\t0-31\t0
+GPU4\tSYS\tSYS\tSYS\tSYS\t X \tNV1\tNV1\tNV1\tSYS\t32-63\t1
+GPU5\tSYS\tSYS\tSYS\tSYS\tNV1\t X \tNV1\tNV1\tSYS\t32-63\t1
+GPU6\tSYS\tSYS\tSYS\tSYS\tNV1\tNV1\t X \tNV1\tSYS\t32-63\t1
+GPU7\tSYS\tSYS\tSYS\tSYS\tNV1\tNV1\tNV1\t X \tSYS\t32-63\t1
+NIC0\tPXB\tPXB\tPXB\tPXB\tSYS\tSYS\tSYS\tSYS\t X \t\t
+
+Legend:
+
+  X    = Self
+"""
+
+
+def test_topology():
+    topology = GPUTopology.from_text(TOPO)
+    assert topology.num_gpus == 8
+    assert topology.islands == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    assert topology.score([0, 1]) > topology.score([0, 2]) > topology.score([0, 4])
+
+
+def test_best_fit():
+    allocator = BestFitAllocator(GPUTopology.from_text(TOPO))
+    # gpu 3 is the last free one of its island, the idle island is kept for larger jobs
+    assert allocator.allocate([3, 4, 5], 1, [3, 4, 5, 6, 7]) == [3]
+    assert FirstFitAllocator().allocate([4, 5, 3], 1, [3, 4, 5, 6, 7]) == [4]
+    # packed into one island with the best links
+    assert allocator.allocate([2, 0, 4, 1], 2, [0, 1, 2, 4]) == [0, 1]
+    # spans the islands if none fits
+    assert allocator.allocate([0, 4, 5], 3, [0, 4, 5]) == [0, 4, 5]
+    assert allocator.allocate([0, 4], 3, [0, 4]) is None
+    # without topology it is first fit
+    assert get_allocator("best_fit").allocate([4, 5, 3], 2, [3, 4, 5]) == [4, 5]
+
+
+def test_best_fit_gpu_info():
+    backend = SimulatedBackend(num_gpus=8, topology=TOPO)
+    backend.occupy(0)
+    gpu_info = GPUInfo(backend=backend, allocator=get_allocator("best_fit", backend.topology()))
+    scope = list(range(8))
+    assert gpu_info.is_req_gpu_num_satisfied(scope, 1) == (True, [1])
+    assert gpu_info.is_req_gpu_num_satisfied(scope, 4) == (True, [4, 5, 6, 7])
+    assert gpu_info.is_req_gpu_num_satisfied(scope, 1, exclude_mask=0b1110) == (True, [4])
@@ -0,0 +1,30 @@
+import json
+import runpy
+from pathlib import Path
+
+from watchmen import listener, server
+
+
+def test_bench_scheduler(tmp_path, monkeypatch):
+    # the harness swaps the global state of the server, restored by monkeypatch
+    for module, name in [(listener, "default_backend"), (server, "gpu_info"), (server, "cc"),
+                         (server, "fair_share")]:
+        monkeypatch.setattr(module, name, getattr(module, name))
+    bench = runpy.run_path(str(Path(__file__).parent.parent / "benchmarks" / "bench_scheduler.py"))
+    output = tmp_path / "bench.json"
+    args = ["--clients", "10", "--gpus", "1,4", "--passes", "2", "--pings", "5", "--api_calls", "1"]
+    assert bench["main"](args + ["--output", str(output)]) == 0
+    results = json.loads(output.read_text())
+    ops = {r["op"] for r in results["results"]}
+    assert ops == {
+        "register", "check_work", "check_work_idle", "ping", "ping_wsgi",
+        "api", "api_page", "api_delta", "memory",
+    }
+
+    # a baseline 1000x faster than this run must be reported as a regression
+    for record in results["results"]:
+        if "p50_ms" in record:
+            record["p50_ms"] /= 1000
+    baseline = tmp_path / "baseline.json"
+    baseline.write_text(json.dumps(results))
+    assert bench["main"](args + ["--baseline", str(baseline)]) == 1
@@ -1,5 +1,87 @@
-from watchmen.client import ClientMode
+import datetime
+import threading
+
+from watchmen.client import ClientCollection, ClientMode, ClientModel, WatchClient
 
 
 def test_in_mode_method():
     assert ClientMode.has_value("queue") is True
+
+
+def test_client_session(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("watchmen.client.check_gpus_existence", lambda gpus: True)
+    with WatchClient("test", [0], "127.0.0.1", 62333, token="secret", max_retries=3) as client:
+        adapter = client.session.get_adapter(client.base_url)
+        assert adapter.max_retries.connect == 3
+        assert client.session.headers["X-Auth-Token"] == "secret"
+
+
+def test_client_collection_concurrency():
+    cc = ClientCollection()
+    errors = []
+
+    def register(start):
+        for i in range(start, start + 500):
+            assert cc.add(ClientModel(id=str(i)))
+            if i % 2 == 0:
+                cc.mark_finished(str(i))
+
+    def read():
+        try:
+            for _ in range(20):
+                for client in cc.work_clients() + cc.finished_clients():
+                    client.dict()
+        except RuntimeError as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=register, args=(i * 500,)) for i in range(4)]
+    threads.append(threading.Thread(target=read))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert len(cc.work_clients()) == len(cc.finished_clients()) == 1000
+    assert cc.add(ClientModel(id="1")) is False
+    assert cc.get("0")[1] is True
+
+
+def test_finished_retention():
+    cc = ClientCollection(max_finished=3)
+    now = datetime.datetime.now()
+    for i in range(5):
+        cc.add(ClientModel(id=str(i), last_request_time=now - datetime.timedelta(hours=5 - i)))
+    for i in [4, 0, 1, 2, 3]:
+        cc.mark_finished(str(i))
+    # the oldest ones are dropped beyond `max_finished`
+    assert sorted(cc.finished_queue) == ["2", "3", "4"]
+    cc.add(ClientModel(id="2", last_request_time=now))
+    cc.mark_finished("2")
+    assert cc.expire_finished(now - datetime.timedelta(hours=2)) == ["3"]
+    assert sorted(cc.finished_queue) == ["2", "4"]
+
+
+def test_client_pages_and_changes():
+    cc = ClientCollection()
+    for i in range(5):
+        cc.add(ClientModel(id=f"user@{i}"))
+    clients, cursor = cc.page("work", limit=2)
+    assert [x.id for x in clients] == ["user@0", "user@1"]
+    clients, cursor = cc.page("work", after=cursor, limit=2, predicate=lambda x: x.id != "user@2")
+    assert [x.id for x in clients] == ["user@3", "user@4"]
+    assert cursor is None
+
+    version = cc.version
+    assert cc.changes_since(version) == ({"work": [], "finished": []}, {"work": [], "finished": []})
+    cc.mark_finished("user@1")
+    cc.update(cc["user@3"])
+    changed, removed = cc.changes_since(version)
+    assert [x.id for x in changed["work"]] == ["user@3"]
+    assert [x.id for x in changed["finished"]] == ["user@1"]
+    assert removed == {"work": ["user@1"], "finished": []}
+    # a version the collection never had, e.g. from before a restart
+    assert cc.changes_since(cc.version + 1) is None
+    assert cc.parse_version_token(cc.version_token(version)) == version
+    assert cc.parse_version_token(f"{cc.epoch + 1}.{version}") is None
+    assert cc.parse_version_token(str(version)) is None
@@ -0,0 +1,229 @@
+import os
+import sys
+import getpass
+import threading
+from types import SimpleNamespace
+
+from watchmen import listener
+from watchmen.backends import MB, SimulatedBackend, get_backend
+from watchmen.client import ClientCollection, ClientModel
+from watchmen.listener import (
+    FreeHistory,
+    GPUInfo,
+    check_gpus_existence,
+    gpus_to_mask,
+    mask_to_gpus,
+    popcount,
+)
+
+
+def test_snapshot_single_query():
+    backend = SimulatedBackend(num_gpus=4)
+    backend.occupy(1)
+    backend.occupy(3, memory=10, utilization=90)
+    gpu_info = GPUInfo(backend=backend)
+    snapshot = gpu_info.get_snapshot()
+    assert backend.num_queries == 1
+    assert gpu_info.is_gpus_available([0, 2], snapshot=snapshot) is True
+    assert gpu_info.is_gpus_available([0, 1], snapshot=snapshot) is False
+    assert gpu_info.get_available_gpus_in_scope([0, 1, 2, 3]) == [0, 2]
+    assert gpu_info.is_req_gpu_num_satisfied([0, 1, 2, 3], 1) == (True, [0])
+    assert gpu_info.is_req_gpu_num_satisfied([1, 2, 3], 2) == (False, [2])
+    assert backend.num_queries == 1
+
+
+def test_snapshot_freshness():
+    backend = SimulatedBackend(num_gpus=1)
+    gpu_info = GPUInfo(max_snapshot_age=0, backend=backend)
+    gpu_info.get_snapshot()
+    gpu_info.get_snapshot()
+    assert backend.num_queries == 2
+
+
+def test_snapshot_version():
+    backend = SimulatedBackend(num_gpus=2)
+    gpu_info = GPUInfo(backend=backend)
+    assert gpu_info.version == -1
+    assert gpu_info.new_query().version == 0
+    assert gpu_info.new_query().version == 0
+    backend.occupy(0)
+    assert gpu_info.new_query().version == 1
+
+
+def test_simulated_backend():
+    now = [0.0]
+    backend = get_backend("simulated", num_gpus=2, clock=lambda: now[0])
+    pid = backend.occupy(0, duration=10)
+    gs = backend.query()
+    assert [len(gpu.processes) for gpu in gs.gpus] == [1, 0]
+    assert gs.jsonify()["gpus"][0]["processes"][0]["pid"] == pid
+    now[0] = 11.0
+    assert [len(gpu.processes) for gpu in backend.query().gpus] == [0, 0]
+
+    backend = SimulatedBackend(num_gpus=2, trace=lambda t, index: (50, 2048) if index else (0, 0))
+    assert [gpu.utilization for gpu in backend.query().gpus] == [0, 50]
+
+
+def test_nvml_backend(monkeypatch):
+    class NVMLError(Exception):
+        pass
+
+    memory = {0: (80 * MB, 0), 1: (80 * MB, 40 * MB)}
+    processes = {0: [], 1: [SimpleNamespace(pid=42, usedGpuMemory=40 * MB)]}
+
+    def not_supported(handle):
+        raise NVMLError("not supported")
+
+    fake_nvml = SimpleNamespace(
+        NVMLError=NVMLError,
+        nvmlInit=lambda: None,
+        nvmlShutdown=lambda: None,
+        nvmlSystemGetDriverVersion=lambda: b"550.00",
+        nvmlDeviceGetCount=lambda: 2,
+        nvmlDeviceGetHandleByIndex=lambda index: index,
+        nvmlDeviceGetName=lambda handle: b"Fake GPU",
+        nvmlDeviceGetUUID=lambda handle: f"GPU-{handle}",
+        nvmlDeviceGetMemoryInfo=lambda handle: SimpleNamespace(
+            total=memory[handle][0], used=memory[handle][1]
+        ),
+        nvmlDeviceGetUtilizationRates=lambda handle: SimpleNamespace(gpu=5),
+        NVML_TEMPERATURE_GPU=0,
+        nvmlDeviceGetTemperature=lambda handle, sensor: 40 + handle,
+        nvmlDeviceGetComputeRunningProcesses=lambda handle: processes[handle],
+        nvmlDeviceGetGraphicsRunningProcesses=not_supported,
+    )
+    monkeypatch.setitem(sys.modules, "pynvml", fake_nvml)
+    backend = get_backend("nvml")
+    assert backend.device_count() == 2
+    gpu_info = GPUInfo(backend=backend)
+    assert gpu_info.get_available_gpus_in_scope([0, 1]) == [0]
+    assert gpu_info.gpus[1].processes == [{"pid": 42, "gpu_memory_usage": 40}]
+    # shown from the snapshot, the user of a pid is only looked up once
+    backend._process_infos[42] = {"username": "alice", "command": "python"}
+    detail = gpu_info.gs.jsonify()
+    assert detail["driver_version"] == "550.00"
+    assert [gpu["temperature.gpu"] for gpu in detail["gpus"]] == [40, 41]
+    assert detail["gpus"][1]["processes"] == [
+        {"pid": 42, "gpu_memory_usage": 40, "username": "alice", "command": "python"}
+    ]
+    assert backend.process_info(os.getpid())["username"] == getpass.getuser()
+
+
+
+def test_nvml_reenumerate(monkeypatch):
+    class NVMLError(Exception):
+        pass
+
+    count = [2]
+
+    def memory_info(handle):
+        if handle >= count[0]:
+            raise NVMLError("gpu is lost")
+        return SimpleNamespace(total=80 * MB, used=0)
+
+    fake_nvml = SimpleNamespace(
+        NVMLError=NVMLError,
+        nvmlInit=lambda: None,
+        nvmlShutdown=lambda: None,
+        nvmlSystemGetDriverVersion=lambda: b"550.00",
+        nvmlDeviceGetCount=lambda: count[0],
+        nvmlDeviceGetHandleByIndex=lambda index: index,
+        nvmlDeviceGetName=lambda handle: b"Fake GPU",
+        nvmlDeviceGetUUID=lambda handle: f"GPU-{handle}",
+        nvmlDeviceGetMemoryInfo=memory_info,
+        nvmlDeviceGetUtilizationRates=lambda handle: SimpleNamespace(gpu=0),
+        NVML_TEMPERATURE_GPU=0,
+        nvmlDeviceGetTemperature=lambda handle, sensor: 40,
+        nvmlDeviceGetComputeRunningProcesses=lambda handle: [],
+        nvmlDeviceGetGraphicsRunningProcesses=lambda handle: [],
+    )
+    monkeypatch.setitem(sys.modules, "pynvml", fake_nvml)
+    backend = get_backend("nvml")
+    assert backend.device_count() == 2
+
+    # a gpu fell off the bus, its stale handle fails and the query enumerates again
+    count[0] = 1
+    gpu_info = GPUInfo(backend=backend)
+    assert [gpu.uuid for gpu in gpu_info.gpus] == ["GPU-0"]
+    assert backend.device_count() == 1
+
+    # hotplugged gpus show up on the next inventory refresh
+    count[0] = 3
+    assert backend.load_inventory().uuids == ("GPU-0", "GPU-1", "GPU-2")
+    assert len(backend.query().gpus) == 3
+
+def test_gpu_masks():
+    assert gpus_to_mask([0, 3, 64]) == (1 << 64) | 0b1001
+    assert mask_to_gpus((1 << 64) | 0b1001) == [0, 3, 64]
+    assert popcount(0b1011) == 3
+    backend = SimulatedBackend(num_gpus=4)
+    backend.occupy(2)
+    assert GPUInfo(backend=backend).get_snapshot().free_mask == 0b1011
+    cc = ClientCollection()
+    cc.add(ClientModel(id="a", gpus=[1, 2]))
+    assert cc.gpu_masks == {"a": 0b110}
+    cc.mark_finished("a")
+    assert cc.gpu_masks == {}
+
+
+def test_free_history():
+    history = FreeHistory(min_free_time=10, grant_hold=30)
+    # gpu 0 always free, gpu 1 idle for a moment between two epochs
+    assert history.add(0b11, now=0) == 0
+    assert history.add(0b01, now=5) == 0
+    assert history.add(0b11, now=10) == 0b01
+    # seen busy 11 seconds ago, free since then
+    assert history.add(0b11, now=16) == 0b01
+    history.hold([0], now=16)
+    assert history.add(0b11, now=20) == 0b10
+    assert history.add(0b11, now=46) == 0b11
+    assert history.holds == {}
+
+    backend = SimulatedBackend(num_gpus=2)
+    backend.occupy(1)
+    snapshot = GPUInfo(backend=backend, history=FreeHistory(min_free_time=60)).get_snapshot()
+    assert (snapshot.raw_free_mask, snapshot.free_mask, snapshot.free) == (0b01, 0, (False, False))
+
+
+def test_concurrent_queries():
+    backend = SimulatedBackend(num_gpus=2)
+    history = FreeHistory(min_free_time=0.01, grant_hold=0.001)
+    gpu_info = GPUInfo(max_snapshot_age=0, backend=backend, history=history)
+    errors = []
+
+    def query(refresh):
+        try:
+            for _ in range(200):
+                refresh()
+                history.hold([0, 1])
+        except Exception as err:
+            errors.append(err)
+
+    threads = [
+        threading.Thread(target=query, args=(refresh,))
+        for refresh in [gpu_info.new_query, gpu_info.get_snapshot] * 4
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    timestamps = [t for t, _ in history.samples]
+    assert timestamps == sorted(timestamps)
+    assert gpu_info.num_queries == backend.num_queries
+
+
+def test_device_inventory(monkeypatch):
+    backend = SimulatedBackend(num_gpus=4)
+    monkeypatch.setattr(listener, "default_backend", backend)
+    for _ in range(100):
+        assert check_gpus_existence([0, 3])
+        assert not check_gpus_existence([4])
+    assert backend.num_queries == 1
+    assert backend.inventory().memory_totals == (81920,) * 4
+
+    # a gpu fell off the bus
+    backend.num_gpus = 3
+    GPUInfo(backend=backend).new_query()
+    assert not check_gpus_existence([3])
+    assert backend.num_queries == 2
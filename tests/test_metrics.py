@@ -0,0 +1,47 @@
+import threading
+
+from watchmen.metrics import Counter, Histogram
+
+
+def test_counter_and_histogram_across_threads():
+    counter = Counter("requests_total", "requests", ("route",))
+    histogram = Histogram("latency_seconds", "latency", buckets=(0.1, 1))
+
+    def work():
+        for _ in range(1000):
+            counter.inc("/a")
+            histogram.observe(0.5)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    counter.inc("/b", amount=2)
+    histogram.observe(0.1)
+    histogram.observe(5)
+
+    # the shards of the exited threads are folded into the base one
+    assert counter.collect() == {("/a",): 4000, ("/b",): 2}
+    assert len(counter._shards) == 1
+    assert histogram.render() == [
+        "# HELP latency_seconds latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1"} 4001',
+        'latency_seconds_bucket{le="+Inf"} 4002',
+        "latency_seconds_sum 2005.1",
+        "latency_seconds_count 4002",
+    ]
+    assert counter.render()[2] == 'requests_total{route="/a"} 4000'
+
+
+def test_shards_of_short_lived_threads():
+    # e.g. flask in threaded mode, a thread per request and nobody scraping
+    counter = Counter("requests_total", "requests")
+    for _ in range(1000):
+        t = threading.Thread(target=counter.inc)
+        t.start()
+        t.join()
+        assert len(counter._shards) <= Counter.min_prune_shards
+    assert counter.collect() == {(): 1000}
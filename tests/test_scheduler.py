@@ -0,0 +1,83 @@
+import threading
+
+from watchmen.client import ClientModel
+from watchmen.scheduler import FairShare, WorkTrigger
+
+
+def test_trigger_coalesces_events():
+    trigger = WorkTrigger(debounce=0.05, fallback_interval=10)
+    for reason in ["register", "register", "cancel"]:
+        trigger.notify(reason)
+    assert trigger.wait() == {"register", "cancel"}
+
+
+def test_trigger_fallback_timer():
+    trigger = WorkTrigger(debounce=0, fallback_interval=0.01)
+    assert trigger.wait() == {"timer"}
+
+
+def test_trigger_run_and_stop():
+    trigger = WorkTrigger(debounce=0, fallback_interval=10)
+    passes = []
+    done = threading.Event()
+
+    def work():
+        passes.append(1)
+        done.set()
+
+    worker = threading.Thread(target=trigger.run, args=(work,), daemon=True)
+    worker.start()
+    trigger.notify()
+    assert done.wait(5)
+    trigger.stop()
+    worker.join(5)
+    assert not worker.is_alive()
+    assert trigger.num_passes == len(passes) >= 1
+
+
+def test_trigger_survives_failing_pass():
+    trigger = WorkTrigger(debounce=0, fallback_interval=10)
+    passes = []
+    done = threading.Event()
+
+    def work():
+        passes.append(1)
+        if len(passes) == 1:
+            raise RuntimeError("broken pass")
+        done.set()
+
+    worker = threading.Thread(target=trigger.run, args=(work,), daemon=True)
+    worker.start()
+    trigger.notify()
+    while not done.is_set() and worker.is_alive():
+        trigger.notify()
+        done.wait(0.01)
+    assert done.is_set() and worker.is_alive()
+    trigger.stop()
+    worker.join(5)
+    assert len(passes) >= 2
+
+
+def test_fair_share_order():
+    now = [0.0]
+    fair_share = FairShare(half_life=3600, default_walltime=3600, clock=lambda: now[0])
+    clients = [
+        ClientModel(id="alice@0"),
+        ClientModel(id="alice@1"),
+        ClientModel(id="bob@0", priority="low"),
+        ClientModel(id="carol@0"),
+    ]
+    fair_share.charge("carol", 3600)
+    assert [c.id for c in fair_share.order(clients)] == ["alice@0", "alice@1", "carol@0", "bob@0"]
+
+    order = []
+    for client in fair_share.order(clients):
+        order.append(client.id)
+        client.available_gpus = [0, 1]
+        fair_share.grant(client)
+    # alice is charged by the first grant, so carol goes in between
+    assert order == ["alice@0", "carol@0", "alice@1", "bob@0"]
+
+    now[0] = 3600.0
+    assert fair_share.usage("alice") == 2 * 2 * 3600 / 2
+    assert fair_share.quota("alice") is None
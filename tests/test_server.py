@@ -0,0 +1,458 @@
+import json
+import datetime
+import time
+import getpass
+import threading
+from types import SimpleNamespace
+
+import pytest
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from watchmen import listener, server
+from watchmen.agent import build_report, report_once
+from watchmen.allocator import BestFitAllocator
+from watchmen.backends import ClusterBackend, SimulatedBackend
+from watchmen.client import ClientCollection, WatchGroup
+from watchmen.listener import GPUInfo
+from watchmen.profiling import PassLog
+from watchmen.scheduler import FairShare
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = SimulatedBackend(num_gpus=4)
+    monkeypatch.setattr(listener, "default_backend", backend)
+    monkeypatch.setattr(server, "gpu_info", GPUInfo(backend=backend))
+    monkeypatch.setattr(server, "cc", ClientCollection())
+    monkeypatch.setattr(server, "fair_share", FairShare())
+    monkeypatch.setattr(server, "AUTH_TOKEN", None)
+    return backend
+
+
+@pytest.fixture
+def app_client(backend):
+    return server.app.test_client()
+
+
+def register(app_client, client_id, gpus, mode="queue", req_gpu_num=0):
+    data = {"id": client_id, "gpus": gpus, "mode": mode, "req_gpu_num": req_gpu_num}
+    return app_client.post("/client/register", json=data).json
+
+
+def ping(app_client, client_id):
+    return app_client.post("/client/ping", json={"id": client_id}).json
+
+
+def test_queue_and_schedule(app_client, backend):
+    backend.occupy(0)
+    assert register(app_client, "a", [0])["status"] == "ok"
+    assert register(app_client, "b", [0, 1, 2], mode="schedule", req_gpu_num=2)["status"] == "ok"
+    assert register(app_client, "c", [1, 2, 3], mode="schedule", req_gpu_num=1)["status"] == "ok"
+    assert register(app_client, "c", [1])["status"] == "err"
+    # cached response of the waiting client, replaced once it is granted
+    assert ping(app_client, "b")["msg"] == "waiting"
+    server.check_work(300)
+    assert ping(app_client, "a")["msg"] == "waiting"
+    assert app_client.post("/client/ping", data="{").json["status"] == "err"
+    assert ping(app_client, "b") == {"status": "ok", "msg": "ready", "available_gpus": [1, 2]}
+    # allocated around the gpus reserved for `b`
+    assert ping(app_client, "c") == {"status": "ok", "msg": "ready", "available_gpus": [3]}
+
+    assert app_client.post("/client/cancel", json={"id": "a"}).json["status"] == "ok"
+    assert ping(app_client, "a")["msg"] == "cancelled"
+    api = app_client.get("/api?fields=id,status").json
+    assert api["work_queue"] == [{"id": "b", "status": "ready"}, {"id": "c", "status": "ready"}]
+    assert api["finished_queue"] == [{"id": "a", "status": "cancelled"}]
+
+
+def test_api_since(app_client, backend, monkeypatch):
+    assert register(app_client, "a", [0])["status"] == "ok"
+    response = app_client.get("/api")
+    version, etag = response.json["version"], response.headers["ETag"]
+    assert register(app_client, "b", [1])["status"] == "ok"
+    delta = app_client.get(f"/api?since={version}&fields=id").json
+    assert delta["delta"] and delta["work_queue"] == [{"id": "b"}]
+    # positions follow from the order of the queue, a delta does not carry them
+    delta = app_client.get(f"/api?since={version}").json
+    assert "queue_num" not in delta["work_queue"][0]
+    assert app_client.get("/api").json["work_queue"][1]["queue_num"] == 1
+    for since in [f"{server.cc.epoch}.500", "500", "garbage"]:
+        full = app_client.get(f"/api?since={since}&fields=id").json
+        assert not full["delta"] and full["work_queue"] == [{"id": "a"}, {"id": "b"}]
+
+    # restarted and back at the same version number: another history, answered in full
+    restarted = ClientCollection()
+    restarted.epoch = server.cc.epoch + 1
+    monkeypatch.setattr(server, "cc", restarted)
+    assert register(app_client, "a", [0])["status"] == "ok"
+    response = app_client.get("/api?fields=id", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    full = app_client.get(f"/api?since={version}&fields=id").json
+    assert not full["delta"] and full["work_queue"] == [{"id": "a"}]
+
+
+def test_events(app_client, backend, monkeypatch):
+    monkeypatch.setattr(server, "EVENT_STREAM_HEARTBEAT", 0.05)
+
+    def connect(last_event_id=None):
+        headers = {} if last_event_id is None else {"Last-Event-ID": last_event_id}
+        response = app_client.get("/events?fields=id", headers=headers, buffered=False)
+        chunks = (chunk.decode() for chunk in response.response)
+        assert next(chunks).startswith("retry:")
+        return response, chunks
+
+    def read(chunks):
+        chunk = next(chunks)
+        if chunk.startswith(":"):
+            return "keep-alive", None, None
+        lines = dict(line.split(": ", 1) for line in chunk.strip().split("\n"))
+        return lines["event"], lines["id"], json.loads(lines["data"])
+
+    assert register(app_client, "a", [0])["status"] == "ok"
+    response, chunks = connect()
+    event, event_id, data = read(chunks)
+    assert event == "full" and data["work_queue"] == [{"id": "a"}]
+    assert event_id == f"{server.cc.version_token()}-{server.gpu_info.version}"
+    assert register(app_client, "b", [1])["status"] == "ok"
+    event, event_id, data = read(chunks)
+    assert event == "delta" and data["work_queue"] == [{"id": "b"}]
+    assert event_id == f"{server.cc.version_token()}-{server.gpu_info.version}"
+    response.close()
+
+    # resumed from the last id, nothing to send
+    response, chunks = connect(event_id)
+    assert read(chunks)[0] == "keep-alive"
+    response.close()
+    # ids from before a restart or garbage get the whole state
+    for stale_id in [f"{server.cc.epoch}.900-5", f"{server.cc.epoch - 1}.3-0", "3-0", "garbage"]:
+        response, chunks = connect(stale_id)
+        event, event_id, data = read(chunks)
+        assert event == "full" and data["work_queue"] == [{"id": "a"}, {"id": "b"}]
+        assert event_id == f"{server.cc.version_token()}-{server.gpu_info.version}"
+        response.close()
+
+
+def test_long_poll_wait(app_client, backend):
+    for url in ["/client/wait", "/client/register"]:
+        for body in [dict(data=""), dict(data="{"), dict(json=[1]), dict(json={"gpus": "x"})]:
+            response = app_client.post(url, **body)
+            assert response.status_code == 200 and response.json["status"] == "err"
+    backend.occupy(0)
+    assert register(app_client, "a", [0])["status"] == "ok"
+    server.check_work(300)
+    # held until the timeout if the status does not change
+    result = app_client.post("/client/wait", json={"id": "a", "status": "waiting", "timeout": 0.05})
+    assert result.json["msg"] == "waiting"
+
+    results = []
+    waiter = threading.Thread(
+        target=lambda: results.append(
+            app_client.post("/client/wait", json={"id": "a", "status": "waiting", "timeout": 10}).json
+        )
+    )
+    waiter.start()
+    waiter.join(0.2)
+    assert waiter.is_alive()
+    backend.release(0)
+    server.check_gpu_info()
+    server.check_work(300)
+    waiter.join(5)
+    assert not waiter.is_alive()
+    assert results == [{"status": "ok", "msg": "ready", "available_gpus": [0]}]
+
+
+def test_backfill(app_client, backend):
+    def register_walltime(client_id, gpus, walltime=None, **kwargs):
+        data = {"id": client_id, "gpus": gpus, "walltime": walltime, **kwargs}
+        return app_client.post("/client/register", json=data).json
+
+    assert register_walltime("holder", [0], walltime=100)["status"] == "ok"
+    server.check_work(300)
+    backend.occupy(0)
+    server.gpu_info.new_query()
+    assert register_walltime("big", [0, 1], mode="schedule", req_gpu_num=2)["status"] == "ok"
+    assert register_walltime("long", [1])["status"] == "ok"
+    assert register_walltime("short", [1], walltime=10)["status"] == "ok"
+    assert register_walltime("other", [2])["status"] == "ok"
+    assert register_walltime("invalid", [2], walltime=-1)["status"] == "err"
+    server.check_work(300)
+    # gpu 1 is kept for `big`, except for `short` which is done before `holder`
+    assert ping(app_client, "big")["msg"] == "waiting"
+    assert ping(app_client, "long")["msg"] == "waiting"
+    assert ping(app_client, "short")["available_gpus"] == [1]
+    assert ping(app_client, "other")["available_gpus"] == [2]
+
+
+def test_duplicate_gpus(app_client, backend):
+    assert register(app_client, "a", [1, 1, 2])["status"] == "ok"
+    assert server.cc.get("a")[0].gpus == [1, 2]
+    server.check_work(300)
+    assert ping(app_client, "a") == {"status": "ok", "msg": "ready", "available_gpus": [1, 2]}
+
+
+def test_unsatisfiable_client(app_client, backend):
+    result = register(app_client, "big", [0, 1], mode="schedule", req_gpu_num=3)
+    assert result["status"] == "err"
+    # e.g. restored from the state file of an older server: never the head of the backfill
+    now = datetime.datetime.now()
+    big = dict(gpus=[0, 1], mode="schedule", req_gpu_num=3, register_time=now, last_request_time=now)
+    server.cc.add(server.ClientModel(id="big", **big))
+    assert register(app_client, "a", [1])["status"] == "ok"
+    server.check_work(300)
+    assert ping(app_client, "a")["msg"] == "ready"
+
+
+
+def test_ping_cache_eviction(app_client, backend, monkeypatch):
+    monkeypatch.setattr(server, "cc", ClientCollection(max_finished=1))
+    monkeypatch.setattr(server, "ping_responses", {})
+    monkeypatch.setattr(server, "PING_CACHE_SLACK", 0)
+    for index in range(10):
+        assert register(app_client, f"c{index}", [0])["status"] == "ok"
+        assert ping(app_client, f"c{index}")["msg"] == "waiting"
+        assert app_client.post("/client/cancel", json={"id": f"c{index}"}).json["status"] == "ok"
+    # all but one were trimmed from the finished queue, their pings go with the next scan
+    assert register(app_client, "x", [0])["status"] == "ok"
+    ping(app_client, "x")
+    (finished_id,) = server.cc.finished_queue
+    assert set(server.ping_responses) == {finished_id, "x"}
+    # expired ones are evicted right away
+    server.check_finished(0)
+    assert set(server.ping_responses) == {"x"}
+
+def test_backfill_off(app_client, backend, monkeypatch):
+    monkeypatch.setattr(server, "BACKFILL", False)
+    backend.occupy(0)
+    assert register(app_client, "big", [0, 1], mode="schedule", req_gpu_num=2)["status"] == "ok"
+    assert register(app_client, "long", [1])["status"] == "ok"
+    server.check_work(300)
+    assert ping(app_client, "long")["available_gpus"] == [1]
+
+
+def test_fair_share_and_quota(app_client, backend):
+    server.fair_share.user_quotas["bob"] = 1
+    for index in range(3):
+        assert register(app_client, f"alice@{index}", [0, 1, 2, 3], "schedule", 1)["status"] == "ok"
+    assert register(app_client, "bob@0", [0, 1, 2, 3], "schedule", 1)["status"] == "ok"
+    assert register(app_client, "bob@1", [0, 1, 2, 3], "schedule", 1)["status"] == "ok"
+    data = {"id": "carol@0", "gpus": [0, 1, 2, 3], "mode": "schedule", "req_gpu_num": 1,
+            "priority": "low"}
+    assert app_client.post("/client/register", json=data).json["status"] == "ok"
+    server.check_work(300)
+    ready = [c["id"] for c in app_client.get("/api?status=ready&fields=id").json["work_queue"]]
+    # users interleaved, bob is capped by its quota and carol has the lowest priority
+    assert ready == ["alice@0", "alice@1", "alice@2", "bob@0"]
+
+
+def test_incremental_check_work(app_client, backend, monkeypatch):
+    evaluated = []
+    evaluate_client = server.evaluate_client
+
+    def counting_evaluate_client(client, gpu_mask, snapshot):
+        evaluated.append(client.id)
+        return evaluate_client(client, gpu_mask, snapshot)
+
+    monkeypatch.setattr(server, "evaluate_client", counting_evaluate_client)
+    backend.occupy(0)
+    for client_id, gpus in [("a", [0]), ("b", [1]), ("c", [0, 2])]:
+        assert register(app_client, client_id, gpus)["status"] == "ok"
+    server.check_work(300)
+    assert sorted(evaluated) == ["a", "b", "c"]
+    assert ping(app_client, "b")["msg"] == "ready"
+
+    # unchanged gpus and queue: nothing is evaluated again, then the pass is skipped
+    server.check_work(300)
+    passes = []
+    server.cc.work_clients = lambda: passes.append(1) or []
+    server.check_work(300)
+    del server.cc.work_clients
+    assert passes == []
+
+    # only the clients waiting for the freed gpu are evaluated again
+    evaluated.clear()
+    backend.occupy(3)
+    backend.release(0)
+    server.gpu_info.new_query()
+    server.check_work(300)
+    assert sorted(evaluated) == ["a", "c"]
+    assert ping(app_client, "a")["msg"] == "ready"
+
+    # the clients behind a cancelled one move up without being changed or evaluated again
+    for client_id in ["d", "e"]:
+        assert register(app_client, client_id, [3])["status"] == "ok"
+    server.check_work(300)
+    version = server.cc.version
+    evaluated.clear()
+    assert app_client.post("/client/cancel", json={"id": "c"}).json["status"] == "ok"
+    server.check_work(300)
+    server.check_work(300)
+    assert evaluated == []
+    changed, removed = server.cc.changes_since(version)
+    assert changed["work"] == [] and removed["work"] == ["c"]
+    assert [c.queue_num for c in server.cc.work_clients()] == [0, 1, 2, 3]
+
+
+def test_cluster(monkeypatch):
+    now = [0.0]
+    cluster = ClusterBackend(node_timeout=30, clock=lambda: now[0])
+    monkeypatch.setattr(listener, "default_backend", cluster)
+    monkeypatch.setattr(server, "gpu_info", GPUInfo(backend=cluster, allocator=BestFitAllocator()))
+    monkeypatch.setattr(server, "cc", ClientCollection())
+    monkeypatch.setattr(server, "fair_share", FairShare())
+    monkeypatch.setattr(server, "AUTH_TOKEN", None)
+    app_client = server.app.test_client()
+    nodes = {"a": SimulatedBackend(num_gpus=2), "b": SimulatedBackend(num_gpus=2)}
+    nodes["a"].occupy(0)
+
+    def report():
+        for name, node in nodes.items():
+            data = build_report(name, node)
+            assert app_client.post("/node/report", json=data).json["status"] == "ok"
+
+    report()
+    assert server.gpu_info.allocator.topology.domains == [[0, 1], [2, 3]]
+
+    def register_nodes(client_id, gpus, nodes, **kwargs):
+        data = {"id": client_id, "gpus": gpus, "nodes": nodes, **kwargs}
+        return app_client.post("/client/register", json=data).json
+
+    assert register_nodes("q", [1], ["a"])["status"] == "ok"
+    assert register_nodes("any", [0, 1], [], mode="schedule", req_gpu_num=2)["status"] == "ok"
+    assert register_nodes("missing", [0], ["c"])["status"] == "err"
+    assert register_nodes("spanning", [0], ["a", "b"])["status"] == "err"
+    # 4 gpus in the cluster, but at most 2 on one node
+    assert register_nodes("big", [0, 1], [], mode="schedule", req_gpu_num=3)["status"] == "err"
+    server.check_work(300)
+    assert ping(app_client, "q") == {
+        "status": "ok", "msg": "ready", "available_gpus": [1], "node": "a"
+    }
+    # never split across the nodes, although 3 gpus are free
+    assert ping(app_client, "any") == {
+        "status": "ok", "msg": "ready", "available_gpus": [0, 1], "node": "b"
+    }
+
+    # a node that stopped reporting is busy
+    now[0] = 60
+    nodes.pop("b")
+    report()
+    server.check_gpu_info()
+    assert server.gpu_info.get_snapshot().free == (False, True, False, False)
+
+    # a joining node is queried by the periodic gpu job, not by the request thread
+    scheduler = BackgroundScheduler()
+    job = scheduler.add_job(server.check_gpu_info, trigger="interval", hours=1)
+    monkeypatch.setattr(server, "gpu_info_job", job)
+    scheduler.start()
+    try:
+        nodes["c"] = SimulatedBackend(num_gpus=2)
+        report()
+        for _ in range(100):
+            if len(server.gpu_info.snapshot) == 6:
+                break
+            time.sleep(0.05)
+    finally:
+        scheduler.shutdown()
+    assert server.gpu_info.snapshot.free == (False, True, False, False, True, True)
+
+
+def test_agent_survives_backend_errors(monkeypatch):
+    cluster = ClusterBackend()
+    monkeypatch.setattr(server, "gpu_info", GPUInfo(backend=cluster))
+    monkeypatch.setattr(server, "AUTH_TOKEN", None)
+    app_client = server.app.test_client()
+
+    def post(url, json=None, timeout=None):
+        response = app_client.post(url, json=json)
+        return SimpleNamespace(json=lambda: response.json)
+
+    session = SimpleNamespace(post=post)
+    node = SimulatedBackend(num_gpus=2)
+    query = node.query
+
+    def broken_query():
+        raise RuntimeError("driver reload")
+
+    node.query = broken_query
+    assert not report_once(session, "/node/report", "a", node)
+    node.query = query
+    assert report_once(session, "/node/report", "a", node)
+    assert list(cluster.nodes) == ["a"]
+
+
+def test_register_and_wait_batch(app_client, backend, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    backend.occupy(0)
+    clients = [{"id": "a", "gpus": [0]}, {"id": "a", "gpus": [1]}, {"id": "x", "gpus": [9]}]
+    result = app_client.post("/client/register_batch", json={"clients": clients}).json
+    assert [r["status"] for r in result["results"]] == ["ok", "err", "err"]
+    assert [c.id for c in server.cc.work_clients()] == ["a"]
+    for url in ["/client/register_batch", "/client/wait_batch"]:
+        for body in [clients, {"clients": 1, "statuses": []}]:
+            response = app_client.post(url, json=body)
+            assert response.status_code == 200 and response.json["status"] == "err"
+    result = app_client.post(
+        "/client/wait_batch", json={"statuses": {"a": "waiting"}, "timeout": 0}
+    ).json
+    assert result["clients"]["a"]["msg"] == "waiting"
+
+    jobs = [
+        {"id": "b", "gpus": [0, 1, 2], "mode": "schedule", "req_gpu_num": 2},
+        {"id": "c", "gpus": [3]},
+        {"id": "d", "gpus": [0]},
+    ]
+    group = WatchGroup(jobs, "127.0.0.1", 62333, long_poll_timeout=0, ping_interval=0)
+
+    def post(url, json=None, timeout=None):
+        if url.endswith("/client/wait_batch"):
+            server.check_work(300)
+        response = app_client.post(url[len(group.base_url):], json=json)
+        return SimpleNamespace(json=lambda: response.json)
+
+    monkeypatch.setattr(group.session, "post", post)
+    granted = group.wait()
+    user = getpass.getuser()
+    assert sorted([next(granted), next(granted)]) == [(f"{user}@b", [1, 2]), (f"{user}@c", [3])]
+    assert server.cc.get(f"{user}@d")[0].status == "waiting"
+
+
+def test_metrics(app_client, backend):
+    backend.occupy(0)
+    assert register(app_client, "alice@a", [0])["status"] == "ok"
+    assert register(app_client, "alice@b", [1])["status"] == "ok"
+    server.check_work(300)
+    ping(app_client, "alice@b")
+    text = app_client.get("/metrics").data.decode()
+    assert 'watchmen_clients{queue="work",status="waiting",mode="queue",user="alice"} 1' in text
+    assert 'watchmen_clients{queue="work",status="ready",mode="queue",user="alice"} 1' in text
+    assert 'watchmen_fair_share_usage_gpu_seconds{user="alice"} ' in text
+    assert 'watchmen_gpu_free{gpu="0",uuid="GPU-simulated-0000"} 0' in text
+    assert 'watchmen_gpu_processes{gpu="0",uuid="GPU-simulated-0000"} 1' in text
+    assert 'watchmen_wait_duration_seconds_bucket{mode="queue",le="1"} ' in text
+    assert 'watchmen_request_duration_seconds_count{route="/client/ping",method="POST"} ' in text
+    assert 'watchmen_check_work_duration_seconds_count ' in text
+
+
+def test_profiling(app_client, backend, monkeypatch):
+    assert app_client.get("/debug/passes").status_code == 404
+    monkeypatch.setattr(server, "PROFILE", True)
+    monkeypatch.setattr(server, "pass_log", PassLog(size=2))
+    backend.occupy(0)
+    for client_id in ["a", "b", "c"]:
+        assert register(app_client, client_id, [1])["status"] == "ok"
+        server.check_work(300)
+    passes = app_client.get("/debug/passes").json["passes"]
+    # newest first, only the last 2 are kept
+    assert [p["clients"] for p in passes] == [3, 2]
+    assert passes[0]["granted"] == 0 and passes[1]["granted"] == 0
+    assert set(passes[0]["phases_ms"]) == {"gpu_query", "evaluate", "lock_wait", "assign", "finish"}
+
+    stop = threading.Event()
+    worker = threading.Thread(target=stop.wait, name="check")
+    worker.start()
+    try:
+        profile = app_client.get("/debug/profile?seconds=0.05&thread=check").data.decode()
+    finally:
+        stop.set()
+        worker.join()
+    stack, count = profile.splitlines()[0].rsplit(" ", 1)
+    assert stack.startswith("check;") and "wait (threading.py" in stack and int(count) > 0
@@ -0,0 +1,56 @@
+import datetime
+
+from watchmen.client import ClientCollection, ClientModel, ClientStatus
+from watchmen.store import ClientStore, restore_clients
+
+
+def make_client(client_id):
+    now = datetime.datetime.now()
+    return ClientModel(id=client_id, gpus=[0], register_time=now, last_request_time=now)
+
+
+def test_store_restore(tmp_path):
+    path = str(tmp_path / "state.db")
+    cc = ClientCollection(store=ClientStore(path))
+    for client_id in ["a", "b", "c", "d"]:
+        cc.add(make_client(client_id))
+    cc["b"].status = ClientStatus.READY
+    cc["b"].available_gpus = [0]
+    cc.update(cc["b"])
+    cc["a"].status = ClientStatus.CANCELLED
+    cc.mark_finished("a")
+    cc.mark_finished("d")
+    cc.remove_finished("d")
+    # `a` registers again after it has been cancelled
+    cc.add(make_client("a"))
+    cc.store.close()
+
+    restored = ClientCollection()
+    assert restore_clients(restored, ClientStore(path)) == (3, 1)
+    assert [x.id for x in restored.work_clients()] == ["b", "c", "a"]
+    assert restored["b"].status == ClientStatus.READY
+    assert restored["b"].available_gpus == [0]
+    assert restored.finished_queue["a"].status == ClientStatus.CANCELLED
+    restored.store.compact()
+    restored.store.close()
+
+
+def test_store_history(tmp_path):
+    path = str(tmp_path / "state.db")
+    cc = ClientCollection(store=ClientStore(path), max_finished=2)
+    now = datetime.datetime.now()
+    for i in range(4):
+        client = make_client(str(i))
+        client.last_request_time = now - datetime.timedelta(hours=4 - i)
+        cc.add(client)
+        cc.mark_finished(str(i))
+    assert sorted(cc.finished_queue) == ["2", "3"]
+    # evicted clients are still kept in the store until they expire
+    assert cc.store.expire(now - datetime.timedelta(hours=3.5)) == 1
+    cc.store.close()
+
+    restored = ClientCollection(max_finished=-1)
+    assert restore_clients(restored, ClientStore(path)) == (0, 3)
+    restored = ClientCollection(max_finished=1)
+    assert restore_clients(restored, ClientStore(path)) == (0, 1)
+    assert list(restored.finished_queue) == ["3"]
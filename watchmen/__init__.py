@@ -1,4 +1,5 @@
 from .client import WatchClient
+from .client import WatchGroup
 from .client import ClientMode
 
 __version__ = "0.4.0"
@@ -0,0 +1,117 @@
+"""Reports the gpus of this node to a watchmen server in cluster mode.
+
+    $ python -m watchmen.server --gpu_backend cluster
+    $ python -m watchmen.agent --server_host <server ip> --node node-01 --token <token>
+
+The agent queries the local gpus every `--interval` seconds and posts them to
+`/node/report`, together with the `nvidia-smi topo -m` matrix of the node.
+"""
+import time
+import socket
+import logging
+import argparse
+
+import requests
+
+from watchmen.backends import BACKENDS, get_backend
+
+
+logger = logging.getLogger("common")
+
+
+def gpu_payload(gpu):
+    """the fields of a gpu the server needs, in the gpustat json format"""
+    return {
+        "index": gpu.index,
+        "uuid": gpu.uuid,
+        "name": gpu.name,
+        "temperature.gpu": gpu.temperature,
+        "utilization.gpu": gpu.utilization,
+        "memory.used": gpu.memory_used,
+        "memory.total": gpu.memory_total,
+        "processes": [dict(p) for p in gpu.processes or []],
+    }
+
+
+def build_report(node: str, backend, topology=None):
+    gpus = sorted(backend.query().gpus, key=lambda gpu: gpu.index)
+    return {
+        "node": node,
+        "gpus": [gpu_payload(gpu) for gpu in gpus],
+        "topology": None if topology is None else topology.matrix,
+    }
+
+
+def report_once(session, url: str, node: str, backend, topology=None):
+    """query the local gpus and post them once, returns whether the server took the report"""
+    try:
+        report = build_report(node, backend, topology)
+    except Exception:
+        # e.g. a driver reload or a transient NVML error, try again in the next round
+        logger.exception("err querying the local gpus")
+        return False
+    try:
+        result = session.post(url, json=report, timeout=10).json()
+    except (requests.RequestException, ValueError) as err:
+        # the server may be restarting, try again in the next round
+        logger.warning(f"err reporting: {err}")
+        return False
+    if result["status"] != "ok":
+        logger.error(f"err reporting: {result['msg']}")
+        return False
+    return True
+
+
+def run(args):
+    if args.gpu_backend == "simulated":
+        backend = get_backend(args.gpu_backend, num_gpus=args.simulated_gpus)
+    else:
+        backend = get_backend(args.gpu_backend)
+    topology = backend.topology()
+    url = f"http://{args.server_host}:{args.server_port}/node/report"
+    session = requests.Session()
+    if args.token:
+        session.headers.update({"X-Auth-Token": args.token})
+    logger.info(f"reporting {backend.device_count()} gpus of node {args.node} to {url}")
+    while True:
+        start = time.monotonic()
+        report_once(session, url, args.node, backend, topology)
+        time.sleep(max(0.0, args.interval - (time.monotonic() - start)))
+
+
+def parse_args(in_args=None):
+    parser = argparse.ArgumentParser(description="watchmen node agent for cluster mode")
+    parser.add_argument("--server_host", type=str, default="127.0.0.1", help="host of the server")
+    parser.add_argument("--server_port", type=int, default=62333, help="port of the server")
+    parser.add_argument(
+        "--node",
+        type=str,
+        default=socket.gethostname(),
+        help="name of this node, used by clients to request its gpus",
+    )
+    parser.add_argument(
+        "--gpu_backend",
+        type=str,
+        choices=sorted(name for name in BACKENDS if name != "cluster"),
+        default="nvml",
+        help="source of the local gpu status",
+    )
+    parser.add_argument(
+        "--simulated_gpus",
+        type=int,
+        default=8,
+        help="number of gpus for `--gpu_backend simulated`",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=1.0,
+        help="seconds between two reports, should be well below the `--node_timeout` of the server",
+    )
+    parser.add_argument("--token", type=str, default="", help="authentication token of the server")
+    return parser.parse_args(in_args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run(parse_args())
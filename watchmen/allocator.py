@@ -0,0 +1,251 @@
+import re
+import subprocess
+from typing import Dict, List, Optional
+
+
+# affinity of the link types in `nvidia-smi topo -m`, higher is closer
+LINK_AFFINITY = {
+    "X": 100,  # self
+    "PIX": 5,  # at most a single PCIe bridge
+    "PXB": 4,  # multiple PCIe bridges, without the host bridge
+    "PHB": 3,  # PCIe host bridge
+    "NODE": 2,  # PCIe host bridges within a NUMA node
+    "SYS": 1,  # across NUMA nodes (SMP interconnect)
+    "SOC": 1,  # older name of `SYS`
+    "NET": 0,  # different hosts (cluster mode)
+}
+NVLINK_AFFINITY = 10  # plus the number of bonded links, e.g. `NV4` -> 14
+
+
+def link_affinity(link: str):
+    link = link.strip().upper()
+    if link.startswith("NV"):
+        try:
+            return NVLINK_AFFINITY + int(link[2:])
+        except ValueError:
+            return NVLINK_AFFINITY
+    return LINK_AFFINITY.get(link, 0)
+
+
+def parse_topo_matrix(text: str):
+    """the gpu x gpu link matrix of the `nvidia-smi topo -m` output,
+    the NIC rows and columns and the affinity columns are dropped"""
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        return []
+    header = [name.strip() for name in lines[0].split("\t")]
+    columns = [j for j, name in enumerate(header) if re.fullmatch(r"GPU\d+", name)]
+    matrix = []
+    for line in lines[1:]:
+        cells = line.split("\t")
+        if not re.fullmatch(r"GPU\d+", cells[0].strip()):
+            continue
+        matrix.append([cells[j].strip() for j in columns])
+    return matrix
+
+
+class GPUTopology(object):
+    """Link affinity between gpus, from a `nvidia-smi topo -m` style matrix.
+
+    `domains` are the groups of gpus in the same host (any link but `NET`),
+    an allocation never spans domains. `islands` are the groups of gpus
+    connected by the fastest link type of their host (NVLink if any, else
+    the same PCIe switch), allocations are packed into as few islands as
+    possible.
+    """
+
+    def __init__(self, matrix: List[List[str]]):
+        self.matrix = matrix
+        self.num_gpus = len(matrix)
+        self.affinity = [[link_affinity(link) for link in row] for row in matrix]
+        self.domains = self._components(range(self.num_gpus), LINK_AFFINITY["SYS"])
+        self.islands = []
+        for domain in self.domains:
+            off_diagonal = [self.affinity[i][j] for i in domain for j in domain if i != j]
+            if any(a >= NVLINK_AFFINITY for a in off_diagonal):
+                threshold = NVLINK_AFFINITY
+            else:
+                threshold = LINK_AFFINITY["PXB"]
+            self.islands.extend(self._components(domain, threshold))
+        self.domain_of = {}
+        for domain_index, domain in enumerate(self.domains):
+            for gpu in domain:
+                self.domain_of[gpu] = domain_index
+        self.island_of = {}
+        for island_index, island in enumerate(self.islands):
+            for gpu in island:
+                self.island_of[gpu] = island_index
+
+    @classmethod
+    def from_text(cls, text: str):
+        return cls(parse_topo_matrix(text))
+
+    @classmethod
+    def from_nvidia_smi(cls):
+        """`None` if `nvidia-smi` is not available"""
+        try:
+            text = subprocess.check_output(
+                ["nvidia-smi", "topo", "-m"], stderr=subprocess.DEVNULL, timeout=10
+            ).decode()
+        except (OSError, subprocess.SubprocessError):
+            return None
+        topology = cls.from_text(text)
+        return topology if topology.num_gpus > 0 else None
+
+    def _components(self, gpus, threshold: int):
+        """groups of `gpus` connected by links with at least `threshold` affinity"""
+        gpus = list(gpus)
+        islands = []
+        visited = set()
+        for start in gpus:
+            if start in visited:
+                continue
+            island = []
+            stack = [start]
+            visited.add(start)
+            while stack:
+                gpu = stack.pop()
+                island.append(gpu)
+                for other in gpus:
+                    if other not in visited and self.affinity[gpu][other] >= threshold:
+                        visited.add(other)
+                        stack.append(other)
+            islands.append(sorted(island))
+        return islands
+
+    def score(self, gpus: List[int]):
+        """sum of the pairwise affinity, higher is better"""
+        return sum(self.affinity[i][j] for n, i in enumerate(gpus) for j in gpus[n + 1:])
+
+
+class Allocator(object):
+    """Picks the gpus of a `schedule` mode client.
+
+    `allocate` gets the free gpus in the scope of the client (in the order
+    of its scope) and all the free gpus of the node, both without the
+    gpus reserved by `ready` clients. Returns `req_gpu_num` gpus, or
+    `None` if the request cannot be satisfied now.
+    """
+
+    name = "base"
+
+    def allocate(self, candidates: List[int], req_gpu_num: int, free_gpus: List[int]):
+        raise NotImplementedError
+
+
+class FirstFitAllocator(Allocator):
+    """the first `req_gpu_num` free gpus in scope order"""
+
+    name = "first_fit"
+
+    def allocate(self, candidates: List[int], req_gpu_num: int, free_gpus: List[int]):
+        if req_gpu_num > len(candidates):
+            return None
+        return candidates[:req_gpu_num]
+
+
+class BestFitAllocator(Allocator):
+    """Packs jobs into the tightest topology island that can hold them.
+
+    Among the islands with enough free candidates, the one with the
+    fewest free gpus left is chosen, so small jobs fill up the fragmented
+    islands and large idle islands are kept for multi-gpu jobs. Inside an
+    island, the gpus with the best pairwise links are picked. If no single
+    island fits, the job spans the islands with the most candidates within
+    a single domain (host). Without a topology the whole node is one
+    island, which is first fit.
+    """
+
+    name = "best_fit"
+
+    def __init__(self, topology: Optional[GPUTopology] = None):
+        self.topology = topology
+
+    def _island(self, gpu: int):
+        if self.topology is None:
+            return 0
+        # gpus missing from the matrix get an island of their own
+        return self.topology.island_of.get(gpu, ("extra", gpu))
+
+    def _domain(self, gpu: int):
+        return self.topology.domain_of.get(gpu, ("extra", gpu))
+
+    def _pick(self, candidates: List[int], req_gpu_num: int):
+        topology = self.topology
+        if topology is None or req_gpu_num >= len(candidates) or req_gpu_num <= 1:
+            return candidates[:req_gpu_num]
+        # greedy from every seed, islands are small so this is cheap
+        best, best_score = None, -1
+        for seed in candidates:
+            picked = [seed]
+            rest = [gpu for gpu in candidates if gpu != seed]
+            while len(picked) < req_gpu_num:
+                gpu = max(rest, key=lambda g: sum(topology.affinity[g][p] for p in picked))
+                picked.append(gpu)
+                rest.remove(gpu)
+            score = topology.score(picked)
+            if score > best_score:
+                best, best_score = picked, score
+        return sorted(best, key=candidates.index)
+
+    def allocate(self, candidates: List[int], req_gpu_num: int, free_gpus: List[int]):
+        if req_gpu_num > len(candidates):
+            return None
+        if self.topology is None:
+            return candidates[:req_gpu_num]
+        island_candidates: Dict = {}
+        for gpu in candidates:
+            island_candidates.setdefault(self._island(gpu), []).append(gpu)
+        island_free: Dict = {}
+        for gpu in free_gpus:
+            island = self._island(gpu)
+            island_free[island] = island_free.get(island, 0) + 1
+
+        fitting = [
+            (island_free.get(island, len(gpus)), order, island)
+            for order, (island, gpus) in enumerate(island_candidates.items())
+            if len(gpus) >= req_gpu_num
+        ]
+        if fitting:
+            _, _, island = min(fitting)
+            return self._pick(island_candidates[island], req_gpu_num)
+
+        # span the islands of a single domain, the tightest one that fits
+        domain_candidates: Dict = {}
+        for gpu in candidates:
+            domain_candidates.setdefault(self._domain(gpu), []).append(gpu)
+        domain_free: Dict = {}
+        for gpu in free_gpus:
+            domain = self._domain(gpu)
+            domain_free[domain] = domain_free.get(domain, 0) + 1
+        fitting = [
+            (domain_free.get(domain, len(gpus)), order, domain)
+            for order, (domain, gpus) in enumerate(domain_candidates.items())
+            if len(gpus) >= req_gpu_num
+        ]
+        if not fitting:
+            return None
+        _, _, domain = min(fitting)
+        allocation = []
+        islands = [
+            gpus for island, gpus in island_candidates.items() if self._domain(gpus[0]) == domain
+        ]
+        for gpus in sorted(islands, key=len, reverse=True):
+            allocation.extend(gpus[:req_gpu_num - len(allocation)])
+            if len(allocation) >= req_gpu_num:
+                break
+        return sorted(allocation, key=candidates.index)
+
+
+ALLOCATORS = {
+    FirstFitAllocator.name: FirstFitAllocator,
+    BestFitAllocator.name: BestFitAllocator,
+}
+
+
+def get_allocator(name: str, topology: Optional[GPUTopology] = None):
+    if name not in ALLOCATORS:
+        raise ValueError(f"allocator: {name} is not supported, choose from {sorted(ALLOCATORS)}")
+    if name == FirstFitAllocator.name:
+        return FirstFitAllocator()
+    return ALLOCATORS[name](topology=topology)
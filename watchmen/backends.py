@@ -0,0 +1,622 @@
+import time
+import random
+import socket
+import logging
+import datetime
+import threading
+from typing import Callable, List, Optional
+
+from watchmen.allocator import GPUTopology
+
+
+logger = logging.getLogger("common")
+
+MB = 1024 * 1024
+
+
+class DeviceInventory(object):
+    """the devices of a backend, which only change on hotplug or driver reload"""
+
+    def __init__(self, uuids: List[str], names: List[str], memory_totals: List[int]):
+        self.uuids = tuple(uuids)
+        self.names = tuple(names)
+        self.memory_totals = tuple(memory_totals)
+        self.timestamp = time.monotonic()
+
+    @classmethod
+    def from_gpus(cls, gpus):
+        return cls(
+            [gpu.uuid for gpu in gpus],
+            [gpu.name for gpu in gpus],
+            [gpu.memory_total for gpu in gpus],
+        )
+
+    @property
+    def age(self):
+        return time.monotonic() - self.timestamp
+
+    def matches(self, gpus):
+        """whether the queried `gpus` are still the same devices"""
+        return len(gpus) == len(self.uuids) and all(
+            gpu.uuid == uuid for gpu, uuid in zip(gpus, self.uuids)
+        )
+
+    def __len__(self):
+        return len(self.uuids)
+
+
+class GPUBackend(object):
+    """Source of gpu status for `GPUInfo`.
+
+    `query` returns a collection shaped like `gpustat.GPUStatCollection`:
+    a `gpus` list whose items have `index`, `name`, `uuid`, `processes`,
+    `utilization`, `memory_used`, `memory_total` and `temperature`, and a
+    `jsonify()` method that returns the same json as gpustat.
+
+    `inventory` is cached for `inventory_ttl` seconds, so validating the gpus
+    of a burst of registrations does not query the devices every time. It is
+    refreshed early if a query sees other devices (`observe`).
+    """
+
+    name = "base"
+    inventory_ttl = 600
+    _inventory = None
+
+    def query(self):
+        raise NotImplementedError
+
+    def load_inventory(self):
+        return DeviceInventory.from_gpus(self.query().gpus)
+
+    def inventory(self):
+        inventory = self._inventory
+        if inventory is None or inventory.age >= self.inventory_ttl:
+            inventory = self._inventory = self.load_inventory()
+        return inventory
+
+    def observe(self, gpus):
+        """refresh the cached inventory if the queried `gpus` differ from it"""
+        inventory = self._inventory
+        if inventory is not None and not inventory.matches(gpus):
+            self._inventory = DeviceInventory.from_gpus(gpus)
+
+    def device_count(self):
+        return len(self.inventory())
+
+    def topology(self):
+        """`GPUTopology` of the devices, `None` if unknown"""
+        return GPUTopology.from_nvidia_smi()
+
+
+class GPUStatBackend(GPUBackend):
+    """full detail from `gpustat`, including the users and commands of the processes"""
+
+    name = "gpustat"
+
+    def query(self):
+        # imported here, so the other backends work without the nvidia driver
+        from gpustat.core import GPUStatCollection
+
+        return GPUStatCollection.new_query()
+
+
+class NVMLGPU(object):
+    def __init__(self, index: int, name: str, uuid: str):
+        self.index = index
+        self.name = name
+        self.uuid = uuid
+        self.memory_total = 0
+        self.memory_used = 0
+        self.utilization = 0
+        self.temperature = None
+        self.processes = []
+
+    def jsonify(self):
+        return {
+            "index": self.index,
+            "uuid": self.uuid,
+            "name": self.name,
+            "temperature.gpu": self.temperature,
+            "utilization.gpu": self.utilization,
+            "memory.used": self.memory_used,
+            "memory.total": self.memory_total,
+            "processes": [dict(p) for p in self.processes],
+        }
+
+
+class NVMLCollection(object):
+    """lean query result, shown from the queried values without querying the devices again,
+    `process_info` resolves a pid to its `username` and `command` for display"""
+
+    def __init__(
+        self,
+        gpus: List[NVMLGPU],
+        hostname: str,
+        driver_version: Optional[str] = None,
+        process_info: Optional[Callable] = None,
+    ):
+        self.gpus = gpus
+        self.hostname = hostname
+        self.driver_version = driver_version
+        self.process_info = process_info
+        self.query_time = datetime.datetime.now()
+
+    def jsonify(self):
+        gpus = [g.jsonify() for g in self.gpus]
+        if self.process_info is not None:
+            for gpu in gpus:
+                for p in gpu["processes"]:
+                    p.update(self.process_info(p["pid"]))
+        return {
+            "hostname": self.hostname,
+            "driver_version": self.driver_version,
+            "query_time": self.query_time,
+            "gpus": gpus,
+        }
+
+
+class NVMLBackend(GPUBackend):
+    """Talks to NVML directly with a handle kept open for the process lifetime.
+
+    Each query fetches utilization, memory, temperature and the pids of
+    the running processes. Unlike gpustat, the processes are not resolved
+    to users and commands through psutil on every query, which is the
+    dominant cost on busy nodes: showing a snapshot (`jsonify`) only looks
+    up the pids it has not seen before.
+    """
+
+    name = "nvml"
+    max_processes = 4096  # cached pid -> user and command, cleared when exceeded
+
+    def __init__(self):
+        import pynvml
+
+        self.nvml = pynvml
+        self.nvml.nvmlInit()
+        self._lock = threading.Lock()
+        self.hostname = socket.gethostname()
+        try:
+            self.driver_version = self._str(self.nvml.nvmlSystemGetDriverVersion())
+        except self.nvml.NVMLError:
+            self.driver_version = None
+        self._processes_lock = threading.Lock()  # guards `_process_infos`
+        self._process_infos = {}
+        with self._lock:
+            self._enumerate()
+
+    def _enumerate(self):
+        """(Re)read the device handles, called with `_lock` held.
+
+        Handles go stale when a gpu falls off the bus or the driver is
+        reloaded, so this runs again on every inventory refresh and after
+        an NVML error in `query`.
+        """
+        handles = []
+        devices = []
+        for index in range(self.nvml.nvmlDeviceGetCount()):
+            handle = self.nvml.nvmlDeviceGetHandleByIndex(index)
+            handles.append(handle)
+            name = self._str(self.nvml.nvmlDeviceGetName(handle))
+            uuid = self._str(self.nvml.nvmlDeviceGetUUID(handle))
+            devices.append((index, name, uuid))
+        self.handles = handles
+        self.devices = devices
+
+    @staticmethod
+    def _str(value):
+        return value.decode() if isinstance(value, bytes) else value
+
+    def process_info(self, pid: int):
+        """`username` and `command` of a process like gpustat shows them, cached by pid"""
+        with self._processes_lock:
+            info = self._process_infos.get(pid)
+        if info is None:
+            import psutil
+
+            try:
+                process = psutil.Process(pid)
+                info = {"username": process.username(), "command": process.name()}
+            except psutil.Error:
+                # gone, or not visible from this pid namespace
+                info = {"username": "?", "command": "?"}
+            with self._processes_lock:
+                if len(self._process_infos) >= self.max_processes:
+                    self._process_infos.clear()
+                self._process_infos[pid] = info
+        return info
+
+    def _processes(self, handle):
+        processes = {}
+        for getter in (
+            self.nvml.nvmlDeviceGetComputeRunningProcesses,
+            self.nvml.nvmlDeviceGetGraphicsRunningProcesses,
+        ):
+            try:
+                for p in getter(handle):
+                    memory = p.usedGpuMemory
+                    processes[p.pid] = {
+                        "pid": p.pid,
+                        "gpu_memory_usage": None if memory is None else memory // MB,
+                    }
+            except self.nvml.NVMLError:
+                pass
+        return list(processes.values())
+
+    def query(self):
+        with self._lock:
+            try:
+                gpus = self._query()
+            except self.nvml.NVMLError:
+                logger.warning("nvml query failed, enumerating the devices again", exc_info=True)
+                self._enumerate()
+                gpus = self._query()
+        return NVMLCollection(gpus, self.hostname, self.driver_version, self.process_info)
+
+    def _query(self):
+        gpus = []
+        for handle, (index, name, uuid) in zip(self.handles, self.devices):
+            gpu = NVMLGPU(index, name, uuid)
+            memory = self.nvml.nvmlDeviceGetMemoryInfo(handle)
+            gpu.memory_total = memory.total // MB
+            gpu.memory_used = memory.used // MB
+            try:
+                gpu.utilization = self.nvml.nvmlDeviceGetUtilizationRates(handle).gpu
+            except self.nvml.NVMLError:
+                # not supported by some devices, decided by memory and processes only
+                gpu.utilization = 0
+            try:
+                gpu.temperature = self.nvml.nvmlDeviceGetTemperature(
+                    handle, self.nvml.NVML_TEMPERATURE_GPU
+                )
+            except self.nvml.NVMLError:
+                gpu.temperature = None
+            gpu.processes = self._processes(handle)
+            gpus.append(gpu)
+        return gpus
+
+    def load_inventory(self):
+        with self._lock:
+            self._enumerate()
+            memory_totals = [
+                self.nvml.nvmlDeviceGetMemoryInfo(handle).total // MB for handle in self.handles
+            ]
+        return DeviceInventory(
+            [uuid for _, _, uuid in self.devices],
+            [name for _, name, _ in self.devices],
+            memory_totals,
+        )
+
+    def close(self):
+        self.nvml.nvmlShutdown()
+
+
+class SimulatedGPU(object):
+    def __init__(self, index: int, memory_total: int, name: Optional[str] = "Simulated GPU"):
+        self.index = index
+        self.name = name
+        self.uuid = f"GPU-simulated-{index:04d}"
+        self.memory_total = memory_total
+        self.memory_used = 0
+        self.utilization = 0
+        self.temperature = 30
+        self.processes = []
+
+    def jsonify(self):
+        return {
+            "index": self.index,
+            "uuid": self.uuid,
+            "name": self.name,
+            "temperature.gpu": self.temperature,
+            "utilization.gpu": self.utilization,
+            "memory.used": self.memory_used,
+            "memory.total": self.memory_total,
+            "processes": [dict(p) for p in self.processes],
+        }
+
+
+class SimulatedCollection(object):
+    def __init__(self, gpus: List[SimulatedGPU], hostname: str):
+        self.gpus = gpus
+        self.hostname = hostname
+        self.driver_version = "simulated"
+        self.query_time = datetime.datetime.now()
+
+    def jsonify(self):
+        return {
+            "hostname": self.hostname,
+            "driver_version": self.driver_version,
+            "query_time": self.query_time,
+            "gpus": [g.jsonify() for g in self.gpus],
+        }
+
+
+class SimulatedBackend(GPUBackend):
+    """A scriptable fake cluster for tests and load tests on machines without gpus.
+
+    - `occupy` / `release` start and stop fake processes on a gpu, e.g. when a
+        benchmark pretends a granted client started its job.
+    - `trace(t, gpu_index)` may return `(utilization, memory_used)` for a gpu
+        without processes at `t` seconds after creation, to replay recorded traces.
+    - `churn` is the probability per query that a free gpu gets a foreign process
+        for a random duration from `job_duration`, emulating users outside watchmen.
+    - `topology` is the `nvidia-smi topo -m` output of the fake node.
+
+    Every query returns fresh objects, so earlier snapshots stay immutable.
+    """
+
+    name = "simulated"
+
+    def __init__(
+        self,
+        num_gpus: Optional[int] = 8,
+        memory_total: Optional[int] = 81920,
+        trace: Optional[Callable] = None,
+        churn: Optional[float] = 0.0,
+        job_duration: Optional[tuple] = (30, 300),
+        seed: Optional[int] = None,
+        clock: Optional[Callable] = time.monotonic,
+        hostname: Optional[str] = None,
+        topology: Optional[str] = None,
+    ):
+        self.num_gpus = num_gpus
+        self.memory_total = memory_total
+        self.trace = trace
+        self.churn = churn
+        self.job_duration = job_duration
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.start_time = clock()
+        self.hostname = hostname or f"{socket.gethostname()}-simulated"
+        self.num_queries = 0
+        # `nvidia-smi topo -m` style text, e.g. recorded on a real node
+        self._topology = None if topology is None else GPUTopology.from_text(topology)
+        self._lock = threading.Lock()
+        self._pid = 100000
+        # gpu index -> list of (process, end_time), `end_time` is None for jobs without a deadline
+        self._jobs = {index: [] for index in range(num_gpus)}
+
+    def occupy(
+        self,
+        gpu_index: int,
+        username: Optional[str] = "simulated",
+        memory: Optional[int] = 1024,
+        utilization: Optional[int] = 90,
+        duration: Optional[float] = None,
+    ):
+        """start a fake process on a gpu, returns its pid"""
+        if gpu_index not in self._jobs:
+            raise ValueError(f"gpu_index: {gpu_index} does not exist")
+        with self._lock:
+            self._pid += 1
+            process = {
+                "username": username,
+                "pid": self._pid,
+                "command": "python",
+                "gpu_memory_usage": memory,
+                "utilization": utilization,
+            }
+            end_time = None if duration is None else self.clock() + duration
+            self._jobs[gpu_index].append((process, end_time))
+            return self._pid
+
+    def release(self, gpu_index: int, pid: Optional[int] = None):
+        """stop the process `pid` or all the processes on a gpu"""
+        with self._lock:
+            self._jobs[gpu_index] = [
+                (p, end) for p, end in self._jobs[gpu_index] if pid is not None and p["pid"] != pid
+            ]
+
+    def _step(self, now: float):
+        for index, jobs in self._jobs.items():
+            jobs[:] = [(p, end) for p, end in jobs if end is None or end > now]
+            if not jobs and self.churn > 0 and self.random.random() < self.churn:
+                self._pid += 1
+                process = {
+                    "username": "someone",
+                    "pid": self._pid,
+                    "command": "python",
+                    "gpu_memory_usage": self.random.randint(1024, self.memory_total // 2),
+                    "utilization": self.random.randint(20, 100),
+                }
+                jobs.append((process, now + self.random.uniform(*self.job_duration)))
+
+    def query(self):
+        with self._lock:
+            now = self.clock()
+            self._step(now)
+            self.num_queries += 1
+            gpus = []
+            for index in range(self.num_gpus):
+                gpu = SimulatedGPU(index, self.memory_total)
+                jobs = self._jobs[index]
+                if jobs:
+                    gpu.processes = [
+                        {k: v for k, v in p.items() if k != "utilization"} for p, _ in jobs
+                    ]
+                    gpu.memory_used = min(
+                        self.memory_total, sum(p["gpu_memory_usage"] for p, _ in jobs)
+                    )
+                    gpu.utilization = min(100, sum(p["utilization"] for p, _ in jobs))
+                elif self.trace is not None:
+                    gpu.utilization, gpu.memory_used = self.trace(now - self.start_time, index)
+                gpu.temperature = 30 + gpu.utilization // 2
+                gpus.append(gpu)
+        return SimulatedCollection(gpus, self.hostname)
+
+    def topology(self):
+        return self._topology
+
+
+class RemoteGPU(object):
+    """a gpu reported by the agent of a node, `index` is the cluster-wide index"""
+
+    def __init__(self, index: int, node: str, local_index: int, info: dict):
+        self.index = index
+        self.node = node
+        self.local_index = local_index
+        self.name = info.get("name")
+        self.uuid = info.get("uuid")
+        self.temperature = info.get("temperature.gpu")
+        self.utilization = info.get("utilization.gpu") or 0
+        self.memory_used = info.get("memory.used") or 0
+        self.memory_total = info.get("memory.total") or 1
+        self.processes = info.get("processes") or []
+
+    def jsonify(self):
+        return {
+            "index": self.index,
+            "node": self.node,
+            "local_index": self.local_index,
+            "uuid": self.uuid,
+            "name": self.name,
+            "temperature.gpu": self.temperature,
+            "utilization.gpu": self.utilization,
+            "memory.used": self.memory_used,
+            "memory.total": self.memory_total,
+            "processes": [dict(p) for p in self.processes],
+        }
+
+
+class ClusterCollection(object):
+    def __init__(self, gpus: List[RemoteGPU], nodes: List[dict]):
+        self.gpus = gpus
+        self.nodes = nodes
+        self.hostname = "cluster"
+        self.driver_version = None
+        self.query_time = datetime.datetime.now()
+
+    def jsonify(self):
+        return {
+            "hostname": self.hostname,
+            "driver_version": self.driver_version,
+            "query_time": self.query_time,
+            "nodes": self.nodes,
+            "gpus": [g.jsonify() for g in self.gpus],
+        }
+
+
+class ClusterBackend(GPUBackend):
+    """The gpus of several nodes, pushed by `python -m watchmen.agent`.
+
+    Each node gets a contiguous range of cluster-wide gpu indices in the
+    order the nodes first report, so the indices of a node never change
+    while the server runs. The scheduler works on the cluster-wide indices
+    only, `scope` and `localize` translate from and to the local indices
+    of a node. The gpus of a node whose last report is older than
+    `node_timeout` seconds are shown as busy, so nothing is granted on a
+    node that is down.
+    """
+
+    name = "cluster"
+    OFFLINE_PROCESS = {"pid": None, "username": "watchmen", "command": "node offline"}
+
+    def __init__(self, node_timeout: Optional[float] = 30, clock: Optional[Callable] = time.monotonic):
+        self.node_timeout = node_timeout
+        self.clock = clock
+        self._lock = threading.Lock()
+        # node name -> {"offset", "num_gpus", "gpus", "topology", "report_time"}
+        self.nodes = {}
+        self.num_gpus = 0
+
+    def report(self, node: str, gpus: List[dict], topology: Optional[List[List[str]]] = None):
+        """store the latest status of a node, returns `True` if the node is new
+        or its topology changed, i.e. `topology()` has to be built again"""
+        with self._lock:
+            info = self.nodes.get(node)
+            changed = info is None
+            if changed:
+                info = {"offset": self.num_gpus, "num_gpus": len(gpus), "topology": None}
+                self.nodes[node] = info
+                self.num_gpus += len(gpus)
+            elif len(gpus) != info["num_gpus"]:
+                raise ValueError(
+                    f"node {node} reported {len(gpus)} gpus instead of {info['num_gpus']}, "
+                    "restart the server to change the gpus of a node"
+                )
+            info["gpus"] = gpus
+            info["report_time"] = self.clock()
+            if topology and topology != info["topology"]:
+                info["topology"] = topology
+                changed = True
+            return changed
+
+    def query(self):
+        gpus = []
+        nodes = []
+        with self._lock:
+            now = self.clock()
+            for node, info in self.nodes.items():
+                online = now - info["report_time"] <= self.node_timeout
+                nodes.append(
+                    {
+                        "node": node,
+                        "offset": info["offset"],
+                        "num_gpus": info["num_gpus"],
+                        "online": online,
+                        "last_report": now - info["report_time"],
+                    }
+                )
+                for local_index, gpu_info in enumerate(info["gpus"]):
+                    gpu = RemoteGPU(info["offset"] + local_index, node, local_index, gpu_info)
+                    if not online:
+                        gpu.processes = [dict(self.OFFLINE_PROCESS)]
+                    gpus.append(gpu)
+        return ClusterCollection(gpus, nodes)
+
+    def device_count(self):
+        return self.num_gpus
+
+    def topology(self):
+        """the reported topology within each node, `NET` between the nodes"""
+        if self.num_gpus <= 0:
+            return None
+        matrix = [["NET"] * self.num_gpus for _ in range(self.num_gpus)]
+        with self._lock:
+            for info in self.nodes.values():
+                offset, num_gpus, local = info["offset"], info["num_gpus"], info["topology"]
+                if local is None or len(local) != num_gpus:
+                    local = [["X" if i == j else "SYS" for j in range(num_gpus)] for i in range(num_gpus)]
+                for i in range(num_gpus):
+                    matrix[offset + i][offset:offset + num_gpus] = local[i]
+        return GPUTopology(matrix)
+
+    def scope(self, gpus: List[int], nodes: Optional[List[str]] = None):
+        """cluster-wide indices of the local `gpus` on each of `nodes` (any node if empty)"""
+        with self._lock:
+            if not nodes:
+                nodes = list(self.nodes)
+            scope = []
+            for node in nodes:
+                info = self.nodes.get(node)
+                if info is None:
+                    raise ValueError(f"node {node} has not reported yet")
+                for gpu in gpus:
+                    if not 0 <= gpu < info["num_gpus"]:
+                        raise ValueError(f"gpu {gpu} does not exist on node {node}")
+                    scope.append(info["offset"] + gpu)
+            return scope
+
+    def localize(self, gpus: List[int]):
+        """`(node, local indices)` of cluster-wide `gpus` on a single node"""
+        if not gpus:
+            return None, []
+        with self._lock:
+            for node, info in self.nodes.items():
+                if info["offset"] <= gpus[0] < info["offset"] + info["num_gpus"]:
+                    return node, [gpu - info["offset"] for gpu in gpus]
+        raise ValueError(f"gpu {gpus[0]} does not belong to any node")
+
+
+BACKENDS = {
+    GPUStatBackend.name: GPUStatBackend,
+    NVMLBackend.name: NVMLBackend,
+    SimulatedBackend.name: SimulatedBackend,
+    ClusterBackend.name: ClusterBackend,
+}
+
+
+def get_backend(name: str, **kwargs):
+    """build a backend by name, `kwargs` are passed to its constructor"""
+    if name not in BACKENDS:
+        raise ValueError(f"gpu backend: {name} is not supported, choose from {sorted(BACKENDS)}")
+    return BACKENDS[name](**kwargs)
@@ -3,14 +3,19 @@ import logging
 import datetime
 import getpass
 import os
+import heapq
+import itertools
+import threading
 from enum import Enum
 from typing import List, Optional
 from collections import OrderedDict
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pydantic import BaseModel
 
-from watchmen.listener import check_gpus_existence, check_req_gpu_num
+from watchmen.listener import check_gpus_existence, check_req_gpu_num, gpus_to_mask
 
 
 logger = logging.getLogger("common")
@@ -29,6 +34,10 @@ if not logger.handlers:
 TOKEN_FILE = ".watchmen_client.token"
 
 
+class LongPollUnsupported(Exception):
+    """the server has no `/client/wait`, e.g. an older version, fall back to pings"""
+
+
 class ClientStatus(str, Enum):
     WAITING = "waiting"
     TIMEOUT = "timeout"
@@ -46,6 +55,12 @@ class ClientMode(str, Enum):
         return value in set(cls._member_map_.values())
 
 
+class ClientPriority(str, Enum):
+    HIGH = "high"
+    NORMAL = "normal"
+    LOW = "low"
+
+
 class ClientModel(BaseModel):
     id: str  # identifier in string format
     # `queue` (wait for specific gpus) or `schedule` (schedule by the server automatically)
@@ -53,35 +68,296 @@ class ClientModel(BaseModel):
     register_time: Optional[datetime.datetime] = None  # datetime.datetime
     last_request_time: Optional[datetime.datetime] = None  # datetime.datetime
     status: Optional[ClientStatus] = ClientStatus.WAITING  # `waiting`, `timeout`, `ok`
-    queue_num: Optional[int] = 0  # queue number
+    queue_num: Optional[int] = 0  # queue number, refreshed in place by the scheduling passes
     # `queue` mode: gpus for requesting to run on; `schedule` mode: available gpu scope.
     gpus: Optional[List[int]] = []
     msg: Optional[str] = ""  # error or status message
     req_gpu_num: Optional[int] = 0  # `schedule` mode: how many gpus are requested
     available_gpus: Optional[List[int]] = []
+    # seconds the job is expected to run after `ready`, declared by the client for backfilling
+    walltime: Optional[int] = None
+    ready_time: Optional[datetime.datetime] = None  # when the gpus were granted
+    # clients of a higher priority class are always scheduled first
+    priority: Optional[ClientPriority] = ClientPriority.NORMAL
+    # cluster mode: nodes the local `gpus` refer to, empty for any node
+    nodes: Optional[List[str]] = None
+    node: Optional[str] = None  # cluster mode: node of `available_gpus`
 
 
 class ClientCollection(object):
-    def __init__(self):
+    """Work and finished queues shared by the api handlers and the scheduler.
+
+    Every structural change (add, finish, remove) happens under `lock`.
+    Readers get a snapshot list copied under the lock, so iterating it
+    never races with the scheduler and never holds the lock for long.
+    Single-key lookups (`get`, `in`) are atomic and need no lock.
+
+    If a `store` (see `watchmen.store.ClientStore`) is attached, every change
+    is also recorded there. In-place changes of a client (e.g. its status)
+    must be reported with `update`.
+
+    Finished clients are indexed by a heap on `last_request_time`, so that
+    expired ones are evicted in O(expired) instead of scanning the whole
+    finished queue. At most `max_finished` of them are kept in memory, the
+    oldest ones beyond that are dropped from memory but stay in the store.
+
+    Every change bumps `version` and is remembered per `(queue, client_id)`,
+    so readers can ask for the clients changed since a version they already
+    have (`changes_since`) instead of the whole queues. Waiting on the
+    `changed` condition wakes up on every change. Versions restart with
+    every collection (e.g. a server restart), so readers that resume later
+    get them as `version_token`s, which carry the `epoch` of the collection.
+
+    `gpu_masks` holds the bitmask of `gpus` of every working client
+    (see `watchmen.listener.gpus_to_mask`), computed once when it is added.
+    """
+
+    max_changes = 100000  # number of remembered changes for `changes_since`
+
+    def __init__(self, store=None, max_finished: Optional[int] = None):
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
         self.work_queue = OrderedDict()  # only `ok` and `waiting`
         self.finished_queue = OrderedDict()
+        self.store = store
+        self.max_finished = max_finished
+        # heap of (last_request_time, seq, client_id), an entry is outdated
+        # if `seq` is not the one in `_finished_seqs` any more
+        self._finished_index = []
+        self._finished_seqs = {}
+        # both queues are kept in ascending `seq` order, used as pagination cursor
+        self._work_seqs = {}
+        self.gpu_masks = {}  # client_id -> bitmask of its `gpus`, only for the work queue
+        self._seq = itertools.count(1)
+        self.version = 0
+        self._changes = OrderedDict()  # (queue, client_id) -> version, oldest first
+        self._min_version = 0  # changes up to this version are forgotten
+        self.epoch = int(time.time() * 1000)  # creation time, tells the versions of two runs apart
+
+    def _touch(self, queue: str, client_id: str):
+        self.version += 1
+        key = (queue, client_id)
+        self._changes.pop(key, None)
+        self._changes[key] = self.version
+        if len(self._changes) > self.max_changes:
+            _, self._min_version = self._changes.popitem(last=False)
+        self.changed.notify_all()
+
+    def notify_changed(self):
+        """wake up the `changed` waiters for a change outside of the collection"""
+        with self.changed:
+            self.changed.notify_all()
+
+    def _put_work(self, client: ClientModel):
+        client.queue_num = len(self.work_queue)
+        self.work_queue[client.id] = client
+        self._work_seqs[client.id] = next(self._seq)
+        self.gpu_masks[client.id] = gpus_to_mask(client.gpus)
+        self._touch("work", client.id)
+
+    def _put_finished(self, client: ClientModel):
+        seq = next(self._seq)
+        # a client finished again with the same id goes to the end of the queue
+        self.finished_queue.pop(client.id, None)
+        self.finished_queue[client.id] = client
+        self._finished_seqs[client.id] = seq
+        self._touch("finished", client.id)
+        last_request_time = client.last_request_time or datetime.datetime.min
+        heapq.heappush(self._finished_index, (last_request_time, seq, client.id))
+
+    def _pop_oldest_finished(self):
+        while self._finished_index:
+            last_request_time, seq, client_id = heapq.heappop(self._finished_index)
+            if self._finished_seqs.get(client_id) == seq:
+                del self._finished_seqs[client_id]
+                self._touch("finished", client_id)
+                return self.finished_queue.pop(client_id)
+        return None
+
+    def _trim_finished(self):
+        """drop the oldest finished clients from memory, they are kept in the store"""
+        if self.max_finished is None or self.max_finished < 0:
+            return
+        while len(self.finished_queue) > self.max_finished:
+            self._pop_oldest_finished()
+
+    def load(self, work_clients: List[ClientModel], finished_clients: List[ClientModel]):
+        """bulk load clients (e.g. restored from the store) without recording them"""
+        with self.lock:
+            for client in finished_clients:
+                self._put_finished(client)
+            self._trim_finished()
+            for client in work_clients:
+                self._put_work(client)
+
+    def add(self, client: ClientModel):
+        """add a client to the work queue, returns False if the id is already working"""
+        with self.lock:
+            if client.id in self.work_queue:
+                return False
+            self._put_work(client)
+            if self.store is not None:
+                self.store.save(client, finished=False)
+            return True
+
+    def add_many(self, clients: List[ClientModel]):
+        """add clients in order under a single lock, returns whether each one was added"""
+        added = []
+        with self.lock:
+            for client in clients:
+                if client.id in self.work_queue:
+                    added.append(False)
+                    continue
+                self._put_work(client)
+                if self.store is not None:
+                    self.store.save(client, finished=False)
+                added.append(True)
+        return added
+
+    def update(self, client: ClientModel):
+        """report an in-place change"""
+        with self.lock:
+            finished = client.id not in self.work_queue
+            self._touch("finished" if finished else "work", client.id)
+            if self.store is not None:
+                self.store.save(client, finished=finished)
 
     def mark_finished(self, client_id: str):
-        self.finished_queue[client_id] = self.work_queue[client_id]
-        self.work_queue.pop(client_id)
+        with self.lock:
+            client = self.work_queue.pop(client_id, None)
+            if client is not None:
+                del self._work_seqs[client_id]
+                self.gpu_masks.pop(client_id, None)
+                self._touch("work", client_id)
+                self._put_finished(client)
+                if self.store is not None:
+                    self.store.delete(client_id, finished=False)
+                    self.store.save(client, finished=True)
+                self._trim_finished()
+            return client
+
+    def remove_finished(self, client_id: str):
+        with self.lock:
+            client = self.finished_queue.pop(client_id, None)
+            if client is not None:
+                # the heap entry becomes outdated and is skipped when popped
+                self._finished_seqs.pop(client_id, None)
+                self._touch("finished", client_id)
+                if self.store is not None:
+                    self.store.delete(client_id, finished=True)
+            return client
+
+    def expire_finished(self, before: datetime.datetime):
+        """remove finished clients whose `last_request_time` is not after `before`"""
+        expired_ids = []
+        with self.lock:
+            while self._finished_index:
+                last_request_time, seq, client_id = self._finished_index[0]
+                if self._finished_seqs.get(client_id) != seq:
+                    heapq.heappop(self._finished_index)  # outdated entry
+                    continue
+                if last_request_time > before:
+                    break
+                heapq.heappop(self._finished_index)
+                del self._finished_seqs[client_id]
+                self.finished_queue.pop(client_id)
+                self._touch("finished", client_id)
+                expired_ids.append(client_id)
+                if self.store is not None:
+                    self.store.delete(client_id, finished=True)
+        return expired_ids
+
+    def get(self, client_id: str):
+        """returns `(client, finished)`, client is `None` if not found in both queues"""
+        client = self.work_queue.get(client_id)
+        if client is not None:
+            return client, False
+        return self.finished_queue.get(client_id), True
+
+    def work_clients(self):
+        with self.lock:
+            return list(self.work_queue.values())
+
+    def finished_clients(self):
+        with self.lock:
+            return list(self.finished_queue.values())
+
+    def page(self, queue: str, after: Optional[int] = None, limit: Optional[int] = None, predicate=None):
+        """clients of the `work` or `finished` queue whose cursor is greater than `after`
+
+        returns `(clients, next_cursor)`, `next_cursor` is `None` on the last page
+        """
+        with self.lock:
+            if queue == "work":
+                items = [(self._work_seqs[k], v) for k, v in self.work_queue.items()]
+            else:
+                items = [(self._finished_seqs[k], v) for k, v in self.finished_queue.items()]
+        clients = []
+        last_seq = after
+        for seq, client in items:
+            if after is not None and seq <= after:
+                continue
+            if predicate is not None and not predicate(client):
+                continue
+            if limit is not None and len(clients) >= limit:
+                return clients, last_seq
+            clients.append(client)
+            last_seq = seq
+        return clients, None
+
+    def changes_since(self, version: int):
+        """returns `(changed, removed)` for each queue since `version`, or `None` if
+        that version is too old to be answered incrementally, or newer than
+        `self.version` (e.g. from before a restart of the server)
+
+        `changed` maps `work`/`finished` to the changed clients,
+        `removed` maps them to the ids that left the queue.
+        """
+        changed = {"work": [], "finished": []}
+        removed = {"work": [], "finished": []}
+        with self.lock:
+            if version < self._min_version or version > self.version:
+                return None
+            for (queue, client_id), change_version in reversed(self._changes.items()):
+                if change_version <= version:
+                    break
+                client = (self.work_queue if queue == "work" else self.finished_queue).get(client_id)
+                if client is None:
+                    removed[queue].append(client_id)
+                else:
+                    changed[queue].append(client)
+        for clients in list(changed.values()) + list(removed.values()):
+            clients.reverse()
+        return changed, removed
+
+    def version_token(self, version: Optional[int] = None):
+        """`<epoch>.<version>` of `version` (the current one by default)"""
+        return f"{self.epoch}.{self.version if version is None else version}"
+
+    def parse_version_token(self, token: Optional[str]):
+        """the version of a `version_token` of this collection, `None` if it is from
+        another epoch (e.g. before a restart) or cannot be parsed"""
+        epoch, _, version = (token or "").partition(".")
+        try:
+            if int(epoch) == self.epoch:
+                return int(version)
+        except ValueError:
+            pass
+        return None
 
     def get_all_clients(self):
-        all_clients = []
-        all_clients.extend(list(self.finished_queue.values()))
+        with self.lock:
+            all_clients = list(self.finished_queue.values())
+            work_clients = list(self.work_queue.values())
         all_clients.sort(key=lambda x: x.last_request_time)
-        all_clients.extend(list(self.work_queue.values()))
+        all_clients.extend(work_clients)
         return all_clients
 
     def __getitem__(self, index: str):
-        if index in self.work_queue:
-            return self.work_queue[index]
-        else:
+        client = self.work_queue.get(index)
+        if client is None:
             raise IndexError(f"index: {index} does not exist or has finished")
+        return client
 
     def __contains__(self, index: str):
         return index in self.work_queue
@@ -101,6 +377,43 @@ def save_token_to_file(token):
         f.write(token)
 
 
+def resolve_token(token: Optional[str] = None):
+    """the given token, else the one saved by an earlier client"""
+    if not token:
+        logger.info(f"No token provided, trying to load from file {TOKEN_FILE}")
+        token = load_token_from_file()
+    if token:
+        logger.info(f"Dump token to file {TOKEN_FILE}")
+        save_token_to_file(token)
+    else:
+        logger.info("No token provided, and no token file found")
+    return token
+
+
+def auth_headers(token: Optional[str] = None):
+    """json request headers, with the authentication token if available"""
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers["X-Auth-Token"] = token
+    return headers
+
+
+def build_session(headers: dict, max_retries: int, backoff_factor: float):
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=0,
+        status=0,
+        backoff_factor=backoff_factor,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(headers)
+    return session
+
+
 class WatchClient(object):
     def __init__(
         self,
@@ -112,32 +425,56 @@ class WatchClient(object):
         req_gpu_num: Optional[int] = 0,
         timeout: Optional[int] = 60,
         token: Optional[str] = None,
+        long_poll: Optional[bool] = True,
+        ping_interval: Optional[int] = 10,
+        long_poll_timeout: Optional[int] = 30,
+        max_retries: Optional[int] = 5,
+        backoff_factor: Optional[float] = 0.5,
+        walltime: Optional[int] = None,
+        priority: Optional[ClientPriority] = ClientPriority.NORMAL,
+        nodes: Optional[List[str]] = None,
     ):
         self.base_url = f"http://{server_host}:{server_port}"
         self.id = f"{getpass.getuser()}@{id}"
-        if self._validate_gpus(gpus):
+        # cluster mode: `gpus` are local indices on one of `nodes` (`[]` for any node),
+        # they are checked by the server since they need not exist on this host
+        self.nodes = nodes
+        self.node = None
+        if nodes is not None or self._validate_gpus(gpus):
             self.gpus = gpus
         else:
             raise ValueError("Check the GPU existence")
         if not self._validate_mode(mode):
             raise ValueError(f"Check the mode: {mode}")
         self.mode = mode
-        if self.mode == ClientMode.SCHEDULE:
+        if self.mode == ClientMode.SCHEDULE and nodes is None:
             if not self._validate_req_gpu_num(req_gpu_num):
                 raise ValueError(f"Check the `req_gpu_num`: {req_gpu_num}")
         self.req_gpu_num = req_gpu_num
+        # expected run time in seconds, lets the job backfill gpus reserved for a larger one
+        self.walltime = walltime
+        self.priority = priority
         self.timeout = timeout
+        # `long_poll`: wait on `/client/wait` instead of pinging every `ping_interval` seconds
+        self.long_poll = long_poll
+        self.ping_interval = ping_interval
+        self.long_poll_timeout = long_poll_timeout
+        self.last_status = ClientStatus.WAITING
 
-        # Handle token authentication
-        self.token = token
-        if not self.token:
-            logger.info(f"No token provided, trying to load from file {TOKEN_FILE}")
-            self.token = load_token_from_file()
-        if self.token:
-            logger.info(f"Dump token to file {TOKEN_FILE}")
-            save_token_to_file(self.token)
-        else:
-            logger.info("No token provided, and no token file found")
+        self.token = resolve_token(token)
+
+        # one keep-alive session for all the requests to the server,
+        # connection errors are retried with exponential backoff
+        self.session = build_session(self._get_headers(), max_retries, backoff_factor)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def _validate_gpus(self, gpus: List[int]):
         return check_gpus_existence(gpus)
@@ -150,10 +487,7 @@ class WatchClient(object):
 
     def _get_headers(self):
         """Get request headers with authentication token if available."""
-        headers = {"Content-Type": "application/json"}
-        if self.token:
-            headers["X-Auth-Token"] = self.token
-        return headers
+        return auth_headers(self.token)
 
     def register(self):
         data = {
@@ -161,11 +495,13 @@ class WatchClient(object):
             "gpus": self.gpus,
             "mode": self.mode,
             "req_gpu_num": self.req_gpu_num,
+            "walltime": self.walltime,
+            "priority": self.priority,
+            "nodes": self.nodes,
         }
-        result = requests.post(
+        result = self.session.post(
             self.base_url + "/client/register",
             json=data,
-            headers=self._get_headers(),
             timeout=self.timeout,
         )
         result = result.json()
@@ -174,15 +510,36 @@ class WatchClient(object):
 
     def ping(self):
         data = {"id": self.id}
-        result = requests.post(
+        result = self.session.post(
             self.base_url + "/client/ping",
             json=data,
-            headers=self._get_headers(),
             timeout=self.timeout,
         ).json()
+        return self._parse_status(result)
+
+    def wait_for_change(self):
+        """long-poll ping, returns once the status changes or the server-side hold expires,
+        raises `LongPollUnsupported` if the server does not have `/client/wait`"""
+        data = {
+            "id": self.id,
+            "status": self.last_status,
+            "timeout": self.long_poll_timeout,
+        }
+        result = self.session.post(
+            self.base_url + "/client/wait",
+            json=data,
+            timeout=self.timeout + self.long_poll_timeout,
+        )
+        if result.status_code == 404:
+            raise LongPollUnsupported("server does not support `/client/wait`")
+        return self._parse_status(result.json())
+
+    def _parse_status(self, result: dict):
         if result["status"] != "ok":
             raise RuntimeError(f"err registering: {result['msg']}")
         else:
+            self.last_status = result["msg"]
+            self.node = result.get("node")
             if result["msg"] == ClientStatus.WAITING:
                 return False, result["available_gpus"]
             elif result["msg"] == ClientStatus.READY:
@@ -200,6 +557,121 @@ class WatchClient(object):
         flag = False
         available_gpus = []
         while not flag:
+            if self.long_poll:
+                try:
+                    start = time.monotonic()
+                    flag, available_gpus = self.wait_for_change()
+                    if not flag and time.monotonic() - start < 1:
+                        # not held by the server (busy or status unchanged), do not hammer it
+                        time.sleep(self.ping_interval)
+                    continue
+                except LongPollUnsupported:
+                    logger.warning("long poll is not supported by the server, fall back to ping")
+                    self.long_poll = False
             flag, available_gpus = self.ping()
-            time.sleep(10)
+            if not flag:
+                time.sleep(self.ping_interval)
         return available_gpus
+
+
+class WatchGroup(object):
+    """Many jobs (e.g. a hyperparameter sweep) registered and waited for together.
+
+    `jobs` are dicts with the arguments of `WatchClient` for a single job:
+    `id`, `gpus` and optionally `mode`, `req_gpu_num`, `walltime`,
+    `priority` and `nodes`. All of them are registered with one request,
+    and `wait` long-polls the whole group on one connection, yielding
+    `(id, available_gpus)` as soon as the gpus of a job are granted:
+
+        with WatchGroup(jobs, server_host="127.0.0.1", server_port=62333) as group:
+            for job_id, gpus in group.wait():
+                launch(job_id, gpus)
+
+    Jobs that time out or are cancelled are not yielded, see `failed`.
+    """
+
+    def __init__(
+        self,
+        jobs: List[dict],
+        server_host: str,
+        server_port: int,
+        timeout: Optional[int] = 60,
+        token: Optional[str] = None,
+        ping_interval: Optional[int] = 10,
+        long_poll_timeout: Optional[int] = 30,
+        max_retries: Optional[int] = 5,
+        backoff_factor: Optional[float] = 0.5,
+    ):
+        self.base_url = f"http://{server_host}:{server_port}"
+        user = getpass.getuser()
+        self.jobs = []
+        for job in jobs:
+            job = dict(job)
+            job["id"] = f"{user}@{job['id']}"
+            job.setdefault("mode", ClientMode.QUEUE)
+            job.setdefault("req_gpu_num", 0)
+            if job.get("nodes") is None:
+                if not check_gpus_existence(job["gpus"]):
+                    raise ValueError(f"Check the GPU existence of job {job['id']}")
+                if job["mode"] == ClientMode.SCHEDULE and not check_req_gpu_num(job["req_gpu_num"]):
+                    raise ValueError(f"Check the `req_gpu_num` of job {job['id']}")
+            self.jobs.append(job)
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.long_poll_timeout = long_poll_timeout
+        self.token = resolve_token(token)
+        self.session = build_session(auth_headers(self.token), max_retries, backoff_factor)
+        self.nodes = {}  # cluster mode: id -> node of the granted gpus
+        self.failed = {}  # id -> final status of the jobs that were not granted
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def register(self):
+        result = self.session.post(
+            self.base_url + "/client/register_batch",
+            json={"clients": self.jobs},
+            timeout=self.timeout,
+        ).json()
+        if result["status"] != "ok":
+            raise RuntimeError(f"err registering: {result['msg']}")
+        errors = [f"{r['id']}: {r['msg']}" for r in result["results"] if r["status"] != "ok"]
+        if errors:
+            raise RuntimeError("err registering: " + "; ".join(errors))
+
+    def wait(self):
+        self.register()
+        pending = {job["id"]: ClientStatus.WAITING.value for job in self.jobs}
+        while pending:
+            start = time.monotonic()
+            result = self.session.post(
+                self.base_url + "/client/wait_batch",
+                json={"statuses": pending, "timeout": self.long_poll_timeout},
+                timeout=self.timeout + self.long_poll_timeout,
+            ).json()
+            if result["status"] != "ok":
+                raise RuntimeError(f"err waiting: {result['msg']}")
+            changed = False
+            for client_id, info in result["clients"].items():
+                if info["status"] != "ok":
+                    self.failed[client_id] = info["msg"]
+                elif info["msg"] == ClientStatus.READY:
+                    self.nodes[client_id] = info.get("node")
+                elif info["msg"] == ClientStatus.WAITING:
+                    continue
+                else:
+                    self.failed[client_id] = info["msg"]
+                    logger.warning(f"client {client_id} is {info['msg']}")
+                del pending[client_id]
+                changed = True
+                if client_id not in self.failed:
+                    yield client_id, info["available_gpus"]
+            if not changed and time.monotonic() - start < 1:
+                # not held by the server (busy), do not hammer it
+                time.sleep(self.ping_interval)
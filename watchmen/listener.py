@@ -1,81 +1,309 @@
 import json
-from typing import List
+import time
+import threading
+from collections import deque
+from typing import List, Optional
 
-from gpustat.core import GPUStatCollection
+from watchmen.allocator import Allocator, FirstFitAllocator
+from watchmen.backends import GPUBackend, GPUStatBackend
+
+
+# used by the module level helpers and by `GPUInfo` without an explicit backend
+default_backend = GPUStatBackend()
+
+
+def set_default_backend(backend: GPUBackend):
+    global default_backend
+    default_backend = backend
+
+
+def is_gpu_stat_free(gpu):
+    """whether a single `gpustat.GPUStat` is totally free"""
+    return len(gpu.processes) <= 0 \
+        and gpu.utilization <= 10 \
+        and (float(gpu.memory_used) / float(gpu.memory_total) <= 1e-3 or gpu.memory_used < 50)
 
 
 def is_single_gpu_totally_free(gpu_index: int):
-    gs = GPUStatCollection.new_query()
+    gs = default_backend.query()
 
     if not isinstance(gpu_index, int):
         raise ValueError(f"gpu_index: {gpu_index} is not int")
     if gpu_index >= len(gs.gpus) or gpu_index < 0:
         raise ValueError(f"gpu_index: {gpu_index} does not exist")
 
-    gpu = gs.gpus[gpu_index]
-    if len(gpu.processes) <= 0 \
-            and gpu.utilization <= 10 \
-            and (float(gpu.memory_used) / float(gpu.memory_total) <= 1e-3 or gpu.memory_used < 50):
-        return True
-    else:
-        return False
+    return is_gpu_stat_free(gs.gpus[gpu_index])
 
 
 def check_gpus_existence(gpus: List[int]):
-    gs = GPUStatCollection.new_query()
-    for gpu in gpus:
-        try:
-            gs.gpus[gpu]
-        except KeyError:
-            return False
-    return True
+    num_gpus = default_backend.device_count()
+    return all(0 <= gpu < num_gpus for gpu in gpus)
 
 
 def check_req_gpu_num(req_gpu_num: int):
-    gs = GPUStatCollection.new_query()
-    return req_gpu_num <= len(gs.gpus)
+    return req_gpu_num <= default_backend.device_count()
+
+
+def gpus_to_mask(gpus: List[int]):
+    """bitmask of gpu indices, bit `i` is set for gpu `i`"""
+    mask = 0
+    for gpu in gpus:
+        if gpu < 0:
+            raise ValueError(f"gpu_index: {gpu} does not exist")
+        mask |= 1 << gpu
+    return mask
+
+
+def mask_to_gpus(mask: int):
+    gpus = []
+    gpu = 0
+    while mask:
+        if mask & 1:
+            gpus.append(gpu)
+        mask >>= 1
+        gpu += 1
+    return gpus
+
+
+# `int.bit_count` is only available since python 3.10
+popcount = getattr(int, "bit_count", None) or (lambda mask: bin(mask).count("1"))
+
+
+def gpu_stat_fingerprint(gpu):
+    """the displayed values of a gpu, used to tell whether anything visible has changed"""
+    return (
+        gpu.utilization,
+        gpu.memory_used,
+        getattr(gpu, "temperature", None),
+        tuple(p.get("pid") for p in gpu.processes),
+    )
+
+
+class FreeHistory(object):
+    """Recent free-ness samples of the gpus, to smooth out short idle gaps.
+
+    A single sample cannot tell a free gpu from one that is idle between
+    two epochs of a running job. A gpu is only free once every sample of
+    the last `min_free_time` seconds saw it free, and the gpus granted to a
+    client stay busy for `grant_hold` seconds (`hold`), until its job has
+    had the time to start. The samples are the raw free masks of the
+    snapshots, kept in a ring buffer that only reaches back
+    `min_free_time` seconds, so evaluating it is a few `&` of ints.
+    `add` is called by the gpu queries and `hold` by the scheduler, both
+    take `_lock`.
+    """
+
+    def __init__(self, min_free_time: Optional[float] = 0.0, grant_hold: Optional[float] = 0.0):
+        self.min_free_time = min_free_time
+        self.grant_hold = grant_hold
+        self.samples = deque()  # (timestamp, free_mask), oldest first
+        self.holds = {}  # gpu -> timestamp until which it is held
+        self._lock = threading.Lock()
+
+    def hold(self, gpus: List[int], now: Optional[float] = None):
+        if self.grant_hold <= 0:
+            return
+        until = (time.monotonic() if now is None else now) + self.grant_hold
+        with self._lock:
+            for gpu in gpus:
+                self.holds[gpu] = max(until, self.holds.get(gpu, until))
+
+    def add(self, free_mask: int, now: float):
+        """add a sample, returns the mask of the gpus free for `min_free_time` and not held"""
+        with self._lock:
+            samples = self.samples
+            samples.append((now, free_mask))
+            # the oldest sample needed is the newest one at least `min_free_time` old
+            while len(samples) > 1 and now - samples[1][0] >= self.min_free_time:
+                samples.popleft()
+            if now - samples[0][0] < self.min_free_time:
+                # not observed for long enough yet, e.g. right after start
+                stable_mask = 0
+            else:
+                stable_mask = free_mask
+                for _, mask in samples:
+                    stable_mask &= mask
+            if self.holds:
+                for gpu, until in list(self.holds.items()):
+                    if until <= now:
+                        del self.holds[gpu]
+                    else:
+                        stable_mask &= ~(1 << gpu)
+            return stable_mask
+
+
+class GPUSnapshot(object):
+    """Immutable result of one GPU query, free-ness is evaluated once on creation
+
+    `version` is only increased if something visible changed since the `previous` snapshot.
+    With a `history`, `free` are the gpus stably free (see `FreeHistory`), and
+    `raw_free_mask` the ones free in this query only.
+    """
+
+    __slots__ = (
+        "gs", "gpus", "free", "free_mask", "raw_free_mask", "timestamp", "fingerprint", "version"
+    )
+
+    def __init__(
+        self,
+        gs,
+        previous: Optional["GPUSnapshot"] = None,
+        history: Optional[FreeHistory] = None,
+    ):
+        object.__setattr__(self, "gs", gs)
+        object.__setattr__(self, "gpus", tuple(gs.gpus))
+        timestamp = time.monotonic()
+        object.__setattr__(self, "timestamp", timestamp)
+        raw_free_mask = 0
+        for i, gpu in enumerate(gs.gpus):
+            if is_gpu_stat_free(gpu):
+                raw_free_mask |= 1 << i
+        object.__setattr__(self, "raw_free_mask", raw_free_mask)
+        free_mask = raw_free_mask if history is None else history.add(raw_free_mask, timestamp)
+        object.__setattr__(self, "free_mask", free_mask)
+        object.__setattr__(self, "free", tuple(bool(free_mask >> i & 1) for i in range(len(gs.gpus))))
+        fingerprint = tuple(gpu_stat_fingerprint(gpu) for gpu in gs.gpus)
+        object.__setattr__(self, "fingerprint", fingerprint)
+        version = 0
+        if previous is not None:
+            version = previous.version + int(previous.fingerprint != fingerprint)
+        object.__setattr__(self, "version", version)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("GPUSnapshot is immutable")
+
+    @property
+    def age(self):
+        return time.monotonic() - self.timestamp
+
+    def is_free(self, gpu_index: int):
+        return self.free[gpu_index]
+
+    def __len__(self):
+        return len(self.gpus)
 
 
 class GPUInfo(object):
-    def __init__(self):
-        self.gpus = []
-        self.new_query()
+    """Latest `GPUSnapshot` of a `GPUBackend`, the first query happens on first use
+
+    Queries are serialized by `_lock`, whichever thread triggers them (the
+    periodic gpu job, the scheduler or an api handler finding the snapshot
+    stale), so the snapshots and the `history` samples follow each other
+    in time. A thread that waited for another one's query uses its result.
+    """
+
+    def __init__(
+        self,
+        max_snapshot_age: Optional[float] = None,
+        backend: Optional[GPUBackend] = None,
+        allocator: Optional[Allocator] = None,
+        history: Optional[FreeHistory] = None,
+    ):
+        # `None` means the snapshot is only refreshed by calling `new_query` explicitly
+        self.max_snapshot_age = max_snapshot_age
+        self.backend = backend
+        # picks the gpus of `schedule` mode clients
+        self.allocator = allocator if allocator is not None else FirstFitAllocator()
+        # smooths the free-ness over the recent snapshots, single samples by default
+        self.history = history if history is not None else FreeHistory()
+        self.snapshot = None
+        self.num_queries = 0  # queries of the backend, e.g. NVML scans
+        self._lock = threading.Lock()
+
+    @property
+    def gpus(self):
+        return self.get_snapshot().gpus
+
+    @property
+    def gs(self):
+        return self.get_snapshot().gs
+
+    @property
+    def version(self):
+        """version of the latest snapshot without querying, `-1` before the first query"""
+        snapshot = self.snapshot
+        return -1 if snapshot is None else snapshot.version
+
+    def _query(self):
+        backend = self.backend if self.backend is not None else default_backend
+        self.num_queries += 1
+        self.snapshot = GPUSnapshot(backend.query(), previous=self.snapshot, history=self.history)
+        # hotplug or driver reload, the device validation sees it right away
+        backend.observe(self.snapshot.gpus)
+        return self.snapshot
 
     def new_query(self):
-        gs = GPUStatCollection.new_query()
-        self.gpus = gs.gpus
-        self.gs = gs
-
-    def _is_totally_free(self, gpu_index: int):
-        self.new_query()
-        gpu = self.gpus[gpu_index]
-        if len(gpu.processes) <= 0 \
-                and gpu.utilization <= 10 \
-                and (float(gpu.memory_used) / float(gpu.memory_total) <= 1e-3 or gpu.memory_used < 50):
-            return True
-        else:
-            return False
-
-    def is_gpus_available(self, gpus: List[int]):
+        with self._lock:
+            return self._query()
+
+    def _is_stale(self, snapshot: Optional[GPUSnapshot]):
+        return snapshot is None or (
+            self.max_snapshot_age is not None and snapshot.age >= self.max_snapshot_age
+        )
+
+    def get_snapshot(self):
+        """the latest snapshot, re-queried only if older than `max_snapshot_age` seconds"""
+        snapshot = self.snapshot
+        if self._is_stale(snapshot):
+            with self._lock:
+                # another thread may have queried while this one waited
+                snapshot = self.snapshot
+                if self._is_stale(snapshot):
+                    snapshot = self._query()
+        return snapshot
+
+    def _is_totally_free(self, gpu_index: int, snapshot: Optional[GPUSnapshot] = None):
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        return snapshot.is_free(gpu_index)
+
+    def is_gpus_available(self, gpus: List[int], snapshot: Optional[GPUSnapshot] = None):
+        if snapshot is None:
+            snapshot = self.get_snapshot()
         stts = []
         for gpu in gpus:
-            stts.append(self._is_totally_free(gpu))
+            stts.append(snapshot.is_free(gpu))
         return all(stts)
 
-    def get_available_gpus_in_scope(self, gpu_scope: List[int]):
+    def get_available_gpus_in_scope(self, gpu_scope: List[int], snapshot: Optional[GPUSnapshot] = None):
+        if snapshot is None:
+            snapshot = self.get_snapshot()
         available_gpus = []
         for gpu in gpu_scope:
-            if self._is_totally_free(gpu):
+            if snapshot.is_free(gpu):
                 available_gpus.append(gpu)
         return available_gpus
 
-    def is_req_gpu_num_satisfied(self, gpu_scope: List[int], req_gpu_num: int):
-        ok = False
-        available_gpus = self.get_available_gpus_in_scope(gpu_scope)
+    def is_req_gpu_num_satisfied(
+        self,
+        gpu_scope: List[int],
+        req_gpu_num: int,
+        snapshot: Optional[GPUSnapshot] = None,
+        exclude_mask: Optional[int] = 0,
+        scope_mask: Optional[int] = None,
+    ):
+        """whether `req_gpu_num` free gpus in scope can be allocated, gpus in `exclude_mask`
+        (reserved by others) are not taken. returns `(ok, gpus)`, where `gpus` are the
+        allocated gpus if ok, else all the free gpus in scope.
+        `scope_mask` is the precomputed bitmask of `gpu_scope`"""
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        if scope_mask is None:
+            if any(gpu >= len(snapshot) for gpu in gpu_scope):
+                raise IndexError("tuple index out of range")
+            scope_mask = gpus_to_mask(gpu_scope)
+        free_mask = snapshot.free_mask & ~exclude_mask
+        candidates_mask = scope_mask & free_mask
+        # in scope order
+        available_gpus = [gpu for gpu in gpu_scope if candidates_mask >> gpu & 1]
+        allocation = None
         if req_gpu_num <= len(available_gpus):
-            available_gpus = available_gpus[:req_gpu_num]
-            ok = True
-        return ok, available_gpus
+            allocation = self.allocator.allocate(
+                available_gpus, req_gpu_num, mask_to_gpus(free_mask)
+            )
+        if allocation is None:
+            return False, available_gpus
+        return True, allocation
 
     def __getitem__(self, index: int):
         return self._is_totally_free(index)
@@ -0,0 +1,169 @@
+"""Counters and histograms in the Prometheus text format, without dependencies.
+
+Every thread updates its own shard, so the hot paths never take a lock and
+never wait for a scrape. `collect` sums the shards up, the shards of the
+threads that have exited are folded into a base shard, also when a new
+thread adds its shard once there are many of them (e.g. a thread per
+request), so they do not pile up between scrapes.
+"""
+import bisect
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+# seconds, from a fast ping to a long `check_work` pass
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# seconds, from an idle gpu to a day in the queue
+WAIT_BUCKETS = (1, 10, 30, 60, 300, 600, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 24 * 3600)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labelnames: Tuple[str, ...], labelvalues: Tuple, extra: str = ""):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    type = "untyped"
+    min_prune_shards = 64  # shards before the exited ones are folded when adding one
+
+    def __init__(self, name: str, help: str, labelnames: Optional[Tuple[str, ...]] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()  # only for adding shards and collecting
+        self._local = threading.local()
+        self._shards = []  # (thread, values)
+        self._base = {}  # values of the threads that have exited
+        self._prune_at = self.min_prune_shards
+
+    def _values(self):
+        """the shard of the current thread, labelvalues -> value"""
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                if len(self._shards) >= self._prune_at:
+                    self._fold_exited()
+                self._shards.append((threading.current_thread(), values))
+            return values
+
+    def _fold_exited(self):
+        """fold the shards of the exited threads into `_base`, called with `_lock` held"""
+        alive = []
+        for thread, values in self._shards:
+            if thread.is_alive():
+                alive.append((thread, values))
+            else:
+                self._merge(self._base, values)
+        self._shards = alive
+        # amortized O(1) per added shard, even if all the threads stay alive
+        self._prune_at = max(self.min_prune_shards, 2 * len(alive))
+
+    def _merge(self, into: Dict, values: Dict):
+        raise NotImplementedError
+
+    def collect(self):
+        """labelvalues -> value, summed up over the threads"""
+        with self._lock:
+            self._fold_exited()
+            total = {}
+            self._merge(total, self._base)
+            for _, values in self._shards:
+                # `dict(values)` is a single C call, so it does not race with the writer
+                self._merge(total, dict(values))
+        return total
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labelvalues, amount: Optional[float] = 1):
+        values = self._values()
+        values[labelvalues] = values.get(labelvalues, 0) + amount
+
+    def _merge(self, into: Dict, values: Dict):
+        for key, value in values.items():
+            into[key] = into.get(key, 0) + value
+
+    def render(self):
+        lines = self.header()
+        for key, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}")
+        return lines
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Optional[Tuple[str, ...]] = (),
+        buckets: Optional[Tuple[float, ...]] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labelvalues):
+        values = self._values()
+        counts = values.get(labelvalues)
+        if counts is None:
+            # a count per bucket (the last one is `+Inf`), then the sum
+            counts = values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _merge(self, into: Dict, values: Dict):
+        for key, counts in values.items():
+            counts = list(counts)
+            total = into.get(key)
+            if total is None:
+                into[key] = counts
+            else:
+                for i, count in enumerate(counts):
+                    total[i] += count
+
+    def render(self):
+        lines = self.header()
+        for key, counts in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{format_value(float(bound))}"'
+                lines.append(
+                    f"{self.name}_bucket{format_labels(self.labelnames, key, le)} {cumulative}"
+                )
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render_samples(
+    name: str, type: str, help: str, labelnames: Tuple[str, ...], samples: List[Tuple[Tuple, float]]
+):
+    """a gauge or counter kept elsewhere (e.g. computed at scrape time),
+    from `(labelvalues, value)` samples"""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+    for labelvalues, value in samples:
+        lines.append(f"{name}{format_labels(labelnames, labelvalues)} {format_value(value)}")
+    return lines
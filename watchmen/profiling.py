@@ -0,0 +1,105 @@
+"""Opt-in profiling of a running server (`--profile`).
+
+- `sample_stacks` samples the stacks of the server threads (the scheduler
+    and the api handlers) for some seconds, in the folded format of
+    `flamegraph.pl` and speedscope: one `thread;outer;...;inner count` line
+    per distinct stack.
+- `PassTimer` measures the phases of a scheduling pass, and `PassLog` keeps
+    the recent passes in a ring buffer.
+"""
+import os
+import sys
+import time
+import datetime
+import threading
+from collections import deque
+from typing import Optional
+
+MAX_PROFILE_SECONDS = 60
+
+
+def frame_label(frame):
+    code = frame.f_code
+    filename = os.path.basename(code.co_filename)
+    # `;` separates the frames of a folded stack
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+
+def sample_stacks(
+    seconds: float, interval: Optional[float] = 0.005, thread_filter: Optional[str] = None
+):
+    """sample the stacks of all the other threads (or those with `thread_filter`
+    in their name) every `interval` seconds, returns `{folded stack: count}`"""
+    seconds = min(max(seconds, 0), MAX_PROFILE_SECONDS)
+    me = threading.get_ident()
+    counts = {}
+    deadline = time.monotonic() + seconds
+    while True:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            name = names.get(ident, str(ident))
+            if ident == me or (thread_filter and thread_filter not in name):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            stack.append(name.replace(";", ":"))
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(interval)
+    return counts
+
+
+def render_folded(counts: dict):
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+
+
+class PassTimer(object):
+    """Wall time of the phases of a scheduling pass.
+
+    `mark(phase)` closes a phase that started at the previous mark (or at
+    `start`), `count` adds to the counters of the pass.
+    """
+
+    def __init__(self, start: float):
+        self.start = start
+        self.last = start
+        self.time = datetime.datetime.now()
+        self.phases = {}
+        self.counts = {}
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def count(self, name: str, value: int):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def jsonify(self):
+        return {
+            "time": self.time.strftime("%Y-%m-%d %H:%M:%S.%f"),
+            "total_ms": (self.last - self.start) * 1000,
+            "phases_ms": {phase: seconds * 1000 for phase, seconds in self.phases.items()},
+            **self.counts,
+        }
+
+
+class PassLog(object):
+    """ring buffer of the last `size` scheduling passes, see `PassTimer`"""
+
+    def __init__(self, size: Optional[int] = 512):
+        self.passes = deque(maxlen=size)
+
+    def add(self, timer: PassTimer):
+        # `deque.append` is atomic, readers take a copy with `list`
+        self.passes.append(timer)
+
+    def jsonify(self, limit: Optional[int] = None):
+        passes = list(self.passes)
+        if limit is not None:
+            passes = passes[-limit:] if limit > 0 else []
+        return [timer.jsonify() for timer in reversed(passes)]
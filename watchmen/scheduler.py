@@ -0,0 +1,328 @@
+import time
+import heapq
+import logging
+import datetime
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional
+
+
+logger = logging.getLogger("common")
+
+
+class WorkTrigger(object):
+    """Runs scheduling passes on demand instead of on a blind timer.
+
+    Any event that may change a scheduling decision (register, cancel,
+    client exit, gpu snapshot change) calls `notify`. The runner wakes up,
+    waits `debounce` seconds so that a burst of events is coalesced into a
+    single pass, and then runs the pass. If nothing happens for
+    `fallback_interval` seconds, a pass is run anyway as a safety net
+    (e.g. to time out clients that stopped pinging). A pass that raises is
+    logged and the runner carries on with the next one.
+    """
+
+    def __init__(self, debounce: Optional[float] = 0.05, fallback_interval: Optional[float] = 5.0):
+        self.debounce = debounce
+        self.fallback_interval = fallback_interval
+        self._event = threading.Event()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._reasons = set()
+        self.num_passes = 0
+
+    def notify(self, reason: Optional[str] = "event"):
+        with self._lock:
+            self._reasons.add(reason)
+        self._event.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._event.set()
+
+    def wait(self):
+        """block until the next pass is due, returns the set of reasons"""
+        if not self._event.wait(timeout=self.fallback_interval):
+            return {"timer"}
+        if self.debounce and not self._stopped.is_set():
+            self._stopped.wait(self.debounce)
+        # cleared before the pass so that events arriving during it trigger another one
+        self._event.clear()
+        with self._lock:
+            reasons, self._reasons = self._reasons, set()
+        return reasons
+
+    def run(self, func: Callable, *args, **kwargs):
+        while not self._stopped.is_set():
+            self.wait()
+            if self._stopped.is_set():
+                break
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception("scheduling pass failed")
+            self.num_passes += 1
+
+
+class Backfill(object):
+    """EASY backfill for one scheduling pass.
+
+    The oldest blocked client that needs more than one gpu gets a
+    reservation: the gpus expected to be free the earliest. The `shadow_time`
+    is when all of them are expected to be free, derived from the declared
+    `walltime` of the `ready` clients holding them (unknown if any holder
+    did not declare one, or the gpu is used outside watchmen).
+
+    A later client may still take reserved gpus if it declared a `walltime`
+    that ends before the `shadow_time`, so it does not delay the reservation.
+    Gpus outside the reservation are assigned as usual.
+    """
+
+    def __init__(self, ready_clients: List, now: Optional[datetime.datetime] = None):
+        self.now = now if now is not None else datetime.datetime.now()
+        # gpu -> when its `ready` holder is expected to finish, `None` if unknown
+        self.gpu_free_time: Dict[int, Optional[datetime.datetime]] = {}
+        for client in ready_clients:
+            self.hold(client)
+        self.head = None
+        self.reserved_mask = 0  # bitmask of the reserved gpus
+        self.shadow_time: Optional[datetime.datetime] = None
+
+    @property
+    def reserved(self):
+        return [gpu for gpu in range(self.reserved_mask.bit_length()) if self.reserved_mask >> gpu & 1]
+
+    def hold(self, client):
+        """record the gpus of a `ready` client"""
+        end_time = None
+        if client.walltime is not None and client.ready_time is not None:
+            end_time = client.ready_time + datetime.timedelta(seconds=client.walltime)
+        for gpu in client.available_gpus:
+            self.gpu_free_time[gpu] = end_time
+
+    @staticmethod
+    def num_required(client):
+        return client.req_gpu_num if client.mode == "schedule" else len(client.gpus)
+
+    def _expected_free_time(self, gpu: int, free: bool):
+        if gpu in self.gpu_free_time:
+            return self.gpu_free_time[gpu]
+        # free now, or busy for an unknown time
+        return self.now if free else None
+
+    def reserve(self, client, free_mask: int):
+        """reserve gpus for `client` if it is the first blocked multi-gpu client of the pass,
+        `free_mask` is the bitmask of the free gpus"""
+        num_required = self.num_required(client)
+        if self.head is not None or num_required <= 1 or len(set(client.gpus)) < num_required:
+            # the scope of a client that can never be satisfied is not worth blocking
+            return False
+        times = {
+            gpu: self._expected_free_time(gpu, bool(free_mask >> gpu & 1)) for gpu in client.gpus
+        }
+        if client.mode == "schedule":
+            # earliest first, unknown last, ties in scope order
+            ordered = sorted(
+                client.gpus, key=lambda gpu: (times[gpu] is None, times[gpu] or self.now)
+            )
+            gpus = ordered[: client.req_gpu_num]
+        else:
+            gpus = list(client.gpus)
+        self.head = client
+        for gpu in gpus:
+            self.reserved_mask |= 1 << gpu
+        if all(times[gpu] is not None for gpu in gpus):
+            self.shadow_time = max(times[gpu] for gpu in gpus)
+        return True
+
+    def fits_before_shadow(self, client):
+        """whether `client` would be done before the reservation can start"""
+        if self.shadow_time is None or client.walltime is None:
+            return False
+        return self.now + datetime.timedelta(seconds=client.walltime) <= self.shadow_time
+
+    def allows(self, client, gpu_mask: int):
+        """whether `client` may run on the gpus of `gpu_mask` without delaying the reservation"""
+        if not self.reserved_mask & gpu_mask:
+            return True
+        return self.fits_before_shadow(client)
+
+
+def client_user(client_id: str):
+    """the user of a client, `WatchClient` prefixes ids with `user@`"""
+    return client_id.split("@", 1)[0]
+
+
+# scheduling order of the priority classes, lower first
+PRIORITY_RANK = {"high": 0, "normal": 1, "low": 2}
+
+
+class FairShare(object):
+    """Per-user fair-share order and gpu quotas of the waiting clients.
+
+    Every grant charges the user `gpus * walltime` gpu-seconds (the
+    `default_walltime` if the client did not declare one). The usage decays
+    with `half_life` seconds, so old usage is forgotten. All users decay
+    at the same rate, so the usage is stored relative to a reference time
+    `t0` and decaying costs nothing: a charge at `t` is stored as
+    `amount * 2 ** ((t - t0) / half_life)`, and the stored values compare
+    just like the decayed ones.
+
+    `order` yields the waiting clients by priority class, then by the
+    lowest usage of their user, then in queue order. The usage of a user
+    is re-read after each of its clients, so grants within a pass
+    interleave the users. A `half_life` <= 0 disables the usage, leaving
+    priority classes and queue order.
+
+    `quota` is the max number of gpus a user may hold at once, held gpus
+    are the ones of its `ready` clients.
+    """
+
+    def __init__(
+        self,
+        half_life: Optional[float] = 24 * 3600,
+        default_walltime: Optional[float] = 3600,
+        max_gpus_per_user: Optional[int] = None,
+        user_quotas: Optional[Dict[str, int]] = None,
+        clock: Optional[Callable] = time.time,
+    ):
+        self.half_life = half_life
+        self.default_walltime = default_walltime
+        self.max_gpus_per_user = max_gpus_per_user
+        self.user_quotas = user_quotas or {}
+        self.clock = clock
+        self.t0 = clock()
+        self._usage: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _scale(self, now: float):
+        return 2.0 ** ((now - self.t0) / self.half_life)
+
+    def _renormalize(self, now: float):
+        # keeps the stored values in float range, the relative order is unchanged
+        scale = self._scale(now)
+        if scale > 1e100:
+            self._usage = {user: usage / scale for user, usage in self._usage.items()}
+            self.t0 = now
+
+    def charge(self, user: str, gpu_seconds: float):
+        if self.half_life is None or self.half_life <= 0:
+            return
+        with self._lock:
+            now = self.clock()
+            self._usage[user] = self._usage.get(user, 0.0) + gpu_seconds * self._scale(now)
+
+    def grant(self, client):
+        walltime = client.walltime if client.walltime is not None else self.default_walltime
+        self.charge(client_user(client.id), len(client.available_gpus) * walltime)
+
+    def usage(self, user: str):
+        """decayed gpu-seconds of `user` now"""
+        if self.half_life is None or self.half_life <= 0:
+            return 0.0
+        with self._lock:
+            return self._usage.get(user, 0.0) / self._scale(self.clock())
+
+    def usages(self):
+        """decayed gpu-seconds of every charged user now"""
+        return {user: self.usage(user) for user in list(self._usage)}
+
+    def has_quotas(self):
+        return self.max_gpus_per_user is not None or bool(self.user_quotas)
+
+    def quota(self, user: str):
+        """max gpus `user` may hold, `None` for unlimited"""
+        return self.user_quotas.get(user, self.max_gpus_per_user)
+
+    def order(self, items: List, client_of: Optional[Callable] = None):
+        """yields `items` (or the clients in them, see `client_of`) in the scheduling order"""
+        if client_of is None:
+            client_of = lambda item: item  # noqa: E731
+        if self.half_life is not None and self.half_life > 0:
+            with self._lock:
+                self._renormalize(self.clock())
+        queues = OrderedDict()
+        default_rank = PRIORITY_RANK["normal"]
+        for position, item in enumerate(items):
+            client = client_of(item)
+            priority = getattr(client.priority, "value", client.priority)
+            key = (PRIORITY_RANK.get(priority, default_rank), client_user(client.id))
+            queue = queues.get(key)
+            if queue is None:
+                queue = queues[key] = deque()
+            queue.append((position, item))
+        heap = []
+        for key, queue in queues.items():
+            heap.append((key[0], self._usage.get(key[1], 0.0), queue[0][0], key))
+        heapq.heapify(heap)
+        while heap:
+            _, _, _, key = heapq.heappop(heap)
+            queue = queues[key]
+            yield queue.popleft()[1]
+            if queue:
+                # the usage may have been charged by a grant of the yielded client
+                heapq.heappush(heap, (key[0], self._usage.get(key[1], 0.0), queue[0][0], key))
+
+
+class SchedulingCache(object):
+    """Inputs and per-client results of the last `check_work` pass.
+
+    A pass is skipped if the free gpus, the work queue (`ClientCollection.version`)
+    and the collection itself are unchanged, and no client can have timed out
+    yet (`deadline`, pings only move it later). Otherwise only the dirty
+    clients are evaluated again: the ones changed since the last pass and the
+    ones whose scope contains a gpu that flipped free/busy, found by the
+    index of the clients by their gpus.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, collection=None):
+        self.collection = collection
+        self.free_mask = None
+        self.version = None
+        self.deadline = None  # no client times out before this
+        self.results = {}  # client_id -> (ok, available_gpus)
+        self._gpu_masks = {}  # client_id -> gpu mask of the cached result
+        self.by_gpu = {}  # gpu -> ids of the cached clients with the gpu in scope
+
+    def is_unchanged(self, collection, free_mask: int, version: int, now: datetime.datetime):
+        return (
+            self.collection is collection
+            and self.free_mask == free_mask
+            and self.version == version
+            and self.deadline is not None
+            and now < self.deadline
+        )
+
+    def put(self, client_id: str, gpu_mask: int, result: tuple):
+        if client_id not in self.results:
+            self._gpu_masks[client_id] = gpu_mask
+            gpu = 0
+            while gpu_mask >> gpu:
+                if gpu_mask >> gpu & 1:
+                    self.by_gpu.setdefault(gpu, set()).add(client_id)
+                gpu += 1
+        self.results[client_id] = result
+
+    def drop(self, client_id: str):
+        if self.results.pop(client_id, None) is None:
+            return
+        gpu_mask = self._gpu_masks.pop(client_id)
+        gpu = 0
+        while gpu_mask >> gpu:
+            if gpu_mask >> gpu & 1:
+                ids = self.by_gpu[gpu]
+                ids.discard(client_id)
+                if not ids:
+                    del self.by_gpu[gpu]
+            gpu += 1
+
+    def affected(self, flipped_mask: int):
+        """ids of the cached clients with a flipped gpu in scope"""
+        dirty = set()
+        for gpu, ids in self.by_gpu.items():
+            if flipped_mask >> gpu & 1:
+                dirty |= ids
+        return dirty
@@ -1,6 +1,7 @@
 import os
 import sys
-import queue
+import json
+import time
 import logging
 import readline  # noqa: F401
 import datetime
@@ -9,17 +10,35 @@ import threading
 import secrets
 from functools import wraps
 
-from flask import Flask, jsonify, request, render_template, make_response, session
+from flask import (
+    Flask,
+    Response,
+    jsonify,
+    request,
+    render_template,
+    make_response,
+    session,
+    stream_with_context,
+)
 from flask.json.provider import DefaultJSONProvider
-from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.schedulers.background import BackgroundScheduler
 
 from watchmen.listener import (
     is_single_gpu_totally_free,
     check_gpus_existence,
     check_req_gpu_num,
     GPUInfo,
+    set_default_backend,
+    gpus_to_mask,
+    popcount,
 )
+from watchmen.allocator import ALLOCATORS, BestFitAllocator, GPUTopology, get_allocator
+from watchmen.backends import BACKENDS, ClusterBackend, get_backend
 from watchmen.client import ClientStatus, ClientMode, ClientModel, ClientCollection
+from watchmen.scheduler import Backfill, FairShare, SchedulingCache, WorkTrigger, client_user
+from watchmen.store import ClientStore, restore_clients
+from watchmen.metrics import WAIT_BUCKETS, Counter, Histogram, render_samples
+from watchmen.profiling import PassLog, PassTimer, render_folded, sample_stacks
 
 
 apscheduler_logger = logging.getLogger("apscheduler")
@@ -35,17 +54,51 @@ logger.addHandler(stream_handler)
 
 app = Flask("watchmen.server")
 app.secret_key = os.environ.get("WATCHMEN_SECRET_KEY", secrets.token_hex(32))
-gpu_queue = queue.Queue()
 gpu_info = GPUInfo()
-gpu_queue.put(1)
-client_queue = queue.Queue()
 cc = ClientCollection()
-client_queue.put(1)
+work_trigger = WorkTrigger()
+fair_share = FairShare()
+scheduling_cache = SchedulingCache()
+worker_exited = threading.Event()
+# notified whenever a client status changes, used by `/client/wait` long polls
+status_changed = threading.Condition()
 
 APP_PORT = None
 AUTH_TOKEN = None
+LONG_POLL_TIMEOUT = 30  # max seconds a `/client/wait` request is held
+# limits the held `/client/wait` requests when serving with a fixed thread pool,
+# so that long polls cannot starve the other routes. `None` means unlimited
+long_poll_slots = None
+event_stream_slots = None  # same for the `/events` streams
+EVENT_STREAM_HEARTBEAT = 15  # seconds between keep-alive comments of idle `/events` streams
+EVENT_STREAM_RETRY = 3000  # reconnection delay of `EventSource` (milliseconds)
+BACKFILL = True  # reserve gpus for the oldest blocked multi-gpu client, see `Backfill`
+PROFILE = False  # `--profile`: enables `/debug/profile` and the timings of `/debug/passes`
+pass_log = PassLog()
+gpu_info_job = None  # the periodic `check_gpu_info` job, see `refresh_gpu_info`
 PID_FILE = ".watchmen_server.pid"
 TOKEN_FILE = ".watchmen_server.token"
+STATE_FILE = ".watchmen_server.db"
+
+# exposed on `/metrics`, see `watchmen.metrics`
+REQUEST_DURATION = Histogram(
+    "watchmen_request_duration_seconds", "latency of the api requests", ("route", "method")
+)
+CHECK_WORK_DURATION = Histogram(
+    "watchmen_check_work_duration_seconds", "duration of the scheduling passes"
+)
+CHECK_WORK_SKIPPED = Counter(
+    "watchmen_check_work_skipped_total", "scheduling passes skipped since nothing changed"
+)
+CHECK_GPU_INFO_DURATION = Histogram(
+    "watchmen_check_gpu_info_duration_seconds", "duration of the periodic gpu status queries"
+)
+WAIT_DURATION = Histogram(
+    "watchmen_wait_duration_seconds",
+    "seconds from the registration of a client until its gpus are granted",
+    ("mode",),
+    buckets=WAIT_BUCKETS,
+)
 
 
 class CustomJSONProvider(DefaultJSONProvider):
@@ -64,6 +117,56 @@ class CustomJSONProvider(DefaultJSONProvider):
 app.json_provider_class = CustomJSONProvider
 
 
+class TimedRequest(app.request_class):
+    """keeps a reference in the environ for `RequestTimer`, flask clears `werkzeug.request`"""
+
+    def __init__(self, environ, *args, **kwargs):
+        super().__init__(environ, *args, **kwargs)
+        environ["watchmen.request"] = self
+
+
+class RequestTimer(object):
+    """wsgi middleware observing the latency of every request in `REQUEST_DURATION`,
+    cheaper than flask's request hooks on the `/client/ping` hot path"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        start_time = time.perf_counter()
+        try:
+            return self.wsgi_app(environ, start_response)
+        finally:
+            # popped, so the request and the environ do not keep each other alive
+            rule = getattr(environ.pop("watchmen.request", None), "url_rule", None)
+            REQUEST_DURATION.observe(
+                time.perf_counter() - start_time,
+                rule.rule if rule is not None else "unmatched",
+                environ.get("REQUEST_METHOD"),
+            )
+
+
+app.request_class = TimedRequest
+app.wsgi_app = RequestTimer(app.wsgi_app)
+
+
+def observed(histogram):
+    """observe the duration of every call of the decorated function in `histogram`"""
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start_time)
+
+        return decorated_function
+
+    return decorator
+
+
 def load_token_from_file():
     """Load authentication token from file if it exists."""
     if os.path.exists(TOKEN_FILE):
@@ -158,71 +261,359 @@ def get_gpus_status(gpu_ids: str):
     return jsonify({"status": status, "msg": msg, "detail": detail})
 
 
+def notify_status_changed():
+    with status_changed:
+        status_changed.notify_all()
+
+
+def cluster_backend():
+    """the gpu backend if the server runs in cluster mode, else `None`"""
+    backend = gpu_info.backend
+    return backend if isinstance(backend, ClusterBackend) else None
+
+
+UNKNOWN_CLIENT_INFO = {
+    "status": "err",
+    "available_gpus": [],
+    "msg": "client not registered or has been cancelled",
+}
+UNKNOWN_CLIENT_RESPONSE = json.dumps(UNKNOWN_CLIENT_INFO, separators=(",", ":"))
+PING_CACHE_SLACK = 1024
+# client_id -> (client, status, available_gpus, response body) of the last ping
+ping_responses = {}
+
+
+def prune_ping_responses():
+    """drop the cached pings of clients that are no longer in either queue"""
+    for client_id, cached in list(ping_responses.items()):
+        if cc.get(client_id)[0] is not cached[0]:
+            ping_responses.pop(client_id, None)
+
+
+class RequestLog(object):
+    """Rate-limited log of a frequent request like `/client/ping`.
+
+    A single summary line is logged at most every `interval` seconds, the
+    single requests only at DEBUG level, so a busy server does not spend
+    its time writing the log.
+    """
+
+    def __init__(self, name: str, interval: float = 60):
+        self.name = name
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._count = 0
+        self._unknown = 0
+        self._since = time.monotonic()
+
+    def record(self, client_id: str, known: bool):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"{self.name} client={client_id} known={known}")
+        with self._lock:
+            self._count += 1
+            self._unknown += not known
+            now = time.monotonic()
+            elapsed = now - self._since
+            if elapsed < self.interval:
+                return
+            count, unknown = self._count, self._unknown
+            self._count = self._unknown = 0
+            self._since = now
+        logger.info(
+            f"{self.name} requests={count} rate={count / elapsed:.1f}/s "
+            f"unknown_clients={unknown} seconds={elapsed:.0f}"
+        )
+
+
+ping_log = RequestLog("ping")
+wait_log = RequestLog("wait")
+
+
+def describe_client(client):
+    info = {"status": "ok", "available_gpus": client.available_gpus, "msg": client.status}
+    cluster = cluster_backend()
+    if cluster is not None:
+        # the job runs on the node, so it gets the local gpu indices of that node
+        info["node"], info["available_gpus"] = cluster.localize(client.available_gpus)
+    return info
+
+
+def get_client_info(client_id: str):
+    client, finished = cc.get(client_id)
+    if client is None:
+        return dict(UNKNOWN_CLIENT_INFO)
+    if not finished:
+        client.last_request_time = datetime.datetime.now()
+    return describe_client(client)
+
+
+def parse_client_id():
+    """the `id` of a json request body, without building a `ClientModel`"""
+    environ = request.environ
+    try:
+        length = int(environ.get("CONTENT_LENGTH") or -1)
+    except ValueError:
+        length = -1
+    try:
+        if length >= 0:
+            # much cheaper than building werkzeug's input stream wrapper
+            raw = environ["wsgi.input"].read(length)
+        else:
+            raw = request.get_data(cache=False)
+        data = json.loads(raw or b"{}")
+    except ValueError:
+        return None
+    client_id = data.get("id") if isinstance(data, dict) else None
+    return client_id if isinstance(client_id, str) else None
+
+
 @app.route("/client/ping", methods=["POST"])
 @login_required
 def client_ping():
-    client_info = ClientModel(**request.json)
-    status = ""
-    available_gpus = []
-    msg = ""
-    client_id = client_info.id
-    if client_id in cc:
-        cc[client_id].last_request_time = datetime.datetime.now()
-        status = "ok"
-        available_gpus = cc[client_id].available_gpus
-        msg = cc[client_id].status
-    elif client_id in cc.finished_queue:
-        status = "ok"
-        available_gpus = cc.finished_queue[client_id].available_gpus
-        msg = cc.finished_queue[client_id].status
+    """hot path: the response body is reused while the client is unchanged"""
+    client_id = parse_client_id()
+    client, finished = cc.get(client_id)
+    if client is None:
+        body = UNKNOWN_CLIENT_RESPONSE
     else:
-        status = "err"
-        msg = "client not registered or has been cancelled"
-    info = {"status": status, "available_gpus": available_gpus, "msg": msg}
-    logger.info(f"client {client_id} ping: {info}")
+        if not finished:
+            client.last_request_time = datetime.datetime.now()
+        status, available_gpus = client.status, client.available_gpus
+        cached = ping_responses.get(client_id)
+        if (
+            cached is not None
+            and cached[0] is client
+            and cached[1] is status
+            and cached[2] is available_gpus
+        ):
+            body = cached[3]
+        else:
+            body = json.dumps(describe_client(client), separators=(",", ":"))
+            # clients trimmed from the finished queue are only found by a scan,
+            # done when the cache has grown well past the live clients
+            num_live = len(cc.work_queue) + len(cc.finished_queue)
+            if len(ping_responses) >= 2 * num_live + PING_CACHE_SLACK:
+                prune_ping_responses()
+            ping_responses[client_id] = (client, status, available_gpus, body)
+    ping_log.record(client_id, client is not None)
+    return Response(body, mimetype="application/json")
+
+
+@app.route("/client/wait", methods=["POST"])
+@login_required
+def client_wait():
+    """long-poll version of `/client/ping`
+
+    The request is held until the status of the client differs from the
+    `status` it already knows, or `timeout` seconds (capped by
+    `LONG_POLL_TIMEOUT`) have passed. `last_request_time` is refreshed
+    like a regular ping.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"status": "err", "available_gpus": [], "msg": "the body must be a json object"})
+    client_id = data.get("id")
+    known_status = data.get("status", ClientStatus.WAITING)
+    try:
+        timeout = min(float(data.get("timeout", LONG_POLL_TIMEOUT)), LONG_POLL_TIMEOUT)
+    except (TypeError, ValueError):
+        timeout = LONG_POLL_TIMEOUT
+    slots = long_poll_slots
+    if slots is not None and not slots.acquire(blocking=False):
+        # all slots are taken, answer like a regular ping
+        slots = None
+        timeout = 0
+    deadline = time.monotonic() + timeout
+    try:
+        with status_changed:
+            info = get_client_info(client_id)
+            while info["status"] == "ok" and info["msg"] == known_status:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                status_changed.wait(remaining)
+                info = get_client_info(client_id)
+    finally:
+        if slots is not None:
+            slots.release()
+    wait_log.record(client_id, info["status"] == "ok")
     return jsonify(info)
 
 
-@app.route("/client/register", methods=["POST"])
+@app.route("/client/wait_batch", methods=["POST"])
 @login_required
-def client_register():
-    client_info = ClientModel(**request.json)
-    status = ""
-    msg = ""
+def client_wait_batch():
+    """long-poll `/client/wait` for a group of clients on a single connection
+
+    `statuses` maps the id of every client of the group to the status its
+    caller already knows. The request is held until one of them differs,
+    or `timeout` seconds have passed, and returns the info of all the
+    clients in `clients`, keyed by id. Every client of the group is
+    refreshed like a regular ping.
+    """
+    data = request.get_json(silent=True)
+    statuses = data.get("statuses") if isinstance(data, dict) else None
+    if not isinstance(statuses, dict):
+        return jsonify({"status": "err", "msg": "`statuses` must be an object of id -> status"})
+    try:
+        timeout = min(float(data.get("timeout", LONG_POLL_TIMEOUT)), LONG_POLL_TIMEOUT)
+    except (TypeError, ValueError):
+        timeout = LONG_POLL_TIMEOUT
+    slots = long_poll_slots
+    if slots is not None and not slots.acquire(blocking=False):
+        slots = None
+        timeout = 0
+    deadline = time.monotonic() + timeout
+
+    def group_info():
+        infos = {client_id: get_client_info(client_id) for client_id in statuses}
+        changed = any(
+            info["status"] != "ok" or info["msg"] != statuses[client_id]
+            for client_id, info in infos.items()
+        )
+        return infos, changed
+
+    try:
+        with status_changed:
+            infos, changed = group_info()
+            while not changed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                status_changed.wait(remaining)
+                infos, changed = group_info()
+    finally:
+        if slots is not None:
+            slots.release()
+    return jsonify({"status": "ok", "msg": "", "clients": infos})
+
+
+def new_client(client_info: ClientModel):
+    """validate a registration, returns `(client, msg)`, `client` is `None` if invalid"""
+    # a job never spans nodes, so in cluster mode only the local gpus of one node count
+    scope_size = len(set(client_info.gpus))
+    cluster = cluster_backend()
+    if cluster is not None:
+        # local gpus of the requested nodes -> cluster-wide gpus
+        nodes = client_info.nodes or list(cluster.nodes)
+        if client_info.mode == ClientMode.QUEUE and len(set(nodes)) != 1:
+            return None, "`queue` mode clients must name a single node"
+        try:
+            client_info.gpus = cluster.scope(client_info.gpus, nodes)
+        except ValueError as err:
+            return None, str(err)
+    # a gpu listed twice would never match the popcount of the gpu mask
+    client_info.gpus = list(dict.fromkeys(client_info.gpus))
     if len(client_info.gpus) <= 0:
-        status = "err"
-        msg = "gpus must not be empty!"
+        return None, "gpus must not be empty!"
     elif not ClientMode.has_value(client_info.mode):
-        status = "err"
-        msg = f"mode {client_info.mode} is not supported"
+        return None, f"mode {client_info.mode} is not supported"
     elif not check_gpus_existence(client_info.gpus):
-        status = "err"
-        msg = "check the gpus existence"
+        return None, "check the gpus existence"
     elif client_info.mode == ClientMode.SCHEDULE and not check_req_gpu_num(
         client_info.req_gpu_num
     ):
-        status = "err"
-        msg = "`req_gpu_num` is not valid"
-    else:
-        if client_info.id not in cc:
-            client = ClientModel(
-                id=client_info.id,
-                mode=client_info.mode,
-                status=ClientStatus.WAITING,
-                register_time=datetime.datetime.now(),
-                last_request_time=datetime.datetime.now(),
-                queue_num=len(cc.work_queue),
-                gpus=client_info.gpus,
-                req_gpu_num=client_info.req_gpu_num,
-            )
-            cc.work_queue[client.id] = client
+        return None, "`req_gpu_num` is not valid"
+    elif client_info.mode == ClientMode.SCHEDULE and client_info.req_gpu_num > scope_size:
+        # could never be granted, and would hold a backfill reservation forever
+        return None, f"`req_gpu_num` is larger than the {scope_size} gpus in scope"
+    elif client_info.walltime is not None and client_info.walltime <= 0:
+        return None, "`walltime` must be positive"
+    now = datetime.datetime.now()
+    client = ClientModel(
+        id=client_info.id,
+        mode=client_info.mode,
+        status=ClientStatus.WAITING,
+        register_time=now,
+        last_request_time=now,
+        gpus=client_info.gpus,
+        req_gpu_num=client_info.req_gpu_num,
+        walltime=client_info.walltime,
+        priority=client_info.priority,
+        nodes=client_info.nodes,
+    )
+    return client, ""
+
+
+@app.route("/client/register", methods=["POST"])
+@login_required
+def client_register():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"status": "err", "msg": "the body must be a json object"})
+    status = "err"
+    try:
+        client_info = ClientModel(**data)
+    except ValueError as err:
+        # pydantic's `ValidationError` is a `ValueError`
+        return jsonify({"status": status, "msg": str(err)})
+    client, msg = new_client(client_info)
+    if client is not None:
+        if cc.add(client):
+            work_trigger.notify("register")
             status = "ok"
         else:
-            status = "err"
             msg = f"client_id: {client_info.id} has been registered!"
     return jsonify({"status": status, "msg": msg})
 
 
+@app.route("/client/register_batch", methods=["POST"])
+@login_required
+def client_register_batch():
+    """register many clients (e.g. a hyperparameter sweep) in one request
+
+    The valid clients are added to the work queue at once, in the given
+    order. `results` has the `status` and `msg` of every client, in the
+    same order, so invalid or duplicate ones do not fail the others.
+    """
+    data = request.get_json(silent=True)
+    items = data.get("clients") if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return jsonify({"status": "err", "msg": "`clients` must be a list"})
+    results = []
+    clients = []
+    for item in items:
+        try:
+            client, msg = new_client(ClientModel(**item))
+        except (TypeError, ValueError) as err:
+            # pydantic's `ValidationError` is a `ValueError`
+            client, msg = None, str(err)
+        client_id = item.get("id") if isinstance(item, dict) else None
+        results.append({"id": client_id, "status": "err", "msg": msg})
+        if client is not None:
+            clients.append((len(results) - 1, client))
+    added = cc.add_many([client for _, client in clients])
+    for (index, client), ok in zip(clients, added):
+        if ok:
+            results[index]["status"] = "ok"
+        else:
+            results[index]["msg"] = f"client_id: {client.id} has been registered!"
+    if any(added):
+        work_trigger.notify("register")
+    return jsonify({"status": "ok", "msg": "", "results": results})
+
+
+@app.route("/node/report", methods=["POST"])
+@login_required
+def node_report():
+    """gpu status of a node, pushed by `python -m watchmen.agent` in cluster mode"""
+    cluster = cluster_backend()
+    if cluster is None:
+        return jsonify({"status": "err", "msg": "the server is not running with `--gpu_backend cluster`"})
+    data = request.json
+    try:
+        changed = cluster.report(data["node"], data["gpus"], data.get("topology"))
+    except (KeyError, TypeError, ValueError) as err:
+        return jsonify({"status": "err", "msg": str(err)})
+    if changed:
+        logger.info(f"node {data['node']} joined or changed its topology")
+        if isinstance(gpu_info.allocator, BestFitAllocator):
+            gpu_info.allocator.topology = cluster.topology()
+        # the new gpus are schedulable right away
+        refresh_gpu_info()
+    return jsonify({"status": "ok", "msg": ""})
+
+
 @app.route("/client/cancel", methods=["POST"])
 @login_required
 def client_cancel():
@@ -230,37 +621,147 @@ def client_cancel():
     msg = ""
     try:
         client_id = request.json.get("id")
-        if client_id in cc:
-            client = cc[client_id]
-            if client.status in [ClientStatus.WAITING, ClientStatus.READY]:
-                client.status = ClientStatus.CANCELLED
-                cc.mark_finished(client_id)
-                status = "ok"
-                msg = f"Client {client_id} cancelled successfully"
+        with cc.lock:
+            client, finished = cc.get(client_id)
+            if client is not None and not finished:
+                if client.status in [ClientStatus.WAITING, ClientStatus.READY]:
+                    client.status = ClientStatus.CANCELLED
+                    cc.mark_finished(client_id)
+                    status = "ok"
+                    msg = f"Client {client_id} cancelled successfully"
+                else:
+                    status = "err"
+                    msg = f"Client {client_id} is not waiting"
             else:
                 status = "err"
-                msg = f"Client {client_id} is not waiting"
-        else:
-            status = "err"
-            msg = f"Client {client_id} not found"
+                msg = f"Client {client_id} not found"
+        if status == "ok":
+            work_trigger.notify("cancel")
+            notify_status_changed()
     except Exception as err:
         status = "err"
         msg = str(err)
     return jsonify({"status": status, "msg": msg})
 
 
+CLIENT_FIELDS = set(ClientModel.__fields__)
+DELTA_EXCLUDE = {"queue_num"}
+
+
+def parse_int_arg(name: str):
+    value = request.args.get(name)
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"`{name}` must be an integer, got: {value}")
+
+
+def parse_client_query():
+    """filters and field projection shared by `/show/work`, `/show/finished` and `/api`
+
+    - `user`: comma separated users, matched against the `user@` prefix of client ids
+    - `status`, `mode`: comma separated values
+    - `gpu`: comma separated gpu indices, a client matches if it requests or got any of them
+    - `fields`: comma separated client fields to return
+    """
+
+    def split_arg(name):
+        value = request.args.get(name)
+        return set(x for x in value.split(",") if x) if value else None
+
+    users = split_arg("user")
+    statuses = split_arg("status")
+    modes = split_arg("mode")
+    gpus = split_arg("gpu")
+    if gpus is not None:
+        try:
+            gpus = set(map(int, gpus))
+        except ValueError:
+            raise ValueError(f"`gpu` must be integers, got: {request.args.get('gpu')}")
+    fields = split_arg("fields")
+    if fields is not None and not fields <= CLIENT_FIELDS:
+        raise ValueError(f"unknown fields: {sorted(fields - CLIENT_FIELDS)}")
+
+    predicate = None
+    if users or statuses or modes or gpus:
+
+        def predicate(client):
+            if users and client_user(client.id) not in users:
+                return False
+            # enum members hash by name, compare their values
+            if statuses and getattr(client.status, "value", client.status) not in statuses:
+                return False
+            if modes and getattr(client.mode, "value", client.mode) not in modes:
+                return False
+            if gpus and not (gpus & set(client.gpus) or gpus & set(client.available_gpus)):
+                return False
+            return True
+
+    return predicate, fields
+
+
+def dump_clients(clients, fields=None, predicate=None, exclude=None):
+    if predicate is not None:
+        clients = [x for x in clients if predicate(x)]
+    if fields:
+        return [x.dict(include=fields, exclude=exclude) for x in clients]
+    return [x.dict(exclude=exclude) for x in clients]
+
+
+def dump_changes(changes, fields=None, predicate=None):
+    """the changed clients and removed ids of `ClientCollection.changes_since`
+
+    `queue_num` is left out: the clients behind one that left the queue move
+    up without being changed, their position is their order in the queue.
+    """
+    changed, removed = changes
+    return {
+        "work_queue": dump_clients(changed["work"], fields, predicate, DELTA_EXCLUDE),
+        "finished_queue": dump_clients(changed["finished"], fields, predicate, DELTA_EXCLUDE),
+        "removed": {"work_queue": removed["work"], "finished_queue": removed["finished"]},
+    }
+
+
+def list_clients(queue: str, cursor_arg: str = "cursor"):
+    """one page of a queue according to the request args, returns `(clients, next_cursor)`"""
+    predicate, fields = parse_client_query()
+    clients, next_cursor = cc.page(
+        queue,
+        after=parse_int_arg(cursor_arg),
+        limit=parse_int_arg("limit"),
+        predicate=predicate,
+    )
+    return dump_clients(clients, fields), next_cursor
+
+
+def get_gpu_msg():
+    msg = gpu_info.gs.jsonify()
+    msg["query_time"] = str(msg["query_time"])
+    return msg
+
+
+def state_etag():
+    # the epoch tells a restarted server from the one that issued an old etag
+    return f"{cc.epoch}-{cc.version}-{gpu_info.version}"
+
+
 @app.route("/show/work", methods=["GET"])
 @login_required
 def show_work():
     status = ""
     msg = ""
+    next_cursor = None
     try:
         status = "ok"
-        msg = [x.dict() for x in cc.work_queue.values()]
+        msg, next_cursor = list_clients("work")
     except Exception as err:
         status = "err"
         msg = str(err)
-    return jsonify({"status": status, "msg": msg})
+    return jsonify(
+        {"status": status, "msg": msg, "next_cursor": next_cursor, "version": cc.version_token()}
+    )
 
 
 @app.route("/show/finished", methods=["GET"])
@@ -268,13 +769,16 @@ def show_work():
 def show_finished():
     status = ""
     msg = ""
+    next_cursor = None
     try:
         status = "ok"
-        msg = [x.dict() for x in cc.finished_queue.values()]
+        msg, next_cursor = list_clients("finished")
     except Exception as err:
         status = "err"
         msg = str(err)
-    return jsonify({"status": status, "msg": msg})
+    return jsonify(
+        {"status": status, "msg": msg, "next_cursor": next_cursor, "version": cc.version_token()}
+    )
 
 
 @app.route("/show/gpus", methods=["GET"])
@@ -284,8 +788,7 @@ def show_gpus():
     msg = ""
     try:
         status = "ok"
-        msg = gpu_info.gs.jsonify()
-        msg["query_time"] = str(msg["query_time"])
+        msg = get_gpu_msg()
     except Exception as err:
         status = "err"
         msg = str(err)
@@ -295,22 +798,241 @@ def show_gpus():
 @app.route("/api", methods=["GET", "OPTIONS"])
 @login_required
 def api():
+    """gpu status with the work and finished queues
+
+    - the `ETag` changes with the state, `If-None-Match` gets a `304` if nothing changed
+    - `since=<version>`: only the clients changed after `version` (`delta: true`,
+        without `queue_num`), ids that left a queue are listed in `removed`. `version` is the
+        `version` of an earlier response. A full response is returned
+        (`delta: false`) if `since` is too old, or from another run of the
+        server (e.g. before a restart)
+    - `limit`, `work_cursor`, `finished_cursor`: pagination of each queue
+    - filters and `fields` like `/show/work`
+    """
     if request.method == "OPTIONS":
         response = make_response()
+        response.headers["Access-Control-Allow-Origin"] = "*"
+        return response
+
+    etag = state_etag()
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
     else:
-        gpu_info = show_gpus()
-        gpu_msg = gpu_info.json["msg"]
-        work_info = show_work()
-        work_msg = work_info.json["msg"]
-        finished_info = show_finished()
-        finished_msg = finished_info.json["msg"]
-        response = jsonify(
-            {"gpu": gpu_msg, "work_queue": work_msg, "finished_queue": finished_msg}
-        )
+        try:
+            version = cc.version
+            since = cc.parse_version_token(request.args.get("since"))
+            changes = cc.changes_since(since) if since is not None else None
+            if changes is not None:
+                predicate, fields = parse_client_query()
+                data = {"delta": True, **dump_changes(changes, fields, predicate)}
+            else:
+                work_msg, work_cursor = list_clients("work", "work_cursor")
+                finished_msg, finished_cursor = list_clients("finished", "finished_cursor")
+                data = {
+                    "delta": False,
+                    "work_queue": work_msg,
+                    "finished_queue": finished_msg,
+                    "next_cursor": {"work_queue": work_cursor, "finished_queue": finished_cursor},
+                }
+            data["gpu"] = get_gpu_msg()
+            data["version"] = cc.version_token(version)
+            data["gpu_version"] = gpu_info.version
+        except ValueError as err:
+            return jsonify({"status": "err", "msg": str(err)}), 400
+        response = jsonify(data)
+        response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
     response.headers["Access-Control-Allow-Origin"] = "*"
     return response
 
 
+def parse_event_id(event_id):
+    """`(version, gpu_version)` of an `/events` id like `<epoch>.12-3` (or a bare
+    `since=<epoch>.12`), `(None, None)` if it cannot be parsed or is from another epoch"""
+    token, _, gpu_version = (event_id or "").partition("-")
+    version = cc.parse_version_token(token)
+    try:
+        return version, int(gpu_version) if version is not None and gpu_version else None
+    except ValueError:
+        return None, None
+
+
+@app.route("/events", methods=["GET"])
+@login_required
+def events():
+    """Server-Sent Events stream of the dashboard state
+
+    - `full`: the whole state like `/api`, sent on connect
+    - `delta`: changed clients and removed ids like `/api?since=`
+    - `gpu`: the gpu status, sent when a displayed value changes
+
+    Every event carries the client and gpu versions as its id, so a
+    reconnecting `EventSource` resumes with deltas through the
+    `Last-Event-ID` header. A `full` event is sent instead if the id cannot
+    be parsed or is not a version of this run of the server (see
+    `ClientCollection.epoch`).
+    Filters and `fields` like `/show/work` apply to the clients.
+    """
+    try:
+        predicate, fields = parse_client_query()
+    except ValueError as err:
+        return jsonify({"status": "err", "msg": str(err)}), 400
+    since, since_gpu = parse_event_id(
+        request.headers.get("Last-Event-ID") or request.args.get("since")
+    )
+
+    slots = event_stream_slots
+    if slots is not None and not slots.acquire(blocking=False):
+        return jsonify({"status": "err", "msg": "too many event streams"}), 503
+
+    def format_event(event, data, version, gpu_version):
+        event_id = f"{cc.version_token(version)}-{gpu_version}"
+        return f"id: {event_id}\nevent: {event}\ndata: {app.json.dumps(data)}\n\n"
+
+    def stream():
+        try:
+            version = since
+            gpu_version = since_gpu
+            yield f"retry: {EVENT_STREAM_RETRY}\n\n"
+            while True:
+                with cc.changed:
+                    if cc.version == version and gpu_info.version == gpu_version:
+                        cc.changed.wait(EVENT_STREAM_HEARTBEAT)
+                    new_version = cc.version
+                    changes = None if version is None else cc.changes_since(version)
+                snapshot = gpu_info.get_snapshot()
+                if changes is None:
+                    data = {
+                        "work_queue": dump_clients(cc.work_clients(), fields, predicate),
+                        "finished_queue": dump_clients(cc.finished_clients(), fields, predicate),
+                        "gpu": get_gpu_msg(),
+                    }
+                    gpu_version = snapshot.version
+                    yield format_event("full", data, new_version, gpu_version)
+                else:
+                    sent = False
+                    if snapshot.version != gpu_version:
+                        # sent first, so the id of every event is the state the client has
+                        gpu_version = snapshot.version
+                        yield format_event("gpu", get_gpu_msg(), version, gpu_version)
+                        sent = True
+                    if new_version != version:
+                        data = dump_changes(changes, fields, predicate)
+                        yield format_event("delta", data, new_version, gpu_version)
+                        sent = True
+                    if not sent:
+                        # heartbeat, also detects closed connections
+                        yield ": keep-alive\n\n"
+                version = new_version
+        finally:
+            if slots is not None:
+                slots.release()
+
+    response = Response(stream_with_context(stream()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+@login_required
+def metrics():
+    """scheduler and gpu internals in the Prometheus text format
+
+    Nothing here takes the scheduler lock: the counters are per thread (see
+    `watchmen.metrics`) and the queues and the gpu snapshot are copied as is.
+    """
+    # `list(...)` of a dict view is a single C call, so it is consistent without the lock
+    queues = [("work", list(cc.work_queue.values())), ("finished", list(cc.finished_queue.values()))]
+    clients = {}
+    for queue, queue_clients in queues:
+        for client in queue_clients:
+            key = (queue, client.status.value, client.mode.value, client_user(client.id))
+            clients[key] = clients.get(key, 0) + 1
+    lines = render_samples(
+        "watchmen_clients",
+        "gauge",
+        "number of clients by queue, status, mode and user",
+        ("queue", "status", "mode", "user"),
+        sorted(clients.items()),
+    )
+    lines += render_samples(
+        "watchmen_fair_share_usage_gpu_seconds",
+        "gauge",
+        "decayed gpu-seconds charged to each user, lower users are scheduled first",
+        ("user",),
+        sorted(((user,), usage) for user, usage in fair_share.usages().items()),
+    )
+
+    backend_name = gpu_info.backend.name if gpu_info.backend is not None else "default"
+    lines += render_samples(
+        "watchmen_gpu_queries_total",
+        "counter",
+        "queries of the gpu backend, e.g. NVML scans",
+        ("backend",),
+        [((backend_name,), gpu_info.num_queries)],
+    )
+    snapshot = gpu_info.snapshot
+    gpus = [] if snapshot is None else list(zip(snapshot.gpus, snapshot.free))
+    gpu_samples = {
+        "utilization_ratio": ("gpu utilization, 0 to 1", lambda g, _: (g.utilization or 0) / 100),
+        "memory_used_bytes": ("used gpu memory", lambda g, _: (g.memory_used or 0) * 1024 * 1024),
+        "memory_total_bytes": ("total gpu memory", lambda g, _: (g.memory_total or 0) * 1024 * 1024),
+        "processes": ("number of processes on the gpu", lambda g, _: len(g.processes)),
+        "free": ("1 if the gpu may be granted", lambda _, free: int(free)),
+    }
+    for suffix, (help, value) in gpu_samples.items():
+        lines += render_samples(
+            f"watchmen_gpu_{suffix}",
+            "gauge",
+            f"{help}, from the latest gpu status query",
+            ("gpu", "uuid"),
+            [((gpu.index, gpu.uuid), value(gpu, free)) for gpu, free in gpus],
+        )
+
+    for metric in (
+        REQUEST_DURATION,
+        CHECK_WORK_DURATION,
+        CHECK_WORK_SKIPPED,
+        CHECK_GPU_INFO_DURATION,
+        WAIT_DURATION,
+    ):
+        lines += metric.render()
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/debug/profile", methods=["GET"])
+@login_required
+def debug_profile():
+    """sample the stacks of the server threads for `seconds` (default 10, at most 60),
+    in the folded format of `flamegraph.pl` and speedscope. `thread` only keeps the
+    threads with it in their name, e.g. `check` for the scheduler thread"""
+    if not PROFILE:
+        return jsonify({"status": "err", "msg": "start the server with `--profile`"}), 404
+    try:
+        seconds = float(request.args.get("seconds", 10))
+        interval = float(request.args.get("interval", 0.005))
+    except ValueError:
+        return jsonify({"status": "err", "msg": "`seconds` and `interval` must be numbers"}), 400
+    counts = sample_stacks(
+        seconds, interval=max(interval, 0.001), thread_filter=request.args.get("thread")
+    )
+    return Response(render_folded(counts), mimetype="text/plain")
+
+
+@app.route("/debug/passes", methods=["GET"])
+@login_required
+def debug_passes():
+    """timings of the phases of the recent scheduling passes, newest first"""
+    if not PROFILE:
+        return jsonify({"status": "err", "msg": "start the server with `--profile`"}), 404
+    try:
+        limit = parse_int_arg("limit")
+    except ValueError as err:
+        return jsonify({"status": "err", "msg": str(err)}), 400
+    return jsonify({"status": "ok", "msg": "", "passes": pass_log.jsonify(limit)})
+
+
 @app.route("/", methods=["GET"])
 def index():
     global APP_PORT
@@ -338,118 +1060,354 @@ def old_index():
     )
 
 
+@observed(CHECK_GPU_INFO_DURATION)
 def check_gpu_info():
-    gpu_info.new_query()
-    logger.info("check gpu info")
+    previous = gpu_info.snapshot
+    snapshot = gpu_info.new_query()
+    logger.info(f"check gpu info, free gpus: {[i for i, free in enumerate(snapshot.free) if free]}")
+    if previous is None or previous.free != snapshot.free:
+        work_trigger.notify("gpu")
+    if previous is None or previous.version != snapshot.version:
+        # push the new gpu status to the `/events` streams
+        cc.notify_changed()
+
+
+def refresh_gpu_info():
+    """run the periodic `check_gpu_info` job now, instead of querying on the calling thread"""
+    job = gpu_info_job
+    if job is not None:
+        job.modify(next_run_time=datetime.datetime.now())
+
+
+def allocate_schedule(client, gpu_mask, snapshot, reserved_mask, backfill, available_gpus):
+    """allocate the gpus of a `schedule` mode client around the gpus reserved earlier in the pass,
+    `gpu_mask` is the bitmask of its scope. returns `(ok, gpus)`"""
+    exclude_mask = reserved_mask
+    if backfill is not None:
+        exclude_mask |= backfill.reserved_mask
+    if not exclude_mask:
+        # nothing reserved, the allocation of the first check holds
+        return True, available_gpus
+    ok, gpus = gpu_info.is_req_gpu_num_satisfied(
+        client.gpus,
+        client.req_gpu_num,
+        snapshot=snapshot,
+        exclude_mask=exclude_mask,
+        scope_mask=gpu_mask,
+    )
+    if not ok and exclude_mask != reserved_mask and backfill.fits_before_shadow(client):
+        # short enough to run on the reserved gpus before the reservation starts
+        ok, gpus = gpu_info.is_req_gpu_num_satisfied(
+            client.gpus,
+            client.req_gpu_num,
+            snapshot=snapshot,
+            exclude_mask=reserved_mask,
+            scope_mask=gpu_mask,
+        )
+    return ok, gpus
+
+
+def evaluate_client(client, gpu_mask, snapshot):
+    """whether a waiting client could run on the free gpus of `snapshot`,
+    regardless of the other clients. returns `(ok, available_gpus)`"""
+    ok = False
+    available_gpus = []
+    try:
+        if client.mode not in ("queue", "schedule"):
+            raise RuntimeError(f"Not supported mode: {client.mode}")
+        if gpu_mask >> len(snapshot):
+            raise IndexError(f"gpus: {client.gpus} do not exist")
+        if client.mode == "queue":
+            ok = (gpu_mask & ~snapshot.free_mask) == 0
+            available_gpus = client.gpus
+        elif popcount(gpu_mask & snapshot.free_mask) >= client.req_gpu_num:
+            ok, available_gpus = gpu_info.is_req_gpu_num_satisfied(
+                client.gpus, client.req_gpu_num, snapshot=snapshot, scope_mask=gpu_mask
+            )
+    except IndexError as err:
+        client.msg = str(err)
+    except ValueError as err:
+        client.msg = str(err)
+    except RuntimeError as err:
+        client.msg = str(err)
+    return ok, available_gpus
 
 
+@observed(CHECK_WORK_DURATION)
 def check_work(queue_timeout):
+    timer = PassTimer(time.perf_counter()) if PROFILE else None
+    # all availability checks in this pass are evaluated against a single snapshot
+    snapshot = gpu_info.get_snapshot()
+    free_mask = snapshot.free_mask
+    pass_start = datetime.datetime.now()
+    cache = scheduling_cache
+    version = cc.version
+    if cache.is_unchanged(cc, free_mask, version, pass_start):
+        # nothing that could change a decision happened since the last pass
+        CHECK_WORK_SKIPPED.inc()
+        return
     logger.info("regular check")
+    if timer is not None:
+        timer.mark("gpu_query")
+    dirty = None  # ids of the clients to evaluate again, `None` for all
+    if cache.collection is cc and cache.free_mask is not None:
+        changes = cc.changes_since(cache.version)
+        if changes is not None:
+            changed, removed = changes
+            for client_id in removed["work"]:
+                cache.drop(client_id)
+            dirty = cache.affected(free_mask ^ cache.free_mask)
+            dirty.update(client.id for client in changed["work"])
+    if dirty is None:
+        cache.reset(cc)
+    # timeouts are only checked once the oldest `last_request_time` may have expired
+    check_timeouts = cache.deadline is None or pass_start >= cache.deadline
+    oldest_request_time = None
+
     marked_finished = []
-    reserved_gpus = set()
+    status_updated = False
+    num_evaluated = 0
+    num_granted = 0
+    # gpus are bitmasks, bit `i` is gpu `i`, see `ClientCollection.gpu_masks`
+    gpu_masks = cc.gpu_masks
+    reserved_mask = 0
+    held_gpus = {}  # user -> number of gpus of its `ready` clients
+    ready_clients = []
     client_list = []
     queue_num = 0
-    for client_id, client in cc.work_queue.items():
-        time_delta = datetime.datetime.now() - client.last_request_time
-        logger.info(
-            f"client: {client.id}, time_delta.seconds: {time_delta.seconds}, time_delta: {time_delta}"
-        )
-        if time_delta.seconds > queue_timeout:
-            if client.status != ClientStatus.READY:
-                client.status = ClientStatus.TIMEOUT
-            else:
-                client.status = ClientStatus.OK
-            # invalid client
-            client.queue_num = -1
-            marked_finished.append(client_id)
-            continue
-        client.queue_num = queue_num
+    # evaluate on a snapshot of the work queue without holding the lock,
+    # status changes are applied under the lock afterwards
+    for client in cc.work_clients():
+        client_id = client.id
+        if check_timeouts:
+            time_delta = pass_start - client.last_request_time
+            logger.info(
+                f"client: {client.id}, time_delta.seconds: {time_delta.seconds}, time_delta: {time_delta}"
+            )
+            if time_delta.seconds > queue_timeout:
+                marked_finished.append(client)
+                cache.drop(client_id)
+                continue
+            if oldest_request_time is None or client.last_request_time < oldest_request_time:
+                oldest_request_time = client.last_request_time
+        if client.queue_num != queue_num:
+            # derived from the position, so set in place: recording it as a change would
+            # put every client behind a finished one into the deltas and re-evaluate it
+            client.queue_num = queue_num
         ok = False
         available_gpus = []
+        gpu_mask = gpu_masks.get(client_id, 0)
         if client.status == ClientStatus.READY:
-            reserved_gpus |= set(client.available_gpus)
+            reserved_mask |= gpus_to_mask(client.available_gpus)
+            ready_clients.append(client)
+            user = client_user(client_id)
+            held_gpus[user] = held_gpus.get(user, 0) + len(client.available_gpus)
+            cache.drop(client_id)
+        elif dirty is None or client_id in dirty or client_id not in cache.results:
+            ok, available_gpus = evaluate_client(client, gpu_mask, snapshot)
+            num_evaluated += 1
+            cache.put(client_id, gpu_mask, (ok, available_gpus))
         else:
-            try:
-                if client.mode == "queue":
-                    ok = gpu_info.is_gpus_available(client.gpus)
-                    available_gpus = client.gpus
-                elif client.mode == "schedule":
-                    ok, available_gpus = gpu_info.is_req_gpu_num_satisfied(
-                        client.gpus, client.req_gpu_num
-                    )
-                else:
-                    raise RuntimeError(f"Not supported mode: {client.mode}")
-            except IndexError as err:
-                client.msg = str(err)
-            except ValueError as err:
-                client.msg = str(err)
-            except RuntimeError as err:
-                client.msg = str(err)
-
-        client_list.append([client_id, client, ok, set(available_gpus)])
+            ok, available_gpus = cache.results[client_id]
+
+        # clients that cannot be assigned are only needed as a candidate of the backfill reservation
+        if ok or (BACKFILL and Backfill.num_required(client) > 1):
+            client_list.append((client_id, client, gpu_mask, ok, available_gpus))
         queue_num += 1
 
-    # post check and assignment, and make sure gpus of `ready` clients will not be assigned to the others
-    for client_id, client, ok, available_gpu_set in client_list:
-        if (
-            ok
-            and len(available_gpu_set) > 0
-            and len(available_gpu_set & reserved_gpus) < 1
+    if check_timeouts:
+        # `last_request_time` only moves forward, so no client times out before
+        # the oldest one does. `timedelta.seconds` is truncated, hence the extra second
+        oldest_request_time = oldest_request_time or pass_start
+        cache.deadline = oldest_request_time + datetime.timedelta(seconds=queue_timeout + 1)
+    cache.free_mask = free_mask
+    # changes during this pass (including its own) are seen by the next one
+    cache.version = version
+
+    if timer is not None:
+        timer.mark("evaluate")
+    with cc.lock:
+        if timer is not None:
+            timer.mark("lock_wait")
+        now = datetime.datetime.now()
+        backfill = Backfill(ready_clients, now=now) if BACKFILL else None
+        # post check and assignment, and make sure gpus of `ready` clients will not be assigned to the others.
+        # clients are visited by priority class and fair share, see `FairShare`
+        has_quotas = fair_share.has_quotas()
+        cluster = cluster_backend()
+        for client_id, client, gpu_mask, ok, available_gpus in fair_share.order(
+            client_list, client_of=lambda item: item[1]
         ):
-            client.status = ClientStatus.READY
-            client.available_gpus = available_gpus
-            reserved_gpus |= set(client.available_gpus)
+            if not ok and (backfill is None or backfill.head is not None):
+                # neither assignable nor a candidate for the reservation
+                continue
+            if client_id not in cc or client.status != ClientStatus.WAITING:
+                continue
+            num_required = Backfill.num_required(client)
+            if has_quotas:
+                user = client_user(client_id)
+                quota = fair_share.quota(user)
+                if quota is not None and held_gpus.get(user, 0) + num_required > quota:
+                    # over quota, neither assigned nor reserved for
+                    continue
+            available_mask = 0
+            if ok and popcount(gpu_mask & free_mask & ~reserved_mask) < num_required:
+                # not enough gpus left in scope after the reservations of this pass
+                ok = False
+            if ok and client.mode == "schedule":
+                ok, available_gpus = allocate_schedule(
+                    client, gpu_mask, snapshot, reserved_mask, backfill, available_gpus
+                )
+                available_mask = gpus_to_mask(available_gpus) if ok else 0
+            elif ok:
+                available_mask = gpu_mask
+                if backfill is not None and not backfill.allows(client, available_mask):
+                    ok = False
+            if ok and available_mask and not available_mask & reserved_mask:
+                client.status = ClientStatus.READY
+                client.available_gpus = available_gpus
+                client.ready_time = now
+                if client.register_time is not None:
+                    WAIT_DURATION.observe(
+                        (now - client.register_time).total_seconds(), client.mode.value
+                    )
+                if cluster is not None:
+                    client.node, _ = cluster.localize(available_gpus)
+                cc.update(client)
+                status_updated = True
+                num_granted += 1
+                reserved_mask |= available_mask
+                user = client_user(client_id)
+                held_gpus[user] = held_gpus.get(user, 0) + len(available_gpus)
+                fair_share.grant(client)
+                # the gpus may look free until the job has started
+                gpu_info.history.hold(available_gpus)
+                if backfill is not None:
+                    backfill.hold(client)
+                logger.info(
+                    f"client: {client.id} is ready, available gpus: {client.available_gpus}"
+                )
+            elif backfill is not None and backfill.reserve(client, free_mask):
+                logger.info(
+                    f"client: {client.id} is blocked, gpus {backfill.reserved} "
+                    f"are reserved, expected to be free at: {backfill.shadow_time}"
+                )
+
+        if timer is not None:
+            timer.mark("assign")
+        for client in marked_finished:
+            if client.id not in cc:
+                # cancelled in the meantime
+                continue
+            if client.status != ClientStatus.READY:
+                client.status = ClientStatus.TIMEOUT
+            else:
+                client.status = ClientStatus.OK
+            # invalid client
+            client.queue_num = -1
             logger.info(
-                f"client: {client.id} is ready, available gpus: {client.available_gpus}"
+                f"client {client.id} marked as finished, status: {client.status}"
             )
-
-    for client_id in marked_finished:
-        logger.info(f"client {client.id} marked as finished, status: {client.status}")
-        cc.mark_finished(client_id)
+            cc.mark_finished(client.id)
+    if marked_finished:
+        # gpus reserved by finished clients are released, re-check the waiting ones
+        work_trigger.notify("exit")
+    if marked_finished or status_updated:
+        notify_status_changed()
+    if timer is not None:
+        timer.mark("finish")
+        timer.count("clients", queue_num)
+        timer.count("evaluated", num_evaluated)
+        timer.count("granted", num_granted)
+        timer.count("finished", len(marked_finished))
+        pass_log.add(timer)
 
 
 def check_finished(status_queue_keep_time):
     logger.info("check out-dated finished clients")
-    marked_delete_ids = []
-    for client_id, client in cc.finished_queue.items():
-        delta = datetime.datetime.now() - client.last_request_time
-        if (delta.days * 24 + delta.seconds / 3600) >= status_queue_keep_time:
-            marked_delete_ids.append(client_id)
-    for client_id in marked_delete_ids:
-        cc.finished_queue.pop(client_id)
-        logger.info(f"remove {client.id} from finished queue")
+    before = datetime.datetime.now() - datetime.timedelta(hours=status_queue_keep_time)
+    # O(expired), only the oldest entries of the finished index are visited
+    expired_ids = cc.expire_finished(before)
+    for client_id in expired_ids:
+        ping_responses.pop(client_id, None)
+        logger.info(f"remove {client_id} from finished queue")
+    if cc.store is not None and (cc.store.expire(before) > 0 or expired_ids):
+        cc.store.compact()
 
 
 def regular_check(request_interval, queue_timeout, status_queue_keep_time):
-    scheduler = BlockingScheduler(logger=apscheduler_logger)
-    scheduler.add_job(
+    global gpu_info_job
+    scheduler = BackgroundScheduler(logger=apscheduler_logger)
+    gpu_info_job = scheduler.add_job(
         check_gpu_info,
         trigger="interval",
         seconds=request_interval,
         next_run_time=datetime.datetime.now(),
     )
-    scheduler.add_job(
-        check_work,
-        trigger="interval",
-        seconds=request_interval * 5,
-        args=(queue_timeout,),
-        next_run_time=datetime.datetime.now(),
-    )
+    if cc.store is not None:
+        # changes are written to the state file in batches, one transaction per interval
+        scheduler.add_job(cc.store.flush, trigger="interval", seconds=request_interval)
     if status_queue_keep_time != -1:
+        # cheap enough to run often, so clients are evicted soon after they expire
         scheduler.add_job(
             check_finished,
             trigger="interval",
-            hours=status_queue_keep_time,
+            minutes=1,
             args=(status_queue_keep_time,),
             next_run_time=datetime.datetime.now(),
         )
     scheduler.start()
+    # `check_work` is driven by events, the old `request_interval * 5` timer is the fallback
+    work_trigger.fallback_interval = request_interval * 5
+    work_trigger.notify("start")
+    try:
+        work_trigger.run(check_work, queue_timeout)
+    finally:
+        gpu_info_job = None
+        scheduler.shutdown(wait=False)
 
 
-def api_server(host, port):
-    global APP_PORT
+def run_worker(target, *args):
+    """run `target` and wake up the supervisor when it exits for whatever reason"""
+    try:
+        target(*args)
+    except Exception:
+        logger.exception(f"worker {threading.current_thread().name} crashed")
+    finally:
+        worker_exited.set()
+
+
+def api_server(host, port, server="flask", workers=64):
+    """serve the api in this process, so the scheduler state is shared by all the handlers
+
+    - `flask`: werkzeug development server, one new thread per request
+    - `waitress`: production wsgi server with a pool of `workers` threads,
+        at most half of them can be held by `/client/wait` long polls
+        and a quarter by `/events` streams
+    """
+    global APP_PORT, long_poll_slots, event_stream_slots
     APP_PORT = port
-    app.run(host=host, port=port)
+    if server == "waitress":
+        try:
+            from waitress import serve
+        except ImportError:
+            raise RuntimeError(
+                "`waitress` is not installed, try `pip install gpu-watchmen[server]` or `--server flask`"
+            )
+        long_poll_slots = threading.BoundedSemaphore(max(1, workers // 2))
+        event_stream_slots = threading.BoundedSemaphore(max(1, workers // 4))
+        serve(
+            app,
+            host=host,
+            port=int(port),
+            threads=workers,
+            connection_limit=max(100, workers * 8),
+            ident="watchmen",
+        )
+    elif server == "flask":
+        app.run(host=host, port=port, threaded=True)
+    else:
+        raise ValueError(f"server: {server} is not supported")
 
 
 if __name__ == "__main__":
@@ -479,13 +1437,235 @@ if __name__ == "__main__":
             "set `-1` to keep all clients' status"
         ),
     )
+    parser.add_argument(
+        "--max_finished",
+        type=int,
+        default=10000,
+        help=(
+            "max number of finished clients kept in memory, older ones are only kept "
+            "in the state file. set `-1` to keep all of them in memory"
+        ),
+    )
+    parser.add_argument(
+        "--state_file",
+        type=str,
+        default=STATE_FILE,
+        help=(
+            "sqlite file to persist the work and finished queues across restarts. "
+            "set to 'none' to keep the state in memory only"
+        ),
+    )
     parser.add_argument(
         "--token",
         type=str,
         default="",
         help="Authentication token for accessing the web interface. If empty, a token will be generated. Set to 'none' to disable authentication.",
     )
+    parser.add_argument(
+        "--server",
+        type=str,
+        choices=["flask", "waitress"],
+        default="flask",
+        help=(
+            "wsgi server for the api. `flask` is the development server, "
+            "`waitress` is a multi-threaded production server"
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=64,
+        help="number of worker threads for `--server waitress`",
+    )
+    parser.add_argument(
+        "--long_poll_timeout",
+        type=int,
+        default=LONG_POLL_TIMEOUT,
+        help=(
+            "max seconds a `/client/wait` request is held, "
+            "should be well below `queue_timeout`"
+        ),
+    )
+    parser.add_argument(
+        "--gpu_backend",
+        type=str,
+        choices=sorted(BACKENDS),
+        default=os.environ.get("WATCHMEN_GPU_BACKEND", "nvml"),
+        help=(
+            "source of gpu status. `nvml` only fetches what scheduling and the dashboard "
+            "need, and looks up the user and command of each process once, `gpustat` "
+            "resolves all the processes on every query, `simulated` is a fake cluster for testing without gpus, "
+            "`cluster` schedules the gpus of several nodes reported by "
+            "`python -m watchmen.agent` (default from env `WATCHMEN_GPU_BACKEND`)"
+        ),
+    )
+    parser.add_argument(
+        "--node_timeout",
+        type=float,
+        default=30,
+        help=(
+            "`--gpu_backend cluster`: the gpus of a node that has not reported for "
+            "this many seconds are treated as busy"
+        ),
+    )
+    parser.add_argument(
+        "--simulated_gpus",
+        type=int,
+        default=8,
+        help="number of gpus for `--gpu_backend simulated`",
+    )
+    parser.add_argument(
+        "--max_snapshot_age",
+        type=float,
+        default=-1,
+        help=(
+            "max age (seconds) of the gpu snapshot used by a scheduling pass, "
+            "an older one is re-queried. set `-1` to use `request_interval * 2`"
+        ),
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=(
+            "enable `/debug/profile?seconds=N` (sampled stacks of the scheduler and api "
+            "threads, flamegraph format) and `/debug/passes` (timings of the phases of "
+            "the recent scheduling passes)"
+        ),
+    )
+    parser.add_argument(
+        "--request_log_interval",
+        type=float,
+        default=60,
+        help=(
+            "seconds between two summary lines of the `/client/ping` and `/client/wait` "
+            "requests, the single requests are only logged at DEBUG level"
+        ),
+    )
+    parser.add_argument(
+        "--min_free_time",
+        type=float,
+        default=10,
+        help=(
+            "seconds a gpu has to look free in every gpu status query before it is "
+            "granted, so gpus idle between the epochs of a running job are not handed out. "
+            "set `0` to trust a single query"
+        ),
+    )
+    parser.add_argument(
+        "--grant_hold",
+        type=float,
+        default=60,
+        help=(
+            "seconds the gpus granted to a client are not granted again, even if they "
+            "look free, so its job has the time to start"
+        ),
+    )
+    parser.add_argument(
+        "--allocator",
+        type=str,
+        choices=sorted(ALLOCATORS),
+        default="best_fit",
+        help=(
+            "gpu allocation of `schedule` mode clients. `best_fit` packs jobs into the "
+            "tightest nvlink/pcie island to keep large islands free for multi-gpu jobs, "
+            "`first_fit` takes the first free gpus in scope order"
+        ),
+    )
+    parser.add_argument(
+        "--topology",
+        type=str,
+        default="auto",
+        help=(
+            "gpu topology for `--allocator best_fit`: `auto` asks the gpu backend "
+            "(`nvidia-smi topo -m`), or a file with the saved output of "
+            "`nvidia-smi topo -m`, or `none`"
+        ),
+    )
+    parser.add_argument(
+        "--backfill",
+        type=str,
+        choices=["on", "off"],
+        default="on",
+        help=(
+            "`on` reserves gpus for the oldest blocked multi-gpu client, later clients "
+            "only take them if their declared `walltime` ends before the reservation "
+            "starts. `off` assigns free gpus strictly in queue order"
+        ),
+    )
+    parser.add_argument(
+        "--fair_share_half_life",
+        type=float,
+        default=24,
+        help=(
+            "half life (hours) of the gpu usage of a user. waiting clients of users "
+            "with less recent usage go first. set `0` to schedule in queue order"
+        ),
+    )
+    parser.add_argument(
+        "--default_walltime",
+        type=int,
+        default=3600,
+        help="gpu seconds charged per gpu to the fair share of clients without a `walltime`",
+    )
+    parser.add_argument(
+        "--max_gpus_per_user",
+        type=int,
+        default=-1,
+        help="max number of gpus a user may hold at once. set `-1` for unlimited",
+    )
+    parser.add_argument(
+        "--user_quotas",
+        type=str,
+        default="",
+        help="per user overrides of `--max_gpus_per_user`, e.g. `alice=8,bob=2`",
+    )
     args = parser.parse_args()
+    LONG_POLL_TIMEOUT = args.long_poll_timeout
+    BACKFILL = args.backfill == "on"
+    PROFILE = args.profile
+    fair_share.half_life = args.fair_share_half_life * 3600
+    fair_share.default_walltime = args.default_walltime
+    fair_share.max_gpus_per_user = None if args.max_gpus_per_user < 0 else args.max_gpus_per_user
+    for quota in filter(None, args.user_quotas.split(",")):
+        user, num = quota.split("=", 1)
+        fair_share.user_quotas[user.strip()] = int(num)
+    cc.max_finished = args.max_finished
+
+    if args.gpu_backend == "simulated":
+        backend = get_backend(args.gpu_backend, num_gpus=args.simulated_gpus)
+    elif args.gpu_backend == "cluster":
+        backend = get_backend(args.gpu_backend, node_timeout=args.node_timeout)
+    else:
+        backend = get_backend(args.gpu_backend)
+    set_default_backend(backend)
+    gpu_info.backend = backend
+    logger.info(f"GPU backend: {backend.name}")
+
+    if args.topology == "auto":
+        topology = backend.topology()
+    elif args.topology.lower() == "none":
+        topology = None
+    else:
+        with open(args.topology, "rt", encoding="utf-8") as fin:
+            topology = GPUTopology.from_text(fin.read())
+    if args.gpu_backend == "cluster" and args.allocator != BestFitAllocator.name:
+        # only `best_fit` knows the node boundaries, see `ClusterBackend.topology`
+        logger.warning("cluster mode uses `--allocator best_fit`")
+        args.allocator = BestFitAllocator.name
+    gpu_info.allocator = get_allocator(args.allocator, topology=topology)
+    if topology is not None:
+        logger.info(f"GPU allocator: {args.allocator}, topology islands: {topology.islands}")
+    else:
+        logger.info(f"GPU allocator: {args.allocator}, topology unknown")
+
+    ping_log.interval = wait_log.interval = args.request_log_interval
+    gpu_info.history.min_free_time = args.min_free_time
+    gpu_info.history.grant_hold = args.grant_hold
+
+    if args.max_snapshot_age < 0:
+        gpu_info.max_snapshot_age = args.request_interval * 2
+    else:
+        gpu_info.max_snapshot_age = args.max_snapshot_age
 
     # Handle token authentication
     if args.token.lower() == "none":
@@ -507,6 +1687,12 @@ if __name__ == "__main__":
         logger.info(f"Authentication enabled with token: {AUTH_TOKEN}")
         logger.info(f"Token saved to {os.path.abspath(TOKEN_FILE)}")
 
+    if args.state_file.lower() != "none":
+        num_work, num_finished = restore_clients(cc, ClientStore(args.state_file))
+        logger.info(
+            f"Restored {num_work} working and {num_finished} finished clients from {args.state_file}"
+        )
+
     logger.info(f"Running at: {args.host}:{args.port}")
     logger.info(f"Current pid: {os.getpid()} > {PID_FILE}")
     with open(PID_FILE, "wt", encoding="utf-8") as fout:
@@ -516,14 +1702,22 @@ if __name__ == "__main__":
     # thread 1: check gpu and client info regularly
     check_worker = threading.Thread(
         name="check",
-        target=regular_check,
-        args=(args.request_interval, args.queue_timeout, args.status_queue_keep_time),
+        target=run_worker,
+        args=(
+            regular_check,
+            args.request_interval,
+            args.queue_timeout,
+            args.status_queue_keep_time,
+        ),
         daemon=True,
     )
 
     # thread 2: main server api backend
     api_server_worker = threading.Thread(
-        name="api", target=api_server, args=(args.host, args.port), daemon=True
+        name="api",
+        target=run_worker,
+        args=(api_server, args.host, args.port, args.server, args.workers),
+        daemon=True,
     )
 
     check_worker.start()
@@ -531,18 +1725,16 @@ if __name__ == "__main__":
     api_server_worker.start()
     logger.info("api server started")
 
-    while True:
-        try:
-            if not check_worker.is_alive():
-                logger.error("check worker is not alive, server quit")
-                raise RuntimeError("check worker is not alive, server quit")
-            if not api_server_worker.is_alive():
-                logger.error("api server worker is not alive, server quit")
-                raise RuntimeError("api server worker is not alive, server quit")
-        except RuntimeError:
-            logger.error("runtime error, kill the server")
-            break
-        except KeyboardInterrupt:
-            logger.error("keyboard interrupted, kill the server")
-            break
+    # block until one of the workers exits instead of spinning on `is_alive()`
+    try:
+        worker_exited.wait()
+        if not check_worker.is_alive():
+            logger.error("check worker is not alive, server quit")
+        if not api_server_worker.is_alive():
+            logger.error("api server worker is not alive, server quit")
+    except KeyboardInterrupt:
+        logger.error("keyboard interrupted, kill the server")
+    work_trigger.stop()
+    if cc.store is not None:
+        cc.store.close()
     logger.error("bye")
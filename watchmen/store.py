@@ -0,0 +1,162 @@
+import gc
+import json
+import sqlite3
+import datetime
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from watchmen.client import ClientModel
+
+
+# pydantic v2 validates json natively, which is much faster than `json.loads` + `__init__`
+parse_client = getattr(ClientModel, "model_validate_json", None) or ClientModel.parse_raw
+
+
+class ClientStore(object):
+    """Crash-safe persistence of the work and finished queues in SQLite (WAL mode).
+
+    Changes are buffered in memory and written by `flush` in a single
+    transaction, so a burst of registrations costs one fsync. Buffered
+    changes are coalesced by key, a key is `(client_id, finished)` which
+    mirrors the two queues of `ClientCollection`. Rows keep their insertion
+    order, so the work queue is restored in the same order.
+
+    Finished clients evicted from memory by the `max_finished` cap stay
+    here as history until they expire.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()  # guards `_pending`
+        self._write_lock = threading.Lock()  # guards `conn`
+        self._pending = OrderedDict()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # every commit is fsynced, commits are batched by `flush`
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS clients ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "id TEXT NOT NULL, "
+            "finished INTEGER NOT NULL, "
+            "last_request_time REAL, "
+            "data TEXT NOT NULL, "
+            "UNIQUE (id, finished))"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS finished_time ON clients (finished, last_request_time)"
+        )
+
+    def save(self, client: ClientModel, finished: Optional[bool] = False):
+        key = (client.id, int(finished))
+        data = json.dumps(client.dict(), default=str, ensure_ascii=False)
+        last_request_time = None
+        if client.last_request_time is not None:
+            last_request_time = client.last_request_time.timestamp()
+        with self._lock:
+            op = self._pending.get(key, (None, None, None))[0]
+            # deleted then added again: the row must move to the end of the queue
+            if op in ("delete", "reinsert"):
+                self._pending[key] = ("reinsert", last_request_time, data)
+                self._pending.move_to_end(key)
+            else:
+                self._pending[key] = ("upsert", last_request_time, data)
+
+    def delete(self, client_id: str, finished: Optional[bool] = False):
+        with self._lock:
+            self._pending[(client_id, int(finished))] = ("delete", None, None)
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, OrderedDict()
+            if not pending:
+                return 0
+            self.conn.execute("BEGIN")
+            try:
+                for (client_id, finished), (op, last_request_time, data) in pending.items():
+                    if op in ("delete", "reinsert"):
+                        self.conn.execute(
+                            "DELETE FROM clients WHERE id = ? AND finished = ?",
+                            (client_id, finished),
+                        )
+                    if op in ("upsert", "reinsert"):
+                        self.conn.execute(
+                            "INSERT INTO clients (id, finished, last_request_time, data) "
+                            "VALUES (?, ?, ?, ?) ON CONFLICT (id, finished) DO UPDATE SET "
+                            "last_request_time = excluded.last_request_time, data = excluded.data",
+                            (client_id, finished, last_request_time, data),
+                        )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return len(pending)
+
+    def load(self, max_finished: Optional[int] = None):
+        """returns `(work_clients, finished_clients)` in their queue order,
+        with at most the `max_finished` latest finished clients"""
+        work_clients = []
+        finished_clients = []
+        limit = -1 if max_finished is None or max_finished < 0 else max_finished
+        with self._write_lock:
+            rows = self.conn.execute(
+                "SELECT finished, data FROM clients WHERE finished = 0 OR seq IN ("
+                "SELECT seq FROM clients WHERE finished = 1 "
+                "ORDER BY last_request_time DESC LIMIT ?) ORDER BY seq",
+                (limit,),
+            ).fetchall()
+        # the cyclic gc only slows down a bulk load of acyclic objects
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for finished, data in rows:
+                client = parse_client(data)
+                if finished:
+                    finished_clients.append(client)
+                else:
+                    work_clients.append(client)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return work_clients, finished_clients
+
+    def expire(self, before: datetime.datetime):
+        """delete the finished clients (including the ones only kept here) not requested after `before`"""
+        self.flush()
+        with self._write_lock:
+            cursor = self.conn.execute(
+                "DELETE FROM clients WHERE finished = 1 AND last_request_time <= ?",
+                (before.timestamp(),),
+            )
+        return cursor.rowcount
+
+    def compact(self):
+        """fold the WAL back into the database file and release the free pages"""
+        self.flush()
+        with self._write_lock:
+            self.conn.execute("PRAGMA incremental_vacuum")
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        self.flush()
+        with self._write_lock:
+            self.conn.close()
+
+
+def restore_clients(cc, store: ClientStore):
+    """load the persisted queues into `cc` and attach `store` for the upcoming changes
+
+    Working clients get a fresh `last_request_time`, so the downtime of the
+    server is not counted into their `queue_timeout`.
+    """
+    work_clients, finished_clients = store.load(max_finished=cc.max_finished)
+    now = datetime.datetime.now()
+    for client in work_clients:
+        client.last_request_time = now
+    with cc.lock:
+        cc.load(work_clients, finished_clients)
+        cc.store = store
+    return len(work_clients), len(finished_clients)
@@ -23,6 +23,27 @@ def parse_args(in_args=None):
         default="none",
         help="scheduling/queue wait",
     )
+    arg_parser.add_argument(
+        "--walltime",
+        type=int,
+        default=None,
+        help="expected run time (seconds), lets the task backfill idle gpus",
+    )
+    arg_parser.add_argument(
+        "--priority",
+        choices=["high", "normal", "low"],
+        default="normal",
+        help="priority class",
+    )
+    arg_parser.add_argument(
+        "--nodes",
+        type=str,
+        default=None,
+        help=(
+            "cluster mode: comma separated nodes `--cuda` refers to, `any` for any node. "
+            "`<node>:<gpus>` is printed instead of `<gpus>`"
+        ),
+    )
     arg_parser.add_argument(
         "--token",
         type=str,
@@ -51,6 +72,9 @@ if __name__ == "__main__":
         sys.exit(0)
     random_id = "-" + "".join(random.sample(string.ascii_letters + string.digits, 8))
     exp_id = in_argv.task_name + random_id
+    nodes = None
+    if in_argv.nodes is not None:
+        nodes = [] if in_argv.nodes == "any" else in_argv.nodes.split(",")
     watch_client = WatchClient(
         id=exp_id,
         gpus=eval(f"[{in_argv.cuda}]"),
@@ -60,7 +84,14 @@ if __name__ == "__main__":
         mode=in_argv.wait,
         timeout=60,
         token=in_argv.token,
+        walltime=in_argv.walltime,
+        priority=in_argv.priority,
+        nodes=nodes,
     )
-    available_gpus = watch_client.wait()
+    with watch_client:
+        available_gpus = watch_client.wait()
     available_gpus = [str(x) for x in available_gpus]
-    print(",".join(available_gpus), end="")
+    if nodes is not None:
+        print(f"{watch_client.node}:" + ",".join(available_gpus), end="")
+    else:
+        print(",".join(available_gpus), end="")